@@ -0,0 +1,136 @@
+import codecs
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+# Rows per DataFrame chunk yielded by record_frames(...)
+CHUNK_ROWS = 50000
+
+# Repetitive string fields stored as categoricals; everything listed in NUMERIC_COLUMNS is parsed as a number
+CATEGORICAL_COLUMNS = ['state_code', 'county_code', 'site_number', 'parameter_code', 'parameter', 'poc', 'method',
+                       'method_code', 'units_of_measure', 'date_local', 'time_local', 'date_gmt', 'time_gmt',
+                       'date_of_last_change', 'qualifier', 'sample_frequency', 'detection_limit', 'uncertainty']
+NUMERIC_COLUMNS = ['sample_measurement', 'latitude', 'longitude']
+
+# Fields identifying the site of a sampleData record
+SITE_COLUMNS = ['state_code', 'county_code', 'site_number']
+
+# Separators allowed between two records of the array
+SEPARATORS = re.compile(r'[\s,]*')
+WHITESPACE = re.compile(r'\s*')
+
+def iter_records(chunks, key='Data', on_header=None):
+    """
+    Incrementally parse the records of the key array of a JSON response, without holding the whole
+    payload in memory. Only the text of the record being decoded is buffered.
+
+    Parameters:
+        chunks: iterable of bytes - Raw response body, eg. requests.Response.iter_content(...).
+        key: String - Top level array to parse.
+        on_header: function - Called with the decoded Header value if it precedes the key array (AQS
+                              sends it first), before any record is yielded. It may raise to stop parsing.
+
+    Returns:
+        Generator of dicts, one per record.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    marker = f'"{key}"'
+    header_marker = '"Header"'
+    buf, pos, in_array, header_seen = '', 0, False, False
+
+    for chunk in chunks:
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        if not in_array:
+            if not header_seen:
+                header_pos = buf.find(header_marker)
+                start = buf.find(marker)
+                if header_pos >= 0 and (start < 0 or header_pos < start):
+                    colon = buf.find(':', header_pos + len(header_marker))
+                    try:
+                        if colon < 0:
+                            raise json.JSONDecodeError('Header value not received yet', buf, header_pos)
+                        header, end = decoder.raw_decode(buf, WHITESPACE.match(buf, colon + 1).end())
+                    except json.JSONDecodeError:
+                        # The Header continues in the next chunk
+                        pos = header_pos
+                        continue
+                    header_seen = True
+                    if on_header is not None:
+                        on_header(header)
+                    buf, pos = buf[end:], 0
+            start = buf.find(marker)
+            bracket = buf.find('[', start) if start >= 0 else -1
+            if bracket < 0:
+                # Keep enough of the tail to match a marker split across chunks
+                pos = max(0, start if start >= 0 else len(buf) - max(len(marker), len(header_marker)))
+                continue
+            pos, in_array = bracket + 1, True
+
+        while True:
+            pos = SEPARATORS.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # The record continues in the next chunk
+                break
+            yield record
+            pos = end
+
+    if in_array:
+        raise ValueError(f"Response ended before the end of the {key} array.")
+    raise ValueError(f"Response has no {key} array.")
+
+def record_frame(records, columns=None):
+    """
+    Helper function. Typed columnar frame of a list of records.
+    """
+    df = pd.DataFrame.from_records(records, columns=columns)
+    for col in df.columns:
+        if col in NUMERIC_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        elif col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype('category')
+    return df
+
+def record_frames(records, chunk_rows=CHUNK_ROWS, columns=None):
+    """
+    Group a stream of records into typed DataFrame chunks: numeric measurements and coordinates,
+    categorical site, parameter, method and date fields.
+
+    Parameters:
+        records: iterable of dicts - Eg. the output of iter_records(...).
+        chunk_rows: int - Rows per chunk.
+        columns: [String] - Fields to keep, defaults to all of them.
+
+    Returns:
+        Generator of pd.DataFrame.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= chunk_rows:
+            yield record_frame(batch, columns)
+            batch = []
+    if batch:
+        yield record_frame(batch, columns)
+
+def site_labels(df):
+    """
+    '<state>-<county>-<site>' label of every row of a sampleData frame.
+
+    Returns:
+        np.ndarray of String.
+    """
+    # Labels are built once per distinct site, not once per row
+    groups = df.groupby(SITE_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+    keys = df[SITE_COLUMNS].iloc[np.unique(groups, return_index=True)[1]].astype(str)
+    labels = (keys['state_code'] + '-' + keys['county_code'] + '-' + keys['site_number']).to_numpy()
+    return labels[groups]
@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# AQS sampleData endpoints accept at most 5 comma separated parameter codes per request
+MAX_PARAMS_PER_REQUEST = 5
+
+class AvailabilityScan():
+    """
+    Site x code x date presence matrix built from bulk AQS queries. Progress is checkpointed to
+    disk so that an interrupted scan can be resumed.
+    """
+
+    def __init__(self, sites, codes, dates, path=None):
+        """
+        Parameters:
+            sites: [String] - Site codes (AQS site_number).
+            codes: [String] - Parameter codes.
+            dates: [(String, String)] - (bdate, edate) windows to sample.
+            path: String - Optional .npz checkpoint file.
+        """
+        self.sites = [str(s) for s in sites]
+        self.codes = [str(c) for c in codes]
+        self.dates = [tuple(str(d) for d in date) for date in dates]
+        self.path = path
+        self.presence = np.zeros((len(self.sites), len(self.codes), len(self.dates)), dtype=bool)
+        self.done = set()
+        self.site_pos = {s: i for i, s in enumerate(self.sites)}
+        self.code_pos = {c: i for i, c in enumerate(self.codes)}
+
+    @classmethod
+    def resume(cls, path, sites, codes, dates):
+        """
+        Load the checkpoint at path if it exists and was made for the same sites, codes and dates,
+        otherwise start a fresh scan that will checkpoint to path.
+        """
+        scan = cls(sites, codes, dates, path=path)
+        if path and os.path.exists(path):
+            with np.load(path) as f:
+                meta = json.loads(str(f['meta']))
+                same = [meta['sites'], meta['codes'], [list(d) for d in meta['dates']]] == \
+                       [scan.sites, scan.codes, [list(d) for d in scan.dates]]
+                if same:
+                    scan.presence = f['presence'].copy()
+                    scan.done = set(f['done'].tolist())
+        return scan
+
+    @staticmethod
+    def saved_dates(path):
+        """
+        Sampled windows stored in the checkpoint at path, or None if there is no checkpoint.
+        """
+        if not path or not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return [tuple(d) for d in json.loads(str(f['meta']))['dates']]
+
+    def save(self):
+        """
+        Write the current state to self.path (atomically, so a crash never leaves a broken checkpoint).
+        """
+        if not self.path:
+            return
+        meta = json.dumps({'sites': self.sites, 'codes': self.codes, 'dates': self.dates})
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, presence=self.presence, done=np.array(sorted(self.done), dtype=str), meta=np.array(meta))
+        os.replace(tmp, self.path)
+
+    def task_key(self, date_idx, chunk_idx, site=None):
+        """
+        Key in self.done of one request: a window and code chunk for every site (county queries), or for one site.
+        """
+        return f"{date_idx}:{chunk_idx}" if site is None else f"{site}:{date_idx}:{chunk_idx}"
+
+    def checked(self):
+        """
+        Boolean array shaped like self.presence, True where the request covering the (site, code, date)
+        succeeded. Windows whose request failed or has not run yet are False.
+        """
+        checked = np.zeros_like(self.presence)
+        for key in self.done:
+            *site, d, c = key.split(':')
+            sites = slice(None) if not site else self.site_pos[site[0]]
+            codes = slice(int(c) * MAX_PARAMS_PER_REQUEST, (int(c) + 1) * MAX_PARAMS_PER_REQUEST)
+            checked[sites, codes, int(d)] = True
+        return checked
+
+    def code_chunks(self):
+        """
+        Split codes into groups small enough for one AQS request.
+        """
+        return [self.codes[i:i + MAX_PARAMS_PER_REQUEST] for i in range(0, len(self.codes), MAX_PARAMS_PER_REQUEST)]
+
+    def mark(self, date_idx, records):
+        """
+        Record which (site, code) pairs returned data for the window dates[date_idx].
+
+        Parameters:
+            date_idx: int - Index into self.dates.
+            records: [dict] - Raw AQS sampleData records.
+        """
+        if not records:
+            return
+        df = pd.DataFrame(records, columns=['site_number', 'parameter_code'])
+        site_idx = df['site_number'].astype(str).map(self.site_pos)
+        code_idx = df['parameter_code'].astype(str).map(self.code_pos)
+        keep = site_idx.notna() & code_idx.notna()
+        self.presence[site_idx[keep].astype(int).to_numpy(), code_idx[keep].astype(int).to_numpy(), date_idx] = True
+
+    def site_result(self, site, date_idxs=None):
+        """
+        Presence for one site in the legacy nested list format: one list (per date) for every code.
+        Windows that could not be scanned are False here, see site_unchecked(...).
+        """
+        arr = self.presence[self.site_pos[str(site)]]
+        if date_idxs is not None:
+            arr = arr[:, date_idxs]
+        return arr.tolist()
+
+    def site_unchecked(self, site, date_idxs=None, checked=None):
+        """
+        Windows of one site whose request failed (or has not run), in the format of site_result(...). Their
+        False entries in site_result mean unknown rather than no data. Pass checked (from checked()) when
+        calling this for many sites, so it is only built once.
+        """
+        checked = self.checked() if checked is None else checked
+        arr = ~checked[self.site_pos[str(site)]]
+        if date_idxs is not None:
+            arr = arr[:, date_idxs]
+        return arr.tolist()
+
+    def totals(self):
+        """
+        Number of (code, date) pairs with data for every site.
+        """
+        return dict(zip(self.sites, self.presence.sum(axis=(1, 2)).tolist()))
@@ -0,0 +1,204 @@
+"""
+Local stand-in for the AQS API, so DataFetcher can be benchmarked without the network.
+
+Responses are replayed from a ResponseCache recorded during normal runs (--replay), and anything not
+recorded is synthesised: a fixed parameter catalog, a county with any number of sites, and hourly
+sampleData records with deterministic values. Point a DataFetcher at it with base_url:
+
+    with StandInAQS(sites=4) as server:
+        fetcher = DataFetcher(base_url=server.url, cache=False, rate_limit=None)
+
+It can also be run on its own:
+
+$ python3 -m benchmarks.aqs_server --port 8080 --sites 4 --replay data/cache/aqs.sqlite
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from response_cache import ResponseCache
+
+# Synthetic catalog: every parameter generate.py asks for, plus a few PAMS VOCs
+CORE_PARAMETERS = {
+    '42101': 'Carbon monoxide', '42602': 'Nitrogen dioxide (NO2)', '44201': 'Ozone', '88101': 'PM2.5 - Local Conditions',
+    '61104': 'Wind Direction - Resultant', '61103': 'Wind Speed - Resultant', '62101': 'Outdoor Temperature',
+    '62201': 'Relative Humidity ', '63301': 'Solar radiation', '63302': 'Ultraviolet radiation', '64101': 'Barometric pressure',
+    '42601': 'Nitric oxide (NO)', '42603': 'Oxides of nitrogen (NOx)',
+}
+VOC_PARAMETERS = {
+    '45201': 'Benzene', '45202': 'Toluene', '43202': 'Ethane', '43204': 'Propane', '43212': 'n-Butane',
+    '43221': 'Isopentane', '43502': 'Formaldehyde', '43503': 'Acetaldehyde',
+}
+PARAMETERS = {**CORE_PARAMETERS, **VOC_PARAMETERS}
+
+STATE, COUNTY = '06', '037'
+FIRST_SITE = ('1103', 'Los Angeles-North Main Street')
+
+# Fields of a synthetic sampleData record that do not depend on the reading
+RECORD_TEMPLATE = {
+    'poc': 1, 'datum': 'WGS84', 'units_of_measure': 'Parts per million', 'units_of_measure_code': '007',
+    'sample_duration': '1 HOUR', 'sample_duration_code': '1', 'sample_frequency': 'HOURLY', 'detection_limit': 0.005,
+    'uncertainty': None, 'qualifier': None, 'method_type': 'FEM', 'method': 'INSTRUMENTAL - ULTRA VIOLET ABSORPTION',
+    'method_code': '087', 'state': 'California', 'county': 'Los Angeles', 'date_of_last_change': '2019-05-01', 'cbsa_code': '31080',
+}
+
+def seed(*parts):
+    """
+    Helper function. Stable integer seed for a combination of values.
+    """
+    return int(hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()[:8], 16)
+
+class StandInAQS():
+    """
+    Threaded HTTP server answering list/ and sampleData/ queries like AQS does.
+    """
+
+    def __init__(self, sites=1, port=0, replay=None, latency=0.0, coverage=0.8, voc_every=6):
+        """
+        Parameters:
+            sites: int - Number of sites in the synthetic county (the first one is North Main Street).
+            port: int - Port to listen on, 0 picks a free one.
+            replay: String - Optional ResponseCache file whose recorded responses are served first.
+            latency: float - Seconds added to every response, to mimic the network.
+            coverage: float - Fraction of (site, parameter) pairs with data. The first site has everything.
+            voc_every: int - VOCs are sampled every voc_every days, like PAMS canister samples.
+        """
+        self.sites = [FIRST_SITE] + [(f'{9000 + i:04d}', f'Synthetic site {i}') for i in range(1, sites)]
+        self.latency = latency
+        self.coverage = coverage
+        self.voc_every = voc_every
+        self.replay = ResponseCache(replay, ttls={'': None, 'list/': None}) if replay else None
+        self.requests = 0
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                body = json.dumps(server.respond(url.path.lstrip('/'), params)).encode()
+                if server.latency:
+                    time.sleep(server.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/'
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.replay is not None:
+            self.replay.close()
+
+    def respond(self, endpoint, params):
+        """
+        Payload for one query: the recorded response if there is one, a synthetic one otherwise.
+        """
+        self.requests += 1
+        if self.replay is not None:
+            payload = self.replay.get(endpoint, params)
+            if payload is not None:
+                return payload
+
+        if endpoint == 'list/parametersByClass':
+            catalog = VOC_PARAMETERS if params.get('pc') == 'PAMS_VOC' else PARAMETERS
+            data = [{'code': code, 'value_represented': name} for code, name in catalog.items()]
+        elif endpoint == 'list/sitesByCounty':
+            data = [{'code': code, 'value_represented': name} for code, name in self.sites]
+        elif endpoint.startswith('monitors/'):
+            data = [{**{k: RECORD_TEMPLATE[k] for k in ['state', 'county', 'cbsa_code']}, 'state_code': STATE, 'county_code': COUNTY,
+                     'site_number': code, 'parameter_code': params['param'], 'poc': 1, 'local_site_name': name,
+                     **self.coordinates(code)} for code, name in self.sites if self.has_data(code, params['param'])]
+        elif endpoint.startswith('sampleData/'):
+            sites = [s for s in self.sites if s[0] == params['site']] if 'site' in params else self.sites
+            data = self.sample_data(sites, params['param'].split(','), params['bdate'], params['edate'])
+        else:
+            return {'Header': [{'status': 'Failed', 'error': [f'Unknown endpoint {endpoint}']}]}
+
+        status = 'Success' if data else 'No data matched your selection'
+        return {'Header': [{'status': status, 'request_time': pd.Timestamp.now().isoformat(), 'url': endpoint, 'rows': len(data)}],
+                'Data': data}
+
+    def has_data(self, site, code):
+        """
+        Helper function. Whether a site measures a parameter.
+        """
+        return site == FIRST_SITE[0] or seed(site, code) % 1000 < self.coverage * 1000
+
+    def coordinates(self, site):
+        """
+        Helper function. Latitude and longitude of a site, spread around North Main Street.
+        """
+        return {'latitude': 34.06659 + int(site) * 1e-4, 'longitude': -118.22688}
+
+    def sample_data(self, sites, codes, bdate, edate):
+        """
+        Hourly records for every site and parameter between bdate and edate (YYYYMMDD, inclusive).
+        """
+        days = pd.date_range(str(bdate), str(edate), freq='D')
+        records = []
+        for site, _ in sites:
+            for code in codes:
+                if code not in PARAMETERS or not self.has_data(site, code):
+                    continue
+                code_days = days[days.dayofyear % self.voc_every == 0] if code in VOC_PARAMETERS else days
+                if len(code_days) == 0:
+                    continue
+                times = (code_days.values[:, None] + np.arange(24) * np.timedelta64(1, 'h')).ravel()
+                stamps = pd.DatetimeIndex(times)
+                rng = np.random.default_rng(seed(site, code, bdate))
+                values = np.round(np.abs(rng.normal(10, 3, len(stamps))), 3)
+                base = {**RECORD_TEMPLATE, 'state_code': STATE, 'county_code': COUNTY, 'site_number': site,
+                        'parameter_code': code, 'parameter': PARAMETERS[code],
+                        **self.coordinates(site)}
+                dates, hours = stamps.strftime('%Y-%m-%d'), stamps.strftime('%H:%M')
+                gmt = stamps + pd.Timedelta('8h')
+                gmt_dates, gmt_hours = gmt.strftime('%Y-%m-%d'), gmt.strftime('%H:%M')
+                records.extend({**base, 'date_local': d, 'time_local': h, 'date_gmt': gd, 'time_gmt': gh, 'sample_measurement': float(v)}
+                               for d, h, gd, gh, v in zip(dates, hours, gmt_dates, gmt_hours, values))
+        return records
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recorded and synthetic AQS responses locally.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--sites', type=int, default=1, help='Number of sites in the synthetic county.')
+    parser.add_argument('--replay', default=None, help='ResponseCache file with recorded responses.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    args = parser.parse_args()
+
+    server = StandInAQS(sites=args.sites, port=args.port, replay=args.replay, latency=args.latency)
+    print(f"Serving AQS stand-in at {server.url} (Ctrl-C to stop)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+if __name__ == '__main__':
+    main()
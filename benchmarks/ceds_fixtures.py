@@ -0,0 +1,75 @@
+"""
+Synthetic NetCDF files laid out like the CEDS anthropogenic emissions files read by DataFetcher:
+<root>/<year>/<compound>-em-anthro_CMIP_CEDS_<year>.nc, with monthly (time, lat, lon) sector variables
+named <compound>_<sector> on a regular global grid.
+"""
+
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+from benchmarks.aqs_server import seed
+
+# CEDS sectors: agriculture, energy, industry, transport, residential/commercial, solvents, waste, shipping
+SECTORS = ['agr', 'ene', 'ind', 'tra', 'rco', 'slv', 'wst', 'shp']
+
+def ceds_file_name(compound, year):
+    return f'{compound}-em-anthro_CMIP_CEDS_{year}.nc'
+
+def write_ceds_file(path, compound, year, resolution=1.0, sectors=SECTORS, compress=True):
+    """
+    Write one synthetic CEDS file.
+
+    Parameters:
+        path: String - Destination.
+        compound: String - CEDS compound, eg. 'BENZ'.
+        year: String - Year of the monthly time axis.
+        resolution: float - Grid spacing in degrees (CEDS itself uses 0.5).
+        sectors: [String] - Sector variables to write.
+        compress: bool - zlib compress the variables like the published files.
+    """
+    lats = np.arange(-90 + resolution / 2, 90, resolution)
+    lons = np.arange(-180 + resolution / 2, 180, resolution)
+    rng = np.random.default_rng(seed(compound, year))
+
+    with nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        ds.frequency = 'mon'
+        ds.createDimension('time', 12)
+        ds.createDimension('lat', len(lats))
+        ds.createDimension('lon', len(lons))
+
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = f'days since {year}-01-01 00:00:00'
+        time.calendar = 'standard'
+        time[:] = [(np.datetime64(f'{year}-{m:02d}-01') - np.datetime64(f'{year}-01-01')).astype(int) for m in range(1, 13)]
+        ds.createVariable('lat', 'f8', ('lat',))[:] = lats
+        ds.createVariable('lon', 'f8', ('lon',))[:] = lons
+
+        # One month of one sector at a time keeps memory flat for fine grids
+        for sector in sectors:
+            var = ds.createVariable(f'{compound}_{sector}', 'f4', ('time', 'lat', 'lon'), zlib=compress, complevel=1,
+                                    chunksizes=(1, len(lats), len(lons)))
+            var.units = 'kg m-2 s-1'
+            for month in range(12):
+                var[month] = rng.gamma(0.5, 1e-10, (len(lats), len(lons))).astype('f4')
+
+def make_ceds_fixtures(root, years, compounds, resolution=1.0, sectors=SECTORS):
+    """
+    Write every (compound, year) file under root/<year>/, skipping files that already exist.
+
+    Returns:
+        [String] - File names (not paths), as returned by DataFetcher.get_ceds_links(...).
+    """
+    names = []
+    for year in years:
+        directory = os.path.join(root, str(year))
+        os.makedirs(directory, exist_ok=True)
+        for compound in compounds:
+            name = ceds_file_name(compound, year)
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                write_ceds_file(path + '.tmp', compound, year, resolution, sectors)
+                os.replace(path + '.tmp', path)
+            names.append(name)
+    return names
@@ -0,0 +1,252 @@
+"""
+Offline benchmarks for DataFetcher and Processor, run against the local AQS stand-in
+(benchmarks/aqs_server.py) and synthetic CEDS files (benchmarks/ceds_fixtures.py).
+
+Every benchmark runs at several scales, from one site-day to several site-years, and the peak memory
+of one extra run is traced with tracemalloc. Results are written to benchmarks/results/<commit>.json so
+two commits can be compared:
+
+$ python3 -m benchmarks.run
+$ python3 -m benchmarks.run --only create_dataset join --scales site-day site-year --repeat 5
+$ python3 -m benchmarks.run --compare benchmarks/results/<other commit>.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.aqs_server import CORE_PARAMETERS, COUNTY, STATE, VOC_PARAMETERS, StandInAQS
+from benchmarks.ceds_fixtures import make_ceds_fixtures
+from data_fetcher import DataFetcher
+from metrics import METRICS
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# sites: sites in the county (and sites fetched), days: length of the fetched range,
+# years: CEDS files per compound, samples: sampled windows in find_best_location
+SCALES = {
+    'site-day': {'sites': 1, 'days': 1, 'years': 1, 'samples': 1},
+    'site-month': {'sites': 1, 'days': 31, 'years': 1, 'samples': 2},
+    'site-year': {'sites': 1, 'days': 365, 'years': 1, 'samples': 4},
+    'sites-years': {'sites': 4, 'days': 730, 'years': 2, 'samples': 4},
+}
+
+CEDS_COMPOUNDS = ['BENZ', 'TOLU', 'C2H6', 'C3H8']
+
+# Regressions larger than this fraction are flagged by --compare
+THRESHOLD = 0.10
+
+def date_range(scale):
+    """
+    Helper function. (bdate, edate) covering scale['days'] days and ending on 2018-12-31.
+    """
+    end = pd.Timestamp('2018-12-31')
+    start = end - pd.Timedelta(days=scale['days'] - 1)
+    return start.strftime('%Y%m%d'), end.strftime('%Y%m%d')
+
+def site_codes(server, scale):
+    return [code for code, _ in server.sites[:scale['sites']]]
+
+def bench_create_dataset(fetcher, server, scale, fixtures):
+    bdate, edate = date_range(scale)
+    return sum(len(fetcher.create_dataset(bdate, edate, site=site, county=COUNTY, state=STATE)) for site in site_codes(server, scale))
+
+def bench_get_voc_data(fetcher, server, scale, fixtures):
+    bdate, edate = date_range(scale)
+    vocs = list(VOC_PARAMETERS.values())
+    return sum(len(fetcher.get_voc_data(bdate, edate, STATE, COUNTY, site, vocs)) for site in site_codes(server, scale))
+
+def bench_join(fetcher, server, scale, fixtures):
+    # Per-parameter frames are built before timing starts, see prepare_join
+    dfs = fixtures['join'][scale['name']]
+    return len(fetcher.processor.join(dfs))
+
+def prepare_join(fetcher, server, scale):
+    """
+    Helper function. One processed frame per core parameter, the input of Processor.join(...).
+    """
+    bdate, edate = date_range(scale)
+    records = server.sample_data(server.sites[:1], list(CORE_PARAMETERS), bdate, edate)
+    df = pd.DataFrame(records)
+    # Like the original create_dataset, only the first frame keeps the site coordinates
+    groups = list(df.groupby('parameter'))
+    return [fetcher.processor.process(group.copy(), name, drop_lat_lon=(i > 0)) for i, (name, group) in enumerate(groups)]
+
+def bench_process_batch(fetcher, server, scale, fixtures):
+    # Raw records are generated before timing starts, see prepare_records
+    records = fixtures['records'][scale['name']]
+    return len(fetcher.processor.process_batch(records, names=CORE_PARAMETERS))
+
+def bench_process_join(fetcher, server, scale, fixtures):
+    # The per-parameter process -> join chain that process_batch replaced, on the same records
+    df = pd.DataFrame(fixtures['records'][scale['name']])
+    dfs = [fetcher.processor.process(group.copy(), name, drop_lat_lon=(i > 0)) for i, (name, group) in enumerate(df.groupby('parameter'))]
+    return len(fetcher.processor.join(dfs))
+
+def prepare_records(server, scale):
+    """
+    Helper function. Raw core parameter records of the first site, the input of process_batch and process_join.
+    """
+    bdate, edate = date_range(scale)
+    return server.sample_data(server.sites[:1], list(CORE_PARAMETERS), bdate, edate)
+
+def bench_make_ceds_df(fetcher, server, scale, fixtures):
+    names = [name for name in fixtures['ceds_links'] if int(name[-7:-3]) > 2018 - scale['years']]
+    return len(fetcher.make_ceds_df(34.06659, -118.22688, names, path=os.path.join(fixtures['ceds_root'], '{year}', '')))
+
+def bench_find_best_location(fetcher, server, scale, fixtures):
+    random.seed(0)
+    bdate = 20000101
+    res = fetcher.find_best_location(STATE, COUNTY, bdate=bdate, edate=bdate + 50000 * scale['samples'])
+    return len(res['Data'])
+
+BENCHMARKS = {
+    'create_dataset': bench_create_dataset,
+    'get_voc_data': bench_get_voc_data,
+    'join': bench_join,
+    'process_batch': bench_process_batch,
+    'process_join': bench_process_join,
+    'make_ceds_df': bench_make_ceds_df,
+    'find_best_location': bench_find_best_location,
+}
+
+def git_commit():
+    """
+    Helper function. Short hash of HEAD, with a -dirty suffix if the tree has uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_benchmark(name, scale_name, repeat, workdir, fixtures, resolution):
+    """
+    Run one benchmark at one scale against a fresh stand-in server.
+
+    Returns:
+        dict - Timings (seconds) of every repeat, the requests, bytes and rows of the last one and the peak
+               traced memory (bytes) of a separate run.
+    """
+    scale = {**SCALES[scale_name], 'name': scale_name}
+    with StandInAQS(sites=scale['sites']) as server:
+        fetcher = DataFetcher(base_url=server.url, cache=False, rate_limit=None,
+                              catalog_path=os.path.join(workdir, f'catalog-{scale_name}.json'))
+        # Load the catalog outside the timed runs
+        fetcher.catalog
+        if name == 'join':
+            fixtures.setdefault('join', {})[scale_name] = prepare_join(fetcher, server, scale)
+        if name in ['process_batch', 'process_join']:
+            fixtures.setdefault('records', {})[scale_name] = prepare_records(server, scale)
+        if name == 'make_ceds_df':
+            fixtures['ceds_links'] = make_ceds_fixtures(fixtures['ceds_root'], [str(2018 - i) for i in range(scale['years'])],
+                                                        CEDS_COMPOUNDS, resolution) + fixtures.get('ceds_links', [])
+            fixtures['ceds_links'] = sorted(set(fixtures['ceds_links']))
+
+        times = []
+        for _ in range(repeat):
+            METRICS.reset()
+            start = time.perf_counter()
+            rows = BENCHMARKS[name](fetcher, server, scale, fixtures)
+            times.append(time.perf_counter() - start)
+        snapshot = METRICS.to_dict()
+        # One more, untimed, run under tracemalloc for the peak memory (the stand-in server runs in this process too)
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        BENCHMARKS[name](fetcher, server, scale, fixtures)
+        peak = tracemalloc.get_traced_memory()[1] - start
+        tracemalloc.stop()
+        fetcher.engine.close()
+
+    return {
+        'benchmark': name,
+        'scale': scale_name,
+        'seconds': times,
+        'median': statistics.median(times),
+        'min': min(times),
+        'rows': rows,
+        'requests': sum(e['requests'] for e in snapshot['endpoints'].values()),
+        'bytes': sum(e['bytes'] for e in snapshot['endpoints'].values()),
+        'peak_bytes': peak,
+    }
+
+def compare(results, baseline_path):
+    """
+    Print the change in median time against an earlier results file and return the regressions.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = {(r['benchmark'], r['scale']): r for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path}:")
+    regressions = []
+    for r in results:
+        old = baseline.get((r['benchmark'], r['scale']))
+        if old is None:
+            continue
+        change = r['median'] / old['median'] - 1
+        flag = ' REGRESSION' if change > THRESHOLD else ''
+        print(f"  {r['benchmark']:<20} {r['scale']:<12} {old['median']:9.3f}s -> {r['median']:9.3f}s ({change:+.1%}){flag}")
+        if flag:
+            regressions.append(r)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline DataFetcher / Processor benchmarks.')
+    parser.add_argument('--only', nargs='*', default=list(BENCHMARKS), choices=list(BENCHMARKS), help='Benchmarks to run.')
+    parser.add_argument('--scales', nargs='*', default=list(SCALES), choices=list(SCALES), help='Scales to run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark and scale.')
+    parser.add_argument('--resolution', type=float, default=1.0, help='Grid spacing (degrees) of the synthetic CEDS files.')
+    parser.add_argument('--fixtures', default=None, help='Directory to keep generated CEDS files in between runs.')
+    parser.add_argument('--output', default=None, help='Results file, defaults to benchmarks/results/<commit>.json.')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare against.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chem150-bench-')
+    fixtures = {'ceds_root': args.fixtures or os.path.join(workdir, 'ceds')}
+    METRICS.enable()
+
+    results = []
+    try:
+        for name in args.only:
+            for scale_name in args.scales:
+                result = run_benchmark(name, scale_name, args.repeat, workdir, fixtures, args.resolution)
+                results.append(result)
+                print(f"{name:<20} {scale_name:<12} median {result['median']:8.3f}s  min {result['min']:8.3f}s  "
+                      f"{result['requests']:5d} requests  {result['rows']:8d} rows  peak {result['peak_bytes'] / 2 ** 20:8.1f} MiB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'repeat': args.repeat,
+            'resolution': args.resolution,
+            'results': results,
+        }, f, indent=1)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmarks regressed by more than {THRESHOLD:.0%}.")
+
+if __name__ == '__main__':
+    main()
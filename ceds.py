@@ -0,0 +1,338 @@
+import os
+import re
+
+import cftime
+import numpy as np
+import netCDF4 as nc
+import pandas as pd
+
+from metrics import METRICS, timed
+
+# Coordinate variables of the CEDS NetCDF files; every other variable is an emissions sector
+CEDS_COORDS = ['time', 'lat', 'lon']
+
+# CEDS file names look like <compound>-em-anthro_CMIP_CEDS_<year>.nc
+CEDS_FILE_PATTERN = re.compile(r'^(?P<compound>.+)-em-anthro_CMIP_CEDS_(?P<year>\d{4})\.nc$')
+
+# Grids are identical across CEDS files, so every distinct grid is only indexed once
+GRID_CACHE = {}
+
+class CedsGrid():
+    """
+    Index over the regular lat/lon grid of a CEDS file. Maps coordinates to cell indices without
+    comparing floats for equality.
+    """
+
+    def __init__(self, lats, lons):
+        """
+        Parameters:
+            lats: np.ndarray - Cell centre latitudes (ascending or descending).
+            lons: np.ndarray - Cell centre longitudes (ascending, -180..180 or 0..360).
+        """
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.lat_descending = self.lats[0] > self.lats[-1]
+        self.sorted_lats = self.lats[::-1] if self.lat_descending else self.lats
+        self.lon_360 = self.lons.max() > 180
+
+    @classmethod
+    def from_dataset(cls, ds):
+        """
+        Grid of an open netCDF4.Dataset, reused from GRID_CACHE when an identical grid was seen before.
+        """
+        lats = np.ma.filled(ds.variables['lat'][:].astype(float), np.nan)
+        lons = np.ma.filled(ds.variables['lon'][:].astype(float), np.nan)
+        key = (len(lats), float(lats[0]), float(lats[-1]), len(lons), float(lons[0]), float(lons[-1]))
+        if key not in GRID_CACHE:
+            GRID_CACHE[key] = cls(lats, lons)
+        return GRID_CACHE[key]
+
+    def wrap_lon(self, lon):
+        """
+        Helper function. Express lon in the convention of the grid.
+        """
+        lon = np.asarray(lon, dtype=float)
+        return lon % 360 if self.lon_360 else (lon + 180) % 360 - 180
+
+    def axis_nearest(self, values, targets):
+        """
+        Helper function. Index of the closest value in a sorted axis for every target.
+        """
+        idx = np.clip(np.searchsorted(values, targets), 1, len(values) - 1)
+        left_closer = (targets - values[idx - 1]) <= (values[idx] - targets)
+        return idx - left_closer
+
+    def lat_index(self, sorted_idx):
+        """
+        Helper function. Convert an index into sorted_lats to an index into the file's lat axis.
+        """
+        return len(self.lats) - 1 - sorted_idx if self.lat_descending else sorted_idx
+
+    def nearest(self, lats, lons):
+        """
+        Nearest cell for every (lat, lon).
+
+        Parameters:
+            lats: float or array - Latitudes.
+            lons: float or array - Longitudes.
+
+        Returns:
+            (np.ndarray, np.ndarray) - Row (lat) and column (lon) indices.
+        """
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = self.wrap_lon(np.atleast_1d(lons))
+        i = self.lat_index(self.axis_nearest(self.sorted_lats, lats))
+        j = self.axis_nearest(self.lons, lons)
+        return i, j
+
+    def bilinear(self, lat, lon):
+        """
+        Cells surrounding (lat, lon) and their bilinear interpolation weights.
+
+        Returns:
+            (slice, slice, np.ndarray) - Lat and lon slices into the file (each up to 2 cells wide)
+            and a matching array of weights summing to 1.
+        """
+        lon = float(self.wrap_lon(lon))
+        i0 = int(np.clip(np.searchsorted(self.sorted_lats, lat) - 1, 0, len(self.sorted_lats) - 2))
+        j0 = int(np.clip(np.searchsorted(self.lons, lon) - 1, 0, len(self.lons) - 2))
+        lat0, lat1 = self.sorted_lats[i0], self.sorted_lats[i0 + 1]
+        lon0, lon1 = self.lons[j0], self.lons[j0 + 1]
+        ty = float(np.clip((lat - lat0) / (lat1 - lat0), 0, 1))
+        tx = float(np.clip((lon - lon0) / (lon1 - lon0), 0, 1))
+        weights = np.array([[(1 - ty) * (1 - tx), (1 - ty) * tx], [ty * (1 - tx), ty * tx]])
+        if self.lat_descending:
+            # Rows are stored north to south, flip to match the file layout
+            weights = weights[::-1]
+            start = self.lat_index(i0 + 1)
+        else:
+            start = i0
+        return slice(start, start + 2), slice(j0, j0 + 2), weights
+
+    def box(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Slices covering every cell centre inside a bounding box (lon_min <= lon_max, no dateline wrap).
+
+        Returns:
+            (slice, slice) - Lat and lon slices into the file.
+        """
+        i0, i1 = np.searchsorted(self.sorted_lats, lat_min, side='left'), np.searchsorted(self.sorted_lats, lat_max, side='right')
+        lon_min, lon_max = self.wrap_lon([lon_min, lon_max])
+        j0, j1 = np.searchsorted(self.lons, lon_min, side='left'), np.searchsorted(self.lons, lon_max, side='right')
+        if self.lat_descending:
+            i0, i1 = len(self.lats) - i1, len(self.lats) - i0
+        return slice(int(i0), int(i1)), slice(int(j0), int(j1))
+
+class CedsReader():
+    """
+    Reads only the hyperslabs it needs from a CEDS NetCDF file, instead of whole global grids.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ds = nc.Dataset(path, format="NETCDF4")
+        self.grid = CedsGrid.from_dataset(self.ds)
+        self.variables = [var for var in self.ds.variables if var not in CEDS_COORDS]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.ds.close()
+
+    def times(self):
+        """
+        Decode the time variable with cftime. Monthly files are stamped at the start of each month.
+
+        Returns:
+            pd.DatetimeIndex
+        """
+        time = self.ds.variables['time']
+        dates = cftime.num2date(time[:], time.units, calendar=getattr(time, 'calendar', 'standard'),
+                                only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        index = pd.DatetimeIndex(np.atleast_1d(dates), name='datetime')
+        if getattr(self.ds, 'frequency', 'mon') == 'mon':
+            index = index.to_period('M').to_timestamp()
+            index.name = 'datetime'
+        return index
+
+    def read(self, var, lat_slice, lon_slice):
+        """
+        Helper function. Read a (time, lat, lon) hyperslab as a float array with NaN for missing values.
+        """
+        with METRICS.stage('netcdf_read'):
+            data = self.ds.variables[var][:, lat_slice, lon_slice]
+            data = np.ma.filled(data.astype(float), np.nan)
+        METRICS.add_rows('netcdf_read', data.size)
+        return data
+
+    def read_points(self, lats, lons, method='nearest', variables=None):
+        """
+        Extract time series for many sites in one pass over the file. Sites sharing a grid cell are
+        only read once.
+
+        Parameters:
+            lats: [float] - Site latitudes.
+            lons: [float] - Site longitudes.
+            method: String - 'nearest' cell or 'bilinear' interpolation between the 4 surrounding cells.
+            variables: [String] - Sector variables to read, defaults to all of them.
+
+        Returns:
+            np.ndarray - Array of shape (sites, variables, time).
+        """
+        variables = variables or self.variables
+        lats, lons = np.atleast_1d(lats), np.atleast_1d(lons)
+        n_time = len(self.ds.variables['time'])
+        out = np.empty((len(lats), len(variables), n_time))
+
+        if method == 'nearest':
+            rows, cols = self.grid.nearest(lats, lons)
+            cells, site_cell = np.unique(np.stack([rows, cols], axis=1), axis=0, return_inverse=True)
+            site_cell = np.asarray(site_cell).reshape(-1)
+            for v, var in enumerate(variables):
+                for c, (i, j) in enumerate(cells):
+                    out[site_cell == c, v] = self.read(var, slice(i, i + 1), slice(j, j + 1))[:, 0, 0]
+        elif method == 'bilinear':
+            stencils = [self.grid.bilinear(lat, lon) for lat, lon in zip(lats, lons)]
+            for v, var in enumerate(variables):
+                for s, (lat_slice, lon_slice, weights) in enumerate(stencils):
+                    out[s, v] = (self.read(var, lat_slice, lon_slice) * weights).sum(axis=(1, 2))
+        else:
+            raise ValueError(f"Unknown method {method}, expected 'nearest' or 'bilinear'.")
+        return out
+
+    def read_box(self, lat_min, lat_max, lon_min, lon_max, variables=None):
+        """
+        Read every cell inside a bounding box.
+
+        Returns:
+            (dict, np.ndarray, np.ndarray) - {variable: array of shape (time, lat, lon)}, and the lat and lon centres of the box.
+        """
+        variables = variables or self.variables
+        lat_slice, lon_slice = self.grid.box(lat_min, lat_max, lon_min, lon_max)
+        data = {var: self.read(var, lat_slice, lon_slice) for var in variables}
+        return data, self.grid.lats[lat_slice], self.grid.lons[lon_slice]
+
+def ceds_units(paths, aggregate=True):
+    """
+    Units of the variables in CEDS files, read from their attributes.
+
+    Parameters:
+        paths: [String] - CEDS NetCDF files.
+        aggregate: bool - Key by compound (the columns of aggregated extractions) instead of sector variable.
+
+    Returns:
+        dict - {compound or sector variable: units}.
+    """
+    units = {}
+    for path in paths:
+        compound, _ = parse_ceds_filename(path)
+        with nc.Dataset(path) as ds:
+            for var in ds.variables:
+                unit = getattr(ds.variables[var], 'units', None)
+                if var in CEDS_COORDS or unit is None:
+                    continue
+                units.setdefault((compound or os.path.basename(path)) if aggregate else var, unit)
+    return units
+
+def parse_ceds_filename(path):
+    """
+    Compound and year encoded in a CEDS file name, eg. 'ALD2-em-anthro_CMIP_CEDS_2018.nc' -> ('ALD2', '2018').
+    Returns (None, None) for other files.
+    """
+    match = CEDS_FILE_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None, None
+    return match.group('compound'), match.group('year')
+
+def ceds_paths(years, compounds=None, path='./data/{year}/'):
+    """
+    Local CEDS files for every year (and compound in compounds, if given).
+
+    Parameters:
+        years: [String] - Years to collect.
+        compounds: [String] - Compounds to keep, defaults to all of them.
+        path: String - Directory pattern, formatted with the year.
+
+    Returns:
+        [String] - File paths, sorted by year then compound.
+    """
+    paths = []
+    for year in years:
+        directory = path.format(year=year)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            compound, _ = parse_ceds_filename(name)
+            if compound and (compounds is None or compound in compounds):
+                paths.append(os.path.join(directory, name))
+    return paths
+
+@timed('extract_ceds')
+def extract_ceds(paths, lats, lons, sites=None, method='nearest', aggregate=True, searched=None):
+    """
+    Extract many sites from many CEDS files (any number of compounds and years) into one long-format
+    frame. Each file is opened once and only the cells around the sites are read.
+
+    Parameters:
+        paths: [String] - CEDS NetCDF files.
+        lats: [float] - Site latitudes.
+        lons: [float] - Site longitudes.
+        sites: [String] - Site labels, defaults to their position.
+        method: String - 'nearest' or 'bilinear', see CedsReader.read_points(...).
+        aggregate: bool - Sum the sector variables of each compound in one reduction.
+        searched: String - Where paths were looked for, named in the error if there are none.
+
+    Returns:
+        pd.DataFrame with columns site, compound, variable, datetime and value. The variable is the
+        compound itself when aggregate is True and the sector variable (eg. 'ALD2_agr') otherwise.
+
+    Raises:
+        FileNotFoundError if paths is empty.
+    """
+    if not paths:
+        where = f" in {searched}" if searched else ''
+        raise FileNotFoundError(f"No CEDS files found{where}, run DataFetcher.save_ceds_ncs first.")
+    sites = list(sites) if sites is not None else list(range(len(np.atleast_1d(lats))))
+    frames = []
+    for path in paths:
+        compound, _ = parse_ceds_filename(path)
+        with CedsReader(path) as reader:
+            data = reader.read_points(lats, lons, method=method)
+            times = reader.times()
+            labels = reader.variables
+        compound = compound or os.path.basename(path)
+        if aggregate:
+            # (sites, sectors, time) -> (sites, 1, time)
+            data = np.nansum(data, axis=1, keepdims=True)
+            labels = [compound]
+
+        n_sites, n_vars, n_time = data.shape
+        frames.append(pd.DataFrame({
+            'site': np.repeat(sites, n_vars * n_time),
+            'compound': compound,
+            'variable': np.tile(np.repeat(labels, n_time), n_sites),
+            'datetime': np.tile(times.values, n_sites * n_vars),
+            'value': data.ravel(),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+def ceds_site_frame(long_df, site):
+    """
+    Wide (datetime x variable) frame for one site of the output of extract_ceds(...).
+    """
+    df = long_df.loc[long_df['site'] == site].pivot(index='datetime', columns='variable', values='value')
+    df.columns.name = None
+    return df
+
+def to_hourly(df):
+    """
+    Upsample a monthly frame to hourly values, holding each month's value until the end of that month.
+    Only build this when hourly resolution is actually needed.
+    """
+    end = df.index[-1] + pd.offsets.MonthBegin(1) - pd.Timedelta('1h')
+    index = pd.date_range(df.index[0], end, freq='1h', name='datetime')
+    return df.reindex(index, method='ffill')
@@ -2,15 +2,21 @@ import requests
 import pandas as pd
 import random
 import datetime
-from dateutil.relativedelta import relativedelta
-import numpy as np
 import netCDF4 as nc
-from bs4 import BeautifulSoup
 import json
 import os
 from dotenv import load_dotenv
 
-from preprocessing import Processor
+from preprocessing import Processor, BATCH_COLUMNS, LOCATION_COLUMNS
+from fetch_engine import FetchEngine, DEFAULT_RATE_LIMIT, BatchResult, TaskResult
+from errors import EmptyResultError
+from response_cache import ResponseCache
+from parameter_index import ParameterIndex
+from availability import AvailabilityScan, MAX_PARAMS_PER_REQUEST
+from ceds import CedsGrid, CedsReader, extract_ceds, ceds_paths, ceds_site_frame, parse_ceds_filename, to_hourly
+from downloader import Downloader
+from metrics import timed
+from aqs_stream import CHUNK_ROWS, record_frames
 
 # Sample env vars:
 # EMAIL="example@example.com"
@@ -34,6 +40,24 @@ LIST_CBSAs = 'list/cbsas'
 LIST_PARAM_CLASSES = 'list/classes'
 LIST_PARAM_IN_CLASS = 'list/parametersByClass'
 
+# Monitor metadata, the only AQS queries listing site coordinates without sample data
+MONITORS_BY_COUNTY = 'monitors/byCounty'
+MONITORS_BY_STATE = 'monitors/byState'
+
+CEDS_URL = 'http://ftp.as.harvard.edu/gcgrid/data/ExtData/HEMCO/CEDS/v2021-06/'
+
+# Fields identifying one reading of a sampleData record, used to drop repeats when stitching shards
+RECORD_KEY = ['state_code', 'county_code', 'site_number', 'parameter_code', 'poc', 'method_code', 'sample_duration', 'date_local', 'time_local']
+
+# How date ranges are split. AQS sampleData queries must not cross a calendar year.
+SHARD_FREQS = {'year': pd.offsets.YearBegin(), 'quarter': pd.offsets.QuarterBegin(startingMonth=1), 'month': pd.offsets.MonthBegin()}
+
+# Endpoints covering many sites return dense data, so they are split into quarters instead of years
+DENSE_ENDPOINTS = [SAMPLE_DATA_BY_COUNTY, SAMPLE_DATA_BY_STATE, SAMPLE_DATA_BY_BOX, SAMPLE_DATA_BY_CBSA]
+
+# Local snapshot of the parameter catalog (ALL and PAMS_VOC classes) so DataFetcher can start offline
+CATALOG_PATH = './data/parameter_catalog.json'
+
 CEDS_AQS_MAP = {
     'ALD2' : {'include' : True, 'matches' : ['Acetaldehyde'], 'notes':'not lumped'},
     'ALK4_butanes' : {'include' : True, 'matches' : ['2,2-Dimethylbutane', '2,3-Dimethylbutane', 'Isobutane', 'n-Butane', '2,2,3-Trimethylbutane'], 'notes' : 'lumped'}, 
@@ -68,23 +92,148 @@ CEDS_AQS_MAP = {
     'XYLE' : {'include' : True, 'matches' : ['m/p Xylene','m-Xylene', 'o-Xylene','p-Xylene','Xylene(s)'], 'notes' : ''}
 }
 
+# Reverse index of CEDS_AQS_MAP: AQS species name -> CEDS (lumped) category
+CEDS_CATEGORY = {match: k for k in CEDS_AQS_MAP for match in CEDS_AQS_MAP[k]['matches']}
+
+def shard_size(data_url):
+    """
+    Default shard for an endpoint: quarters for multi-site sampleData queries, years for single sites,
+    and no splitting for anything else.
+    """
+    if data_url in DENSE_ENDPOINTS:
+        return 'quarter'
+    if data_url.startswith('sampleData/'):
+        return 'year'
+    return None
+
+def date_shards(bdate, edate, shard='year'):
+    """
+    Split [bdate, edate] into consecutive ranges that never cross a shard boundary.
+
+    Parameters:
+        bdate: int or String - First day (YYYYMMDD).
+        edate: int or String - Last day (YYYYMMDD).
+        shard: String - 'year', 'quarter', 'month' or None.
+
+    Returns:
+        [(String, String)] - (bdate, edate) of every shard, in order. A range that fits in one shard is
+        returned unchanged.
+
+    Example:
+
+    date_shards(20181101, 20190315) -> [('20181101', '20181231'), ('20190101', '20190315')]
+    """
+    if shard is None:
+        return [(bdate, edate)]
+    if shard not in SHARD_FREQS:
+        raise ValueError(f"Unknown shard {shard}, expected one of {list(SHARD_FREQS)} or None.")
+    start, end = pd.Timestamp(str(bdate)), pd.Timestamp(str(edate))
+    starts = [start, *[s for s in pd.date_range(start, end, freq=SHARD_FREQS[shard]) if s > start]]
+    if len(starts) == 1:
+        return [(bdate, edate)]
+    ends = [s - pd.Timedelta('1D') for s in starts[1:]] + [end]
+    return [(s.strftime('%Y%m%d'), e.strftime('%Y%m%d')) for s, e in zip(starts, ends)]
+
 class DataFetcher():
     """
     Python API to queury from AQS database.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=4, rate_limit=DEFAULT_RATE_LIMIT, cache=True, base_url=URL, catalog_path=CATALOG_PATH):
+        """
+        Parameters:
+            max_workers: int - Number of AQS requests allowed in flight at once.
+            rate_limit: float - Maximum AQS requests started per second.
+            cache: bool or ResponseCache - Whether to keep AQS responses on disk (True uses the default location).
+            base_url: String - Root of the AQS API (eg. a local stand-in server, see benchmarks/aqs_server.py).
+            catalog_path: String - Local snapshot of the parameter catalog.
+        """
         # params define the access tokens to query AQS database
         self.params = {
             'email': os.getenv("EMAIL"),
             'key': os.getenv("KEY")}
-        self.all_codes = self.get_codes('list/parametersByClass', all=True, nparams={'pc':'ALL'})
-        self.all_codes = pd.DataFrame(self.all_codes).set_index('code')
-        self.processor = Processor()
-        vocs = self.get_codes(LIST_PARAM_IN_CLASS, all=True, nparams={'pc':'PAMS_VOC'})
-        self.vocs = [i['value_represented'] for i in vocs]
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache or None
+        self.catalog_path = catalog_path
+        self.engine = FetchEngine(base_url, max_workers=max_workers, rate_limit=rate_limit, cache=self.cache)
+
+        # all_codes, vocs and processor are loaded lazily on first access
+        self._catalog = None
+        self._all_codes = None
+        self._vocs = None
+        self._processor = None
+        self._index = None
+
+        # Compounds seen in CEDS files -> file name
+        self.ceds_compounds = {}
+
+        # SiteIndex of the sites found by build_site_index(...)
+        self.sites = None
+
+    @property
+    def all_codes(self):
+        """
+        pd.DataFrame of every AQS parameter, indexed by code.
+        """
+        if self._all_codes is None:
+            self._all_codes = pd.DataFrame(self.catalog['ALL']).set_index('code')
+        return self._all_codes
+
+    @property
+    def vocs(self):
+        """
+        Names of all PAMS_VOC parameters.
+        """
+        if self._vocs is None:
+            self._vocs = [i['value_represented'] for i in self.catalog['PAMS_VOC']]
+        return self._vocs
+
+    @property
+    def index(self):
+        """
+        ParameterIndex over all AQS parameters, for O(1) name <-> code lookups.
+        """
+        if self._index is None:
+            self._index = ParameterIndex(self.catalog['ALL'])
+        return self._index
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            self._processor = Processor()
+        return self._processor
+
+    @property
+    def catalog(self):
+        """
+        Parameter catalog, read from the local snapshot at catalog_path or fetched (and saved) if missing.
+        """
+        if self._catalog is None:
+            if os.path.exists(self.catalog_path):
+                with open(self.catalog_path, 'r') as f:
+                    self._catalog = json.load(f)
+            else:
+                self.refresh_catalog()
+        return self._catalog
+
+    def refresh_catalog(self):
+        """
+        Re-download the parameter catalog from AQS, overwrite the local snapshot and reset lazy attributes.
+        """
+        # Bypass the cached code lists, which would otherwise be served for up to 30 days
+        catalog = {pc: self.get_codes(LIST_PARAM_IN_CLASS, all=True, nparams={'pc':pc}, use_cache=False) for pc in ['ALL', 'PAMS_VOC']}
+        if os.path.dirname(self.catalog_path):
+            os.makedirs(os.path.dirname(self.catalog_path), exist_ok=True)
+        with open(self.catalog_path, 'w') as f:
+            json.dump(catalog, f)
+        self._catalog = catalog
+        self._all_codes = None
+        self._vocs = None
+        self._index = None
+        return catalog
         
-    def get_codes(self, filter_url, all: bool, value=None, nparams=None):
+    def get_codes(self, filter_url, all: bool, value=None, nparams=None, use_cache=True):
         """
         Search for codes for a particular filter. Either show all results or search 
         for specific value.
@@ -94,6 +243,7 @@ class DataFetcher():
             all: bool - Whether to return all codes for this endpoint or filter for some value
             value: String - Value to filter by
             nparams: dict - Required parameters for some AQS queries
+            use_cache: bool - Whether a cached response may be used (False forces a fresh query)
         
         Returns:
             HTTP Response Data: json or pd.DataFrame
@@ -107,17 +257,17 @@ class DataFetcher():
         params = self.params.copy()
         if nparams:
             params.update(nparams)
-        r = requests.get(url=URL+filter_url, params=params)
-        data = r.json()['Data']
+        data = self.engine.get(filter_url, params, use_cache=use_cache)['Data']
         if all:
             return data
         else:
             search = [item for item in data if item['value_represented'] == value][0]
             return search['code']
     
-    def get_data(self, data_url, param, bdate, edate, df=False, nparams=None):
+    def get_data(self, data_url, param, bdate, edate, df=False, nparams=None, shard='auto', raise_empty=False):
         """
-        Queries AQS for data from data_url
+        Queries AQS for data from data_url. Ranges longer than one shard (eg. several years) are split
+        into shards, fetched concurrently and stitched back together in order.
 
         Parameters:
             data_url: String - Endpoint of AQS query. Example: 'sampleData/bySite'.
@@ -126,6 +276,8 @@ class DataFetcher():
             edate: int - Last data entry time.
             df: bool - Whether to return output as dataframe.
             nparams: dict - Required parameters for some AQS queries
+            shard: String - 'year', 'quarter', 'month', None (no splitting) or 'auto' (see shard_size(...)).
+            raise_empty: bool - Raise EmptyResultError instead of returning an empty result.
         
         Returns:
             HTTP Response Data: json or pd.DataFrame
@@ -133,56 +285,234 @@ class DataFetcher():
         Example: 
         
         DataFetcher().get_data(SAMPLE_DATA_BY_STATE, 42101, 20180101, 20181231, df=True, nparams={'state':06})
+        DataFetcher().get_data(SAMPLE_DATA_BY_SITE, 44201, 20000101, 20191231, nparams={'state':'06', 'county':'037', 'site':'1103'})
+
+        Raises:
+            AQSError subclass (see errors.py) if the query failed after retrying.
+        """
+        batch = self.get_data_many(data_url, [(param, bdate, edate, nparams)], df=df, shard=shard, batch=True)
+        result = batch.results[0]
+        if result.status == 'failed':
+            raise result.error
+        if result.status == 'empty' and raise_empty:
+            raise EmptyResultError(f"No {param} data between {bdate} and {edate}.", data_url)
+        return result.value
+
+    def get_data_many(self, data_url, tasks, df=False, use_cache=True, shard='auto', batch=False):
+        """
+        Concurrent version of get_data(...). All queries (and all their shards) share the engine's
+        connection pool and rate limit.
+
+        Parameters:
+            data_url: String - Endpoint of AQS query. Example: 'sampleData/bySite'.
+            tasks: [(String, int, int, dict)] - (param, bdate, edate, nparams) for every query.
+            df: bool - Whether to return outputs as dataframes.
+            use_cache: bool - Whether cached responses may be used (False forces fresh queries).
+            shard: String - How long ranges are split, see get_data(...).
+            batch: bool - Return a BatchResult with the status of every task instead of a plain list.
+
+        Returns:
+            List of HTTP Response Data (json or pd.DataFrame), in the same order as tasks. Failed tasks
+            are None. With batch=True, a fetch_engine.BatchResult whose rerun() re-runs only the tasks that failed
+            for a transient reason.
+
+        Example:
+
+        DataFetcher().get_data_many(SAMPLE_DATA_BY_SITE, [(42101, 20180101, 20181231, {'state':'06', 'county':'037', 'site':'1103'})], df=True)
+        """
+        if shard == 'auto':
+            shard = shard_size(data_url)
+        requests_list, owners = [], []
+        for i, (param, bdate, edate, *nparams) in enumerate(tasks):
+            for start, end in date_shards(bdate, edate, shard):
+                requests_list.append((data_url, self.data_params(param, start, end, *nparams)))
+                owners.append(i)
+
+        shards = [[] for _ in tasks]
+        for i, result in zip(owners, self.engine.get_batch(requests_list, use_cache=use_cache).results):
+            shards[i].append(result)
+
+        # A task failed if any of its shards did, and is empty if all of them are
+        results = []
+        for task_shards in shards:
+            failed = [result for result in task_shards if result.status == 'failed']
+            if failed:
+                results.append(TaskResult('failed', error=failed[0].error, attempts=max(r.attempts for r in failed)))
+                continue
+            value = self.stitch_shards([self.parse_data(result.value, False) for result in task_shards], df)
+            results.append(TaskResult('ok' if len(value) else 'empty', value))
+
+        result = BatchResult(tasks, results, runner=lambda retry: self.get_data_many(data_url, retry, df, use_cache, shard, batch=True))
+        if batch:
+            return result
+        for task, task_result in zip(tasks, result.results):
+            if task_result.status == 'failed':
+                print(f"Failed to fetch {task[0]} ({task[1]}-{task[2]}): {task_result.error}")
+        return result.values()
+
+    def stitch_shards(self, results, df=False):
+        """
+        Helper function. Concatenate the records of consecutive shards in order, dropping records that
+        an earlier shard already returned.
+
+        Returns:
+            [dict] or pd.DataFrame.
+        """
+        if len(results) == 1:
+            records = results[0]
+        else:
+            records, seen = [], set()
+            for data in results:
+                keys = [tuple(record.get(k) for k in RECORD_KEY) for record in data]
+                records.extend(record for record, key in zip(data, keys) if key not in seen)
+                seen.update(keys)
+        return pd.DataFrame(records) if df else records
+
+    def stream_data(self, data_url, param, bdate, edate, nparams=None, chunk_rows=CHUNK_ROWS, columns=None):
+        """
+        Streaming version of get_data(...) for large queries (eg. SAMPLE_DATA_BY_STATE over a year). The
+        response is parsed as it arrives and yielded as typed chunks, so the full payload is never held
+        in memory. Streamed queries bypass the response cache.
+
+        Parameters:
+            data_url: String - Endpoint of AQS query. Example: 'sampleData/byState'.
+            param: String - Parameter(s) to query, up to 5 comma separated codes.
+            bdate: int - First data entry time.
+            edate: int - Last data entry time.
+            nparams: dict - Required parameters for some AQS queries.
+            chunk_rows: int - Rows per chunk.
+            columns: [String] - Fields to keep, defaults to all of them.
+
+        Returns:
+            Generator of pd.DataFrame with categorical site, parameter, method and date fields.
+
+        Example:
+
+        for chunk in DataFetcher().stream_data(SAMPLE_DATA_BY_STATE, 44201, 20180101, 20181231, nparams={'state':'06'}):
+            ...
+        """
+        records = self.engine.stream(data_url, self.data_params(param, bdate, edate, nparams))
+        yield from record_frames(records, chunk_rows=chunk_rows, columns=columns)
+
+    @timed('stream_dataset')
+    def stream_dataset(self, data_url, codes, bdate, edate, nparams=None, names=None, store=None, kind=None, year=None, duplicate_policy='mean'):
+        """
+        Hourly frames for every site returned by a large query, built from stream_data(...) chunks with
+        Processor.process_stream(...). Codes are queried 5 at a time. If a store is given each site is
+        also written to it as soon as the query is finished.
+
+        Parameters:
+            data_url: String - Endpoint of AQS query. Example: 'sampleData/byState'.
+            codes: [String] - Parameter codes.
+            bdate: int - First data entry time.
+            edate: int - Last data entry time.
+            nparams: dict - Required parameters for some AQS queries.
+            names: dict - {code: column name}, defaults to the AQS parameter names.
+            store: DatasetStore - Optional store to write every site to.
+            kind: String - Table name in the store.
+            year: String - Year label in the store, defaults to the year of bdate.
+            duplicate_policy: String - How the processor resolves duplicate readings (see preprocessing.DUPLICATE_POLICIES).
+
+        Returns:
+            dict - {'<state>-<county>-<site>': pd.DataFrame}.
+
+        Example:
+
+        DataFetcher().stream_dataset(SAMPLE_DATA_BY_STATE, ['44201', '42602'], 20180101, 20181231, nparams={'state':'06'})
+        """
+        codes = [str(code) for code in codes]
+        names = names or dict(zip(codes, self.find_names(codes)))
+        chunks = (chunk
+                  for i in range(0, len(codes), MAX_PARAMS_PER_REQUEST)
+                  for chunk in self.stream_data(data_url, ','.join(codes[i:i + MAX_PARAMS_PER_REQUEST]), bdate, edate,
+                                                nparams, columns=BATCH_COLUMNS + LOCATION_COLUMNS))
+        frames = self.processor.process_stream(chunks, names, duplicate_policy=duplicate_policy)
+
+        if store is not None:
+            year = year or str(bdate)[:4]
+            coords = self.processor.site_coordinates
+            for site, df in frames.items():
+                extra = {'query': data_url}
+                if coords is not None and site in coords.index:
+                    extra.update(coords.loc[site].to_dict())
+                store.write(df, site, year, kind or 'core', units=self.processor.units, extra=extra)
+        return frames
+
+    def data_params(self, param, bdate, edate, nparams=None):
+        """
+        Helper function. Builds the query parameters for a data request.
         """
         params = self.params.copy()
         params['param'] = param
         params['bdate'] = bdate
         params['edate'] = edate
-        if params:
+        if nparams:
             params.update(nparams)
-        r = requests.get(url=URL+data_url, params=params)
+        return params
 
-        try:
-            data = r.json()['Data']
-            if df:
-                return pd.DataFrame(data)
-            return data
-        except:
-            print(r.json())
+    def parse_data(self, payload, df):
+        """
+        Helper function. Extracts the data from an AQS response (failed responses already raised in the engine).
+        """
+        data = payload.get('Data') or []
+        if df:
+            return pd.DataFrame(data)
+        return data
     
-    def find_code(self, value, verbose=False):
+    def find_code(self, value, verbose=False, fuzzy=False):
         """
         Find code for a particular value (eg. 'Ozone')
 
         Parameters:
             value: String - Value to search for.
+            fuzzy: bool - Whether to fall back to the closest matching name.
         
         Returns:
-            code: int - The code you are searching for.
-        """
-        # Look for code in self.all_codes
-        try:
-            code = self.all_codes.loc[self.all_codes['value_represented'] == value].index[0]
-            if verbose:
-                print(f"{value} code is: {code}")
-            return code
-        except Exception as e:
+            code: String - The code you are searching for.
+        """
+        code = self.index.code(value, fuzzy=fuzzy)
+        if code is None:
             print(f"Could not find {value}.")
-            # print(e)
+        elif verbose:
+            print(f"{value} code is: {code}")
+        return code
+
+    def find_codes(self, values, fuzzy=False):
+        """
+        Batch version of find_code(...).
+
+        Returns:
+            [String] - Codes in the same order as values (None where nothing matched).
+        """
+        codes = self.index.codes(values, fuzzy=fuzzy)
+        for value, code in zip(values, codes):
+            if code is None:
+                print(f"Could not find {value}.")
+        return codes
     
     def find_name(self, code):
         """
         Inverse of find_code(...)
         """
-        # Look for code in self.all_codes
-        try:
-            code = self.all_codes.loc[code].value_represented
-            return code
-        except Exception as e:
+        name = self.index.name(code)
+        if name is None:
             print(f"Could not find {code}.")
-            # print(e)
+        return name
+
+    def find_names(self, codes):
+        """
+        Batch version of find_name(...).
+        """
+        return [self.find_name(code) for code in codes]
+
+    def find_ceds_category(self, value):
+        """
+        CEDS (lumped) emissions category an AQS species belongs to, eg. 'n-Butane' -> 'ALK4_butanes'.
+        """
+        return CEDS_CATEGORY.get(value)
     
-    def create_dataset(self, bdate, edate, site=None, county=None, state=None, processed=True, verbose=False):
+    @timed('create_dataset')
+    def create_dataset(self, bdate, edate, site=None, county=None, state=None, processed=True, verbose=False, duplicate_policy='mean', shard='auto'):
         """
         Generates core dataset (CRITERIA pollutants and MET vars).
 
@@ -193,9 +523,11 @@ class DataFetcher():
             count: String - County code.
             state: String - State code.
             processed: True - Whether to run dataset through processor class.
+            duplicate_policy: String - How the processor resolves duplicate readings (see preprocessing.DUPLICATE_POLICIES).
+            shard: String - How long ranges are split into requests, see get_data(...).
         
         Returns:
-            HTTP Response Data: json or pd.DataFrame
+            pd.DataFrame - Hourly wide frame if processed, raw records otherwise.
 
         Example: 
         
@@ -203,89 +535,196 @@ class DataFetcher():
         """
         code_names = [*CRITERIA_POLLUTANTS, *MET_VARS]
         
-        codes = [self.find_code(v) for v in code_names]
+        codes = self.find_codes(code_names)
         dct = {codes[i]: code_names[i] for i in range(len(codes))}
 
-        dfs = []
-        for code in codes:
-            if verbose:
-                print(f"\n Fetching data for {dct[code]}...", end="\n\n")
-            
-            df = self.get_data(SAMPLE_DATA_BY_SITE, code, bdate, edate, df=True, nparams={'state':state, 'county':county, 'site': site})
+        if verbose:
+            print(f"\n Fetching data for {', '.join(code_names)}...", end="\n\n")
+        nparams = {'state':state, 'county':county, 'site': site}
+        # Transient failures were already retried by the engine, so give up rather than let a column go missing silently
+        batch = self.get_data_many(SAMPLE_DATA_BY_SITE, [(code, bdate, edate, nparams) for code in codes], shard=shard, batch=True)
+        batch.raise_for_failures()
 
-            if df.empty:
+        records = []
+        for code, result in zip(codes, batch.results):
+            if result.status == 'empty':
                 print(f"No data for {dct[code]}")
                 continue
-            
-            if processed:
-                df = self.processor.process(df, dct[code])
+            records.extend(result.value)
 
-            dfs.append(df)
-
-        return self.processor.join(dfs)
+        if not processed:
+            return pd.DataFrame(records)
+        return self.processor.process_batch(records, names=dct, duplicate_policy=duplicate_policy)
     
-    def find_best_location(self, state='06', county='037', bdate=20000101, edate=20210101):
+    @timed('find_best_location')
+    def find_best_location(self, state='06', county='037', bdate=20000101, edate=20210101, checkpoint=None):
         """
         Go through all sites in county and find site with the most data
 
         Parameters:
             bdate: int - First data entry time.
             edate: int - Last data entry time.
-            site: String - Site code.
+            state: String - State code.
             county: String - County code.
+            checkpoint: String - Optional .npz file used to resume an interrupted scan.
         
         Returns:
-            dict - Output of search.
+            dict - Output of search. 'Data' holds the presence of every site, 'Unchecked' marks the windows
+            whose requests failed (so their False entries mean unknown) and 'Errors' the failed requests.
         """
         print(f"Searching county {county} in state {state}...", end=" ")
         sites = self.get_codes(LIST_SITES_BY_COUNTY, all=True, nparams={'state':state, 'county':county})
         sites = [(site['code'], site['value_represented']) for site in sites if site['value_represented']]
         print(f"Found {len(sites)} sites.")
 
-        codes = [self.find_code(v) for v in [*CRITERIA_POLLUTANTS , *MET_VARS, *PAMS]]
+        codes = self.find_codes([*CRITERIA_POLLUTANTS , *MET_VARS, *PAMS])
         sample_days = [self.sample_day_in_year(year, year + 10000) for year in range(bdate, edate, 50000)]
-        # sample_days = [(i, i+1130) for i in range(20000101, 20210101, 50000)]
+        if checkpoint:
+            # Reuse the days drawn by the interrupted scan
+            sample_days = AvailabilityScan.saved_dates(checkpoint) or sample_days
+
+        scan = self.scan_availability([site for site, _ in sites], codes, sample_days, state, county, checkpoint=checkpoint)
+
         res = {}
-        res['Data'] = {}
+        res['Data'] = {name: scan.site_result(site) for site, name in sites}
+        checked = scan.checked()
+        res['Unchecked'] = {name: scan.site_unchecked(site, checked=checked) for site, name in sites}
+        res['Errors'] = {key: f"{type(e).__name__}: {e}" for key, e in scan.failed.items()}
         res['Metadata'] = {'dates':sample_days, 'codes':codes}
-        for site, name in sites:
-            res['Data'][name] = []
-            for code in codes:
-                year_res = [self.find_data_availability(site, county, state, code, bdate, edate) for bdate, edate in sample_days]
-                res['Data'][name].append(year_res)
-            print(f"Finished site {site}, {name}")
-        
         return res
-    
+
+    @timed('build_site_index')
+    def build_site_index(self, state=None, county=None, code='44201', bdate=20180101, edate=20181231):
+        """
+        Build a SiteIndex of every site monitoring code in a county, a state, or (state=None) every state,
+        and keep it in self.sites. list/ results carry no coordinates, so they come from the monitors/
+        endpoint; site names come from list/sitesByCounty when a county is given.
+
+        Parameters:
+            state: String or [String] - State code(s), None for every state.
+            county: String - County code, None for whole states.
+            code: String - Parameter the sites must monitor (Ozone by default).
+            bdate: int - Sites must have been active after this date.
+            edate: int - Sites must have been active before this date.
+
+        Returns:
+            SiteIndex
+
+        Example:
+
+        index = DataFetcher().build_site_index('06')
+        index.neighbours('06-037-1103', k=5)
+        """
+        from spatial import SiteIndex # Imported here since only the site index needs scipy
+        if county is not None:
+            monitors = self.get_data(MONITORS_BY_COUNTY, code, bdate, edate, nparams={'state':state, 'county':county})
+            sites = self.get_codes(LIST_SITES_BY_COUNTY, all=True, nparams={'state':state, 'county':county})
+            names = {f"{state}-{county}-{site['code']}": site['value_represented'] for site in sites}
+            self.sites = SiteIndex.from_records(monitors, names)
+            return self.sites
+
+        if state is None:
+            state = [s['code'] for s in self.get_codes(LIST_STATES, all=True)]
+        states = [state] if isinstance(state, str) else list(state)
+        batch = self.get_data_many(MONITORS_BY_STATE, [(code, bdate, edate, {'state':s}) for s in states], batch=True)
+        batch.raise_for_failures()
+        self.sites = SiteIndex.from_records([record for records in batch.values() if records for record in records])
+        return self.sites
+
+    @timed('scan_availability')
+    def scan_availability(self, sites, codes, dates, state, county, site_dates=None, by_county=True, checkpoint=None):
+        """
+        Bulk availability scan. Every sampled window is pulled once for up to 5 parameters at a time,
+        either for the whole county (by_county=True) or per site, and the site x code x date presence
+        matrix is built locally.
+
+        Parameters:
+            sites: [String] - Site codes.
+            codes: [String] - Parameter codes.
+            dates: [(String, String)] - (bdate, edate) windows to sample.
+            state: String - State code.
+            county: String - County code.
+            site_dates: dict - Optional {site: [date indices]} restricting which windows each site needs.
+            by_county: bool - Query sampleData/byCounty (one request covers every site) or sampleData/bySite.
+            checkpoint: String - Optional .npz file. Progress is saved there and an existing scan is resumed.
+
+        Returns:
+            AvailabilityScan - Scan with a boolean presence array of shape (sites, codes, dates). scan.failed
+            maps the requests that still failed after retrying to their error.
+        """
+        scan = AvailabilityScan.resume(checkpoint, sites, codes, dates)
+        chunks = scan.code_chunks()
+
+        tasks = []
+        if by_county:
+            needed = sorted({d for idxs in site_dates.values() for d in idxs}) if site_dates else range(len(scan.dates))
+            for d in needed:
+                for c, chunk in enumerate(chunks):
+                    tasks.append((scan.task_key(d, c), d, SAMPLE_DATA_BY_COUNTY, chunk, {'state':state, 'county':county}))
+        else:
+            for site in scan.sites:
+                needed = site_dates[site] if site_dates else range(len(scan.dates))
+                for d in needed:
+                    for c, chunk in enumerate(chunks):
+                        tasks.append((scan.task_key(d, c, site), d, SAMPLE_DATA_BY_SITE, chunk, {'state':state, 'county':county, 'site':site}))
+        tasks = [task for task in tasks if task[0] not in scan.done]
+
+        # Fetch in batches so progress can be checkpointed along the way
+        failed = {}
+        batch_size = max(1, 2 * self.engine.max_workers)
+        for i in range(0, len(tasks), batch_size):
+            batch = tasks[i:i + batch_size]
+            requests_list = [(url, self.data_params(','.join(chunk), *scan.dates[d], nparams)) for _, d, url, chunk, nparams in batch]
+            for (key, d, _, _, _), result in zip(batch, self.engine.get_batch(requests_list).results):
+                # Failed windows are not marked done, so they are not mistaken for missing data
+                if result.status == 'failed':
+                    failed[key] = result.error
+                    continue
+                scan.mark(d, result.value.get('Data') or [])
+                scan.done.add(key)
+            scan.save()
+            print(f"Scanned {min(i + batch_size, len(tasks))}/{len(tasks)} requests.")
+
+        if failed:
+            print(f"{len(failed)} requests failed ({', '.join(sorted({type(e).__name__ for e in failed.values()}))}). "
+                  f"Run the scan again with the same checkpoint to retry only those.")
+        scan.failed = failed
+        return scan
+
     def find_data_availability(self, site, county, state, code, bdate, edate):
         """
         Helper function for find_best_location()
+
+        Returns:
+            bool - Whether AQS has data. Failed queries raise a typed error (see errors.py) rather than
+            being reported as missing data.
         """
-        try:
-            df = self.get_data(SAMPLE_DATA_BY_SITE, code, bdate, edate, df = True, nparams={'state':state, 'county':county, 'site': site})
-            return not (df.empty)
-        except:
-            return -1
+        df = self.get_data(SAMPLE_DATA_BY_SITE, code, bdate, edate, df = True, nparams={'state':state, 'county':county, 'site': site})
+        return not (df.empty)
     
-    def find_voc_availability(self, sites, sites_codes, dates, state='06', county='037'):
+    def find_voc_availability(self, sites, sites_codes, dates, state='06', county='037', checkpoint=None):
         """
         Go through all sites in county and find site with the most VOC data
 
-        Please refer to lab_notebook.ipynb for example usage.
+        Please refer to lab_notebook.ipynb for example usage. The output is laid out like that of
+        find_best_location(...).
         """
-        codes = [r['code'] for r in self.get_codes(LIST_PARAM_IN_CLASS, all=True, nparams={'pc':'PAMS_VOC'})]
+        codes = [r['code'] for r in self.catalog['PAMS_VOC']]
         self.voc_codes = codes 
 
+        # Every site only needs its own dates, but windows shared between sites are queried once
+        all_dates = sorted({tuple(d) for site_dates in dates for d in site_dates})
+        date_pos = {d: i for i, d in enumerate(all_dates)}
+        site_dates = {str(site): [date_pos[tuple(d)] for d in site_date] for site, site_date in zip(sites_codes, dates)}
+
+        scan = self.scan_availability(sites_codes, codes, all_dates, state, county, site_dates=site_dates, checkpoint=checkpoint)
+
         res = {}
-        res['Data'] = {}
+        res['Data'] = {name: scan.site_result(site, site_dates[str(site)]) for name, site in zip(sites, sites_codes)}
+        checked = scan.checked()
+        res['Unchecked'] = {name: scan.site_unchecked(site, site_dates[str(site)], checked) for name, site in zip(sites, sites_codes)}
+        res['Errors'] = {key: f"{type(e).__name__}: {e}" for key, e in scan.failed.items()}
         res['Metadata'] = {'dates':dates, 'codes':codes}
-        for name, site, site_dates in zip(sites, sites_codes, dates):
-            res['Data'][name] = []
-            for code in codes:
-                year_res = [self.find_data_availability(site, county, state, code, site_date[0], site_date[1]) for site_date in site_dates]
-                res['Data'][name].append(year_res)
-            print(f"Finished site {site}, {name}")
-        
         return res
     
     def sample_day_in_year(self, bdate, edate):
@@ -296,7 +735,8 @@ class DataFetcher():
         sample_date = random.choice(pd.date_range(start=str(bdate), end=str(edate)))
         return sample_date.date().strftime("%Y%m%d"), (sample_date.date() + datetime.timedelta(1)).strftime("%Y%m%d")
 
-    def get_voc_data(self, bdate, edate, state, county, site, vocs):
+    @timed('get_voc_data')
+    def get_voc_data(self, bdate, edate, state, county, site, vocs, duplicate_policy='mean', shard='auto'):
         """
         Get dataset for VOCs
 
@@ -306,132 +746,272 @@ class DataFetcher():
             site: String - Site code.
             county: String - County code.
             state: String - State code.
+            duplicate_policy: String - How the processor resolves duplicate readings (see preprocessing.DUPLICATE_POLICIES).
+            shard: String - How long ranges are split into requests, see get_data(...).
         
         Returns:
             pandas DataFrame.
         """
-        dfs = []
-        for voc in vocs:
-            code = self.find_code(voc)
-            df = self.get_data(SAMPLE_DATA_BY_SITE, code, bdate, edate, df=True, nparams={'state':state, 'county':county, 'site': site})
+        vocs = list(vocs)
+        codes = self.find_codes(vocs)
+        nparams = {'state':state, 'county':county, 'site': site}
+        batch = self.get_data_many(SAMPLE_DATA_BY_SITE, [(code, bdate, edate, nparams) for code in codes], shard=shard, batch=True)
+        batch.raise_for_failures()
 
-            if df.empty:
+        records = []
+        for voc, result in zip(vocs, batch.results):
+            if result.status == 'empty':
                 print(f"No data for {voc}")
                 continue
+            records.extend(result.value)
 
-            df = self.processor.process(df, voc, change_freq=False, select_method=True, drop_lat_lon=True, remove_duplicates=True)
-            dfs.append(df)
-        
-        return self.processor.join(dfs)
+        return self.processor.process_batch(records, names=dict(zip(codes, vocs)), select_method=True, duplicate_policy=duplicate_policy)
 
     
+    @timed('refresh_dataset')
+    def refresh_dataset(self, store, label, year, kind, state, county, site, names=None, bdate=None, edate=None, duplicate_policy='mean'):
+        """
+        Incrementally bring one stored partition up to date. Only the parts of the requested range
+        that each parameter does not cover yet are queried, plus (via AQS cbdate/cedate) records
+        changed since the last refresh. The deltas are merged into the stored partition.
+
+        Parameters:
+            store: DatasetStore - Store holding the partition.
+            label: String - Site label used in the store.
+            year: String - Year of the partition.
+            kind: String - 'core' or 'vocs'.
+            state: String - State code.
+            county: String - County code.
+            site: String - Site code.
+            names: [String] - Parameters of the table. Defaults to CRITERIA_POLLUTANTS and MET_VARS for 'core'.
+            bdate: String - First day wanted (YYYYMMDD), defaults to the start of year.
+            edate: String - Last day wanted (YYYYMMDD), defaults to the end of year (or today).
+            duplicate_policy: String - How the processor resolves duplicate readings.
+
+        Returns:
+            dict - Number of requests made, records fetched and rows updated.
+
+        Example:
+
+        DataFetcher().refresh_dataset(DatasetStore(), 'Los_Angeles-North_Main_Street', '2018', 'core', '06', '037', '1103')
+        """
+        year = str(year)
+        today = datetime.date.today()
+        if names is None:
+            if kind != 'core':
+                raise ValueError(f"names must be given for {kind} tables.")
+            names = [*CRITERIA_POLLUTANTS, *MET_VARS]
+        bdate = bdate or f'{year}0101'
+        edate = edate or min(f'{year}1231', today.strftime('%Y%m%d'))
+
+        codes = self.find_codes(names)
+        dct = {code: name for code, name in zip(codes, names) if code is not None}
+        nparams = {'state':state, 'county':county, 'site': site}
+
+        # Gaps at the start or end of each parameter's coverage, and the outages recorded inside it
+        tasks = []
+        gaps = store.missing_ranges(label, year, kind, list(dct.values()), pd.Timestamp(bdate), pd.Timestamp(edate) + pd.Timedelta('23h'))
+        for code, name in dct.items():
+            for start, end in gaps.get(name, []):
+                tasks.append((code, start.strftime('%Y%m%d'), end.strftime('%Y%m%d'), nparams))
+
+        # Records AQS revised since the last refresh, up to 5 parameters per request
+        meta = store.metadata(label, year, kind)
+        if meta:
+            last_refresh = meta.get('refreshed') or meta['updated']
+            changed = {**nparams, 'cbdate': pd.Timestamp(last_refresh).strftime('%Y%m%d'), 'cedate': today.strftime('%Y%m%d')}
+            covered = [code for code, name in dct.items() if (meta['coverage'].get(name) or {}).get('first')]
+            for i in range(0, len(covered), 5):
+                tasks.append((','.join(covered[i:i + 5]), bdate, edate, changed))
+
+        # Cached responses for this site and range hold the values being replaced
+        if self.cache is not None:
+            self.cache.invalidate(SAMPLE_DATA_BY_SITE, where=lambda p: (p.get('state'), p.get('county'), p.get('site')) == (state, county, site)
+                                  and p.get('bdate', '') <= str(edate) and p.get('edate', '') >= str(bdate))
+        batch = self.get_data_many(SAMPLE_DATA_BY_SITE, tasks, use_cache=False, batch=True)
+        # A partial refresh would be recorded as complete, so fail instead
+        batch.raise_for_failures()
+        records = [record for data in batch.values() for record in data]
+
+        delta = self.processor.process_batch(records, names=dct, select_method=(kind == 'vocs'), duplicate_policy=duplicate_policy)
+        if meta is not None:
+            stored = store.read(label, year, kind)
+            columns = [name for name in dict.fromkeys([*stored.columns, *dct.values()]) if name in stored.columns or name in delta.columns]
+            merged = stored.reindex(index=stored.index.union(delta.index), columns=columns)
+            # Refetched hours replace the stored readings, so revised values win
+            merged.update(delta)
+        else:
+            merged = delta
+        if not merged.empty:
+            # Keep the extras of the partition being replaced (eg. the coordinates SiteIndex.from_store reads)
+            units = {**((meta or {}).get('units') or {}), **self.processor.units}
+            store.write(merged, label, year, kind, units=units, extra={**store.extras(label, year, kind), 'refreshed': today.isoformat()})
+
+        return {'requests': len(tasks), 'records': len(records), 'rows_updated': int(len(delta))}
+
     ### CEDS DATA ###
 
     # Get all URLS
-    def get_ceds_links(self, year='2018'):
+    def get_ceds_links(self, year='2018', base_url=CEDS_URL):
         """
         Web-scraping tool to get the links to all CEDS datasets.
 
         Parameters:
             year: String - Year to get data for.
+            base_url: String - Root of the CEDS directory listing (eg. a local mirror).
         
         Returns:
             Tuple([String], String) - Links to query from CEDS database and year url endpoint.
         """
-        url = 'http://ftp.as.harvard.edu/gcgrid/data/ExtData/HEMCO/CEDS/v2021-06/' + year + '/'
+        from bs4 import BeautifulSoup # Imported here since only the CEDS methods need it
+
+        url = base_url + str(year) + '/'
         self.ceds_url = url
+        self.ceds_year = str(year)
         r = requests.get(url)
         soup = BeautifulSoup(r.text, "html.parser")
         links = []
         for link in soup.findAll('a'):
             links.append(link.get('href'))
-        nc_links = links[5:]
+        nc_links = [link for link in links if link and link.endswith('.nc')]
         self.nc_links = nc_links
-        self.ceds_compounds = {}
         return nc_links, url
     
-    def save_ceds_ncs(self):
+    @timed('save_ceds_ncs')
+    def save_ceds_ncs(self, path=None, max_workers=4, checksums=None):
         """
-        Query the CEDS database for the emissions data and write it locally.
+        Query the CEDS database for the emissions data and write it locally. Files are streamed to disk
+        in parallel, partial downloads are resumed and complete files are skipped.
         NOTE: This must run before any datasets are created for CEDS.
+
+        Parameters:
+            path: String - Output directory, defaults to ./data/<year>/ for the year passed to get_ceds_links.
+            max_workers: int - Number of files to download at once.
+            checksums: dict - Optional {url: '<algorithm>:<hex>'} to verify files against.
+
+        Returns:
+            dict - {file path: 'skipped' | 'downloaded' | 'failed'}. Failed files are reported and can be
+            fetched by calling this again.
         """
-        if self.nc_links:
-            for endpoint in self.nc_links:
-                r = requests.get(self.ceds_url + endpoint)
-                open('./data/2018/' + endpoint, 'wb').write(r.content)
+        if not self.nc_links:
+            return {}
+        path = path or f'./data/{self.ceds_year}/'
+        items = [(self.ceds_url + endpoint, os.path.join(path, endpoint)) for endpoint in self.nc_links]
+        downloader = Downloader(max_workers=max_workers)
+        statuses = downloader.download_many(items, checksums=checksums)
+        for file_path, error in downloader.errors.items():
+            print(f"Failed to download {file_path}: {error}")
+        return statuses
 
-    def get_compound_df(self, path, site_lat, site_lon, endpoint):
+    @timed('get_compound_df')
+    def get_compound_df(self, path, site_lat, site_lon, endpoint, method='nearest'):
         """
-        Helper function for make_ceds_df. Converts one CEDS netcdf file to a pandas df.
+        Helper function for make_ceds_df. Converts one CEDS netcdf file to a pandas df, reading only
+        the grid cell(s) around the site.
         """
-        ds = nc.Dataset(path, format="NETCDF4")
-        lat_idx = np.where(ds.variables['lat'][:] == site_lat)
-        lon_idx = np.where(ds.variables['lon'][:] == site_lon)
+        self.ceds_compounds[parse_ceds_filename(endpoint)[0]] = endpoint
 
-        self.ceds_compounds[endpoint.replace('-em-anthro_CMIP_CEDS_2018.nc', '')] = endpoint
-        
-        data = []
-        for var in ds.variables:
-            if var not in ['time', 'lat', 'lon']:
-                data.append(ds.variables[var][:][:, lat_idx, lon_idx].flatten())
-        
-        data = np.asarray(data).T
-        df = pd.DataFrame(data, columns = [x for x in ds.variables if x not in ['time', 'lat', 'lon']])
-        df.index = ds.variables['time'][:]
+        with CedsReader(path) as reader:
+            data = reader.read_points([site_lat], [site_lon], method=method)[0]
+            df = pd.DataFrame(data.T, columns=reader.variables)
+            df.index = reader.times()
         return df
 
-    def make_ceds_df(self, lat, lon, nc_links):
+    @timed('make_ceds_df')
+    def make_ceds_df(self, lat, lon, nc_links, path=None, hourly=True):
         """
         Make dataframe with CEDS emissions.
 
         Parameters:
             lat: int - Latitude of relevant site.
             lon: int - Longitude of relevant site.
-            nc_links: [String] - Endpoints of emissions data to query.
+            nc_links: [String] - Endpoints of emissions data to query (may span several years).
+            path: String - Directory pattern of the local files, defaults to ./data/{year}/.
+            hourly: bool - Upsample the monthly values to an hourly index.
         
         Returns:
-            pandas DataFrame with CEDS emissions.
+            pandas DataFrame with CEDS emissions, one column per sector variable.
         """
-        dfs = []
+        path = path or './data/{year}/'
+        paths = []
         for endpoint in nc_links:
-            df = self.get_compound_df('./data/2018/' + endpoint, lat, lon, endpoint)
-            dfs.append(df)
-
-        full_df = dfs[0].join(dfs[1:], how='outer')
-
-        # NOTE: Not sure how to convert to timestamp so I will just convert to the first of the month for the given year
-        start = datetime.datetime(2018, 1, 1, 0, 0)
-        dates = [start + relativedelta(months=i) for i in range(0, 12)]
-        full_df['datetime'] = dates
-        full_df.index = full_df['datetime']
-        full_df = full_df.drop(['datetime'], axis=1)
-        full_df.loc[datetime.datetime(2018, 12, 31, 23, 0)] = full_df.loc[datetime.datetime(2018, 12, 1)] # Repeat last row
-        full_df = full_df.asfreq(freq='1h', method='ffill')
+            compound, year = parse_ceds_filename(endpoint)
+            self.ceds_compounds[compound] = endpoint
+            paths.append(os.path.join(path.format(year=year), endpoint))
 
-        return full_df
+        long_df = extract_ceds(paths, [lat], [lon], sites=['site'], aggregate=False, searched=path)
+        df = ceds_site_frame(long_df, 'site')
+        return to_hourly(df) if hourly else df
     
     def aggregate_ceds_data(self, df):
         """
         Aggregates data for different sectors for each compound so we only have one column per compound.
+        Sector columns are named <compound>_<sector>, and all compounds are summed in one grouped reduction.
         """
-        ndf = df.copy()
-        for compound in self.ceds_compounds:
-            cols = [col for col in df.columns if (compound + '_' in col) and (col.startswith(compound))]
-            if len(cols) != 8:
-                raise("Not properly aggregating columns.")
-            compound_aggregated = df[cols].sum(axis=1)
-            ndf = ndf.drop(cols, axis=1)
-            ndf[compound] = compound_aggregated
-        return ndf
+        compounds = [col.rsplit('_', 1)[0] for col in df.columns]
+        return df.T.groupby(compounds, sort=False).sum().T
     
-    def get_ceds_data(self, year, lat=34.25, lon=-118.25, keep=[]):
+    def get_ceds_data(self, year, site, keep=None, path='./data/{year}/', hourly=True):
+        """
+        Get aggregated CEDS data for all compounds in keep (all of them when keep is empty)
+
+        Parameters:
+            year: String or [String] - Year(s) to get data for.
+            site: String or (float, float) - Site label in self.sites (see build_site_index) or (lat, lon).
+            keep: [String] - Compounds to keep, defaults to all of them.
+            path: String - Directory pattern of the local files (see save_ceds_ncs).
+            hourly: bool - Upsample the monthly values to an hourly index.
         """
-        Get aggregated CEDS data for all compounds in keep 
+        years = [year] if isinstance(year, (str, int)) else year
+        lat, lon = self.ceds_location(site, years, path)
+        long_df = self.get_ceds_sites(years, {'site': (lat, lon)}, keep=keep or None, path=path)
+        df = ceds_site_frame(long_df, 'site')
+        if keep:
+            df = df[[k for k in keep if k in df.columns]]
+        return to_hourly(df) if hourly else df
+
+    def ceds_location(self, site, years, path='./data/{year}/'):
+        """
+        Helper function. Coordinates to read CEDS data at: the centre of a site's grid cell (mapped once per
+        grid by SiteIndex.ceds_cells), or a (lat, lon) pair as given.
+        """
+        if isinstance(site, tuple):
+            return site
+        if self.sites is None:
+            raise ValueError(f"No site index to locate {site}, call build_site_index(...) first or pass (lat, lon).")
+        paths = ceds_paths([str(y) for y in years], path=path)
+        if not paths:
+            return self.sites.coordinates(site)
+        with nc.Dataset(paths[0]) as ds:
+            grid = CedsGrid.from_dataset(ds)
+        cell = self.sites.ceds_cells(grid).loc[site]
+        return float(cell['lat']), float(cell['lon'])
+
+    @timed('get_ceds_sites')
+    def get_ceds_sites(self, years, sites, keep=None, path='./data/{year}/', method='nearest'):
+        """
+        Extract monthly, sector-aggregated CEDS emissions for many sites and years in one pass over the files.
+
+        Parameters:
+            years: [String] - Years to get data for.
+            sites: dict - {site name: (lat, lon)}.
+            keep: [String] - Compounds to keep, defaults to all of them.
+            path: String - Directory pattern of the local files (see save_ceds_ncs).
+            method: String - 'nearest' grid cell or 'bilinear' interpolation.
+
+        Returns:
+            pd.DataFrame in long format with columns site, compound, variable, datetime and value.
+
+        Example:
+
+        DataFetcher().get_ceds_sites(['2017', '2018'], {'LA North Main St': (34.07, -118.23)}, keep=['ALD2', 'BENZ'])
         """
-        nc_links, _ = self.get_ceds_links(year=year)
-        nc_links = [link for link in nc_links if link.replace('-em-anthro_CMIP_CEDS_2018.nc', '') in keep]
-        ceds_df = self.make_ceds_df(lat, lon, nc_links)
-        return self.aggregate_ceds_data(ceds_df)
+        paths = ceds_paths([str(y) for y in years], compounds=keep or None, path=path)
+        for p in paths:
+            self.ceds_compounds[parse_ceds_filename(p)[0]] = os.path.basename(p)
+        lats, lons = zip(*sites.values())
+        searched = ', '.join(path.format(year=y) for y in years) + (f" (compounds {', '.join(keep)})" if keep else '')
+        return extract_ceds(paths, lats, lons, sites=list(sites), method=method, searched=searched)
     
     ### MISC ###
     
@@ -441,15 +1021,12 @@ class DataFetcher():
         """
         with open('voc_data.json', 'r') as f:
             voc_r = json.load(f)
-        vocs = sorted([self.find_name(code) for code in voc_r['Metadata']['codes']])
-        # Get all vocs in AQS that have emissions recorded by CEDS and
-        matched_vocs = set()
-        for k in CEDS_AQS_MAP:
-            for match in CEDS_AQS_MAP[k]['matches']:
-                matched_vocs.add(match)
-        final_vocs = [x for x in vocs if x in matched_vocs]
+        vocs = sorted(self.find_names(voc_r['Metadata']['codes']))
+        # Get all vocs in AQS that have emissions recorded by CEDS
+        final_vocs = [x for x in vocs if x in CEDS_CATEGORY]
         # Get all emissions recorded by CEDS that are used by a VOC in AQS data
-        final_emissions = [k for k in CEDS_AQS_MAP if len(set(CEDS_AQS_MAP[k]['matches']) & set(final_vocs)) != 0]
+        used = {CEDS_CATEGORY[x] for x in final_vocs}
+        final_emissions = [k for k in CEDS_AQS_MAP if k in used]
 
         return final_vocs, final_emissions
 
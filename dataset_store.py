@@ -0,0 +1,279 @@
+import datetime
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from metrics import METRICS, timed
+from preprocessing import Processor
+
+# Tables written by generate.py
+KINDS = ['core', 'vocs', 'emissions']
+
+EXTENSIONS = {'feather': '.feather', 'parquet': '.parquet'}
+
+# Metadata fields written by DatasetStore itself; everything else in a sidecar came from write(..., extra=...)
+META_FIELDS = ['site', 'year', 'kind', 'format', 'path', 'updated', 'columns', 'units', 'rows', 'start', 'end', 'coverage']
+
+# Missing runs at least this many hours long inside a column's coverage are recorded as gaps
+GAP_HOURS = 24
+
+class DatasetStore():
+    """
+    Typed columnar store for generated datasets, partitioned as <root>/<site>/<year>/<kind>.<ext>.
+    Every partition has a <kind>.meta.json sidecar (columns, dtypes, units and coverage), and
+    manifest.json at the root collects all of them.
+    """
+
+    def __init__(self, root='./data/store/', format='feather'):
+        """
+        Parameters:
+            root: String - Root directory of the store.
+            format: String - 'feather' (uncompressed Arrow IPC, memory-mapped on read) or 'parquet'.
+        """
+        if format not in EXTENSIONS:
+            raise ValueError(f"Unknown format {format}, expected one of {list(EXTENSIONS)}.")
+        self.root = root
+        self.format = format
+
+    def partition_dir(self, site, year):
+        return os.path.join(self.root, str(site), str(year))
+
+    def partition_path(self, site, year, kind, format=None):
+        return os.path.join(self.partition_dir(site, year), kind + EXTENSIONS[format or self.format])
+
+    def meta_path(self, site, year, kind):
+        return os.path.join(self.partition_dir(site, year), kind + '.meta.json')
+
+    def describe(self, df, units=None):
+        """
+        Helper function. Columns, dtypes, units and per-column coverage of a datetime indexed frame: the
+        number of values, the first and last valid timestamp, and the gaps of GAP_HOURS or more between them.
+        """
+        counts = df.notna().sum()
+        gaps = {col: [] for col in df.columns}
+        if len(df) > 1 and df.index.is_unique:
+            # Hours without a row are missing too
+            hours = pd.date_range(df.index[0], df.index[-1], freq='1h')
+            missing = ~df.notna().reindex(hours, fill_value=False).to_numpy()
+            cols, starts, lengths = Processor().gap_runs(missing)
+            inside = (lengths >= GAP_HOURS) & (starts > 0) & (starts + lengths < len(hours))
+            for c, start, length in zip(cols[inside], starts[inside], lengths[inside]):
+                gaps[df.columns[c]].append([str(hours[start]), str(hours[start + length - 1])])
+        coverage = {}
+        for col in df.columns:
+            valid = df.index[df[col].notna().to_numpy()]
+            coverage[col] = {
+                'count': int(counts[col]),
+                'first': str(valid[0]) if len(valid) else None,
+                'last': str(valid[-1]) if len(valid) else None,
+                'gaps': gaps[col],
+            }
+        return {
+            'columns': {col: str(dtype) for col, dtype in df.dtypes.items()},
+            'units': {col: (units or {}).get(col) for col in df.columns},
+            'rows': int(len(df)),
+            'start': str(df.index[0]) if len(df) else None,
+            'end': str(df.index[-1]) if len(df) else None,
+            'coverage': coverage,
+        }
+
+    @timed('store_write')
+    def write(self, df, site, year, kind, units=None, extra=None):
+        """
+        Write one partition, replacing any existing one.
+
+        Parameters:
+            df: pd.DataFrame - Datetime indexed frame.
+            site: String - Site label (used as a directory name).
+            year: String - Year label.
+            kind: String - Table name, eg. 'core', 'vocs' or 'emissions'.
+            units: dict - Optional {column: unit} recorded in the manifest.
+            extra: dict - Optional additional metadata stored with the partition.
+
+        Returns:
+            dict - Metadata of the partition.
+        """
+        os.makedirs(self.partition_dir(site, year), exist_ok=True)
+        METRICS.add_rows('store_write', len(df))
+        df = df.sort_index()
+        table = pa.Table.from_pandas(df.rename_axis('datetime').reset_index(), preserve_index=False)
+
+        path = self.partition_path(site, year, kind)
+        tmp = path + '.tmp'
+        if self.format == 'feather':
+            # Uncompressed so reads can memory-map the file without copying
+            feather.write_feather(table, tmp, compression='uncompressed')
+        else:
+            # One row group per ~month of hourly data so time filters skip whole groups
+            pq.write_table(table, tmp, row_group_size=24 * 31)
+        os.replace(tmp, path)
+
+        meta = {'site': str(site), 'year': str(year), 'kind': kind, 'format': self.format,
+                'path': os.path.relpath(path, self.root),
+                'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+                **self.describe(df, units), **(extra or {})}
+        with open(self.meta_path(site, year, kind), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return meta
+
+    def metadata(self, site, year, kind):
+        """
+        Metadata of one partition, or None if it does not exist.
+        """
+        path = self.meta_path(site, year, kind)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def extras(self, site, year, kind):
+        """
+        Extra metadata a partition was written with (eg. site coordinates), to carry over when rewriting it.
+        """
+        meta = self.metadata(site, year, kind) or {}
+        return {k: v for k, v in meta.items() if k not in META_FIELDS}
+
+    def exists(self, site, year, kind):
+        meta = self.metadata(site, year, kind)
+        return meta is not None and os.path.exists(os.path.join(self.root, meta['path']))
+
+    def partitions(self, site=None, year=None, kind=None):
+        """
+        Metadata of every partition matching the given site, year and kind (None matches all).
+        """
+        pattern = os.path.join(self.root, str(site or '*'), str(year or '*'), (kind or '*') + '.meta.json')
+        metas = []
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r') as f:
+                metas.append(json.load(f))
+        return metas
+
+    def missing_ranges(self, site, year, kind, columns, start, end):
+        """
+        Parts of [start, end] not covered by each column of a partition, based on the first and last
+        valid timestamp and the gaps recorded in its metadata.
+
+        Parameters:
+            site: String - Site label.
+            year: String - Year label.
+            kind: String - Table name.
+            columns: [String] - Columns to check.
+            start: String or Timestamp - Start of the wanted range.
+            end: String or Timestamp - End of the wanted range.
+
+        Returns:
+            dict - {column: [(Timestamp, Timestamp)]}, only for columns with gaps.
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        meta = self.metadata(site, year, kind)
+        coverage = meta['coverage'] if meta else {}
+        gaps = {}
+        for col in columns:
+            cov = coverage.get(col)
+            if not cov or cov['first'] is None:
+                gaps[col] = [(start, end)]
+                continue
+            first, last = pd.Timestamp(cov['first']), pd.Timestamp(cov['last'])
+            ranges = []
+            if first > start:
+                ranges.append((start, first))
+            for gap_start, gap_end in cov.get('gaps', []):
+                gap_start, gap_end = max(pd.Timestamp(gap_start), start), min(pd.Timestamp(gap_end), end)
+                if gap_start <= gap_end:
+                    ranges.append((gap_start, gap_end))
+            if last < end:
+                ranges.append((last, end))
+            if ranges:
+                gaps[col] = ranges
+        return gaps
+
+    def write_manifest(self):
+        """
+        Collect every partition's metadata into <root>/manifest.json.
+        """
+        manifest = {'partitions': self.partitions()}
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(self.root, 'manifest.json'))
+        return manifest
+
+    def read_table(self, path, format, columns=None, start=None, end=None):
+        """
+        Helper function. Arrow table of a partition, memory-mapped where the format allows it. Parquet
+        row groups entirely outside [start, end] are skipped using their datetime statistics.
+        """
+        if columns is not None:
+            columns = ['datetime'] + [c for c in columns if c != 'datetime']
+        if format == 'feather':
+            return feather.read_table(path, columns=columns, memory_map=True)
+        filters = []
+        if start is not None:
+            filters.append(('datetime', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('datetime', '<=', pd.Timestamp(end)))
+        return pq.read_table(path, columns=columns, memory_map=True, filters=filters or None)
+
+    @timed('store_read')
+    def read(self, site, year, kind, columns=None, start=None, end=None):
+        """
+        Read one partition, loading only the requested columns and time range.
+
+        Parameters:
+            site: String - Site label.
+            year: String - Year label.
+            kind: String - Table name.
+            columns: [String] - Columns to load, defaults to all of them.
+            start: String or Timestamp - First timestamp to keep (inclusive).
+            end: String or Timestamp - Last timestamp to keep (inclusive).
+
+        Returns:
+            pd.DataFrame indexed by datetime.
+        """
+        meta = self.metadata(site, year, kind)
+        if meta is None:
+            raise FileNotFoundError(f"No {kind} partition for site {site}, year {year} in {self.root}.")
+        table = self.read_table(os.path.join(self.root, meta['path']), meta['format'], columns, start, end)
+
+        if start is not None or end is not None:
+            # Partitions are sorted by datetime, so the range is a contiguous slice (already applied for parquet)
+            times = table.column('datetime').to_numpy()
+            i0 = np.searchsorted(times, np.datetime64(pd.Timestamp(start)), side='left') if start is not None else 0
+            i1 = np.searchsorted(times, np.datetime64(pd.Timestamp(end)), side='right') if end is not None else len(times)
+            table = table.slice(i0, max(0, i1 - i0))
+
+        METRICS.add_rows('store_read', table.num_rows)
+        return table.to_pandas().set_index('datetime')
+
+    def load(self, kind, sites=None, years=None, columns=None, start=None, end=None):
+        """
+        Read and concatenate many partitions of one kind.
+
+        Parameters:
+            kind: String - Table name.
+            sites: [String] - Sites to load, defaults to all of them.
+            years: [String] - Years to load, defaults to all of them.
+            columns: [String] - Columns to load, defaults to all of them.
+            start: String or Timestamp - First timestamp to keep.
+            end: String or Timestamp - Last timestamp to keep.
+
+        Returns:
+            pd.DataFrame indexed by (site, datetime).
+        """
+        sites = {str(s) for s in sites} if sites is not None else None
+        years = {str(y) for y in years} if years is not None else None
+        frames = {}
+        for meta in self.partitions(kind=kind):
+            if (sites is None or meta['site'] in sites) and (years is None or meta['year'] in years):
+                df = self.read(meta['site'], meta['year'], kind, columns=columns, start=start, end=end)
+                frames.setdefault(meta['site'], []).append(df)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat({site: pd.concat(dfs).sort_index() for site, dfs in frames.items()}, names=['site', 'datetime'])
@@ -0,0 +1,163 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS, timed
+
+CHUNK_SIZE = 1024 * 1024
+
+# Network failures worth retrying, for the HEAD request and the (resumed) transfer alike
+RETRYABLE = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+class Downloader():
+    """
+    Parallel, resumable file downloader. Files are streamed to disk in chunks, partial files
+    (<name>.part) are resumed with HTTP range requests, and files that are already complete are skipped.
+    """
+
+    def __init__(self, max_workers=4, chunk_size=CHUNK_SIZE, retries=3, timeout=120):
+        """
+        Parameters:
+            max_workers: int - Number of transfers to run in parallel.
+            chunk_size: int - Bytes written to disk at a time.
+            retries: int - Number of times an interrupted transfer is resumed before giving up.
+            timeout: float - Seconds to wait for the server between chunks.
+        """
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Errors of the files download_many(...) could not fetch, keyed by path
+        self.errors = {}
+
+    def remote_size(self, url):
+        """
+        Size of the remote file in bytes, or None if the server does not say.
+        """
+        r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        if r.ok and r.headers.get('Content-Length', '').isdigit():
+            return int(r.headers['Content-Length'])
+        return None
+
+    def file_checksum(self, path, algorithm='sha256'):
+        """
+        Helper function. Hex digest of a local file, computed in chunks.
+        """
+        h = hashlib.new(algorithm)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def verify(self, path, size=None, checksum=None):
+        """
+        Check a local file against an expected size and/or checksum.
+
+        Parameters:
+            path: String - Local file.
+            size: int - Expected size in bytes.
+            checksum: String - Expected digest as '<algorithm>:<hex>', eg. 'sha256:ab12...'.
+        """
+        if not os.path.exists(path):
+            return False
+        if size is not None and os.path.getsize(path) != size:
+            return False
+        if checksum is not None:
+            algorithm, digest = checksum.split(':', 1)
+            return self.file_checksum(path, algorithm) == digest.lower()
+        return True
+
+    @timed('ceds_download')
+    def download(self, url, path, checksum=None):
+        """
+        Download url to path, resuming a partial download if one exists.
+
+        Parameters:
+            url: String - File to download.
+            path: String - Destination on disk.
+            checksum: String - Optional expected digest as '<algorithm>:<hex>'.
+
+        Returns:
+            String - 'skipped' if path was already complete, 'downloaded' otherwise.
+        """
+        size = self.retrying(self.remote_size, url)
+        if self.verify(path, size, checksum) and (size is not None or checksum is not None):
+            return 'skipped'
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + '.part'
+
+        self.retrying(self.transfer, url, part, size)
+
+        if not self.verify(part, size, checksum):
+            os.remove(part)
+            raise IOError(f"Downloaded file {path} failed its integrity check.")
+        os.replace(part, path)
+        return 'downloaded'
+
+    def retrying(self, fn, *args):
+        """
+        Helper function. Call fn(*args), retrying up to self.retries times after a RETRYABLE error.
+        Retried transfers resume from the bytes already written.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except RETRYABLE:
+                if attempt == self.retries:
+                    raise
+
+    def transfer(self, url, part, size=None):
+        """
+        Helper function. Stream url into part, continuing from the bytes already in it.
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if size is not None and offset == size:
+            return
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 416:
+                # Nothing left to fetch
+                return
+            r.raise_for_status()
+            # 206 means the server honoured the range, 200 means it sent the whole file again
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            with open(part, mode) as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    METRICS.record_bytes('ceds_files', len(chunk))
+
+    def download_many(self, items, checksums=None):
+        """
+        Download many files in parallel. A file that cannot be fetched does not stop the others: its
+        status is 'failed' and its error is kept in self.errors.
+
+        Parameters:
+            items: [(String, String)] - (url, path) pairs.
+            checksums: dict - Optional {url: '<algorithm>:<hex>'}.
+
+        Returns:
+            dict - {path: 'skipped' | 'downloaded' | 'failed'}.
+        """
+        checksums = checksums or {}
+        self.errors = {}
+
+        def run(item):
+            url, path = item
+            try:
+                return self.download(url, path, checksum=checksums.get(url))
+            except Exception as e:
+                self.errors[path] = e
+                return 'failed'
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip([path for _, path in items], executor.map(run, items)))
@@ -0,0 +1,100 @@
+class AQSError(Exception):
+    """
+    Base class of every error raised by the AQS fetch layer.
+    """
+    # Whether trying the same request again later may succeed
+    transient = False
+
+    def __init__(self, message, endpoint=None, status=None):
+        """
+        Parameters:
+            message: String - What went wrong.
+            endpoint: String - Endpoint of the failed query.
+            status: int - HTTP status of the response, if there was one.
+        """
+        super().__init__(message)
+        self.endpoint = endpoint
+        self.status = status
+
+class AuthError(AQSError):
+    """
+    Missing or invalid AQS credentials (EMAIL and KEY).
+    """
+
+class RequestError(AQSError):
+    """
+    AQS rejected the query itself, eg. an unknown parameter or a range crossing a year.
+    """
+
+class RateLimitError(AQSError):
+    """
+    AQS asked us to slow down (HTTP 429).
+    """
+    transient = True
+
+class ServerError(AQSError):
+    """
+    AQS could not be reached or failed to answer (HTTP 5xx, dropped connection).
+    """
+    transient = True
+
+class AQSTimeoutError(AQSError):
+    """
+    AQS did not answer within the engine's timeout.
+    """
+    transient = True
+
+class EmptyResultError(AQSError):
+    """
+    The query succeeded but matched no data.
+    """
+
+class BatchError(AQSError):
+    """
+    Some tasks of a batch still failed after retrying. The full BatchResult is kept in self.batch.
+    """
+
+    def __init__(self, message, batch):
+        super().__init__(message)
+        self.batch = batch
+
+# Phrases of AQS header errors caused by bad credentials
+AUTH_PHRASES = ['email', 'key', 'credential', 'authoriz', 'not registered']
+
+def is_transient(error):
+    """
+    Whether a failed request (or a batch whose failures are all transient) is worth retrying.
+    """
+    if isinstance(error, BatchError):
+        return all(is_transient(error.batch.results[i].error) for i in error.batch.failed())
+    return isinstance(error, AQSError) and error.transient
+
+def http_error(status, endpoint, text=''):
+    """
+    Typed error for an HTTP error status.
+    """
+    message = f"AQS returned HTTP {status} for {endpoint}. {text[:200]}".strip()
+    if status in (401, 403):
+        return AuthError(message, endpoint, status)
+    if status == 429:
+        return RateLimitError(message, endpoint, status)
+    if status >= 500:
+        return ServerError(message, endpoint, status)
+    return RequestError(message, endpoint, status)
+
+def header_error(header, endpoint):
+    """
+    Typed error for an AQS response whose header reports a failure, or None if it does not.
+
+    Parameters:
+        header: dict - First entry of the 'Header' list of the response.
+        endpoint: String - Endpoint of the query.
+    """
+    if header.get('status') != 'Failed':
+        return None
+    messages = header.get('error') or []
+    messages = [messages] if isinstance(messages, str) else messages
+    message = f"AQS query to {endpoint} failed: {'; '.join(messages) or 'no reason given'}"
+    if any(phrase in m.lower() for m in messages for phrase in AUTH_PHRASES):
+        return AuthError(message, endpoint)
+    return RequestError(message, endpoint)
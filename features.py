@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+
+from metrics import METRICS, timed
+
+# Lags (hours) of every column
+LAGS = [1, 2, 3, 6, 12, 24]
+
+# Rolling window lengths (hours) and the statistics computed over them
+WINDOWS = [6, 24]
+STATS = ['mean', 'max']
+
+# Calendar encodings: hour of day and day of year as points on a circle, plus a weekend flag
+CALENDAR = ['hour_sin', 'hour_cos', 'doy_sin', 'doy_cos', 'weekend']
+
+HOUR = np.timedelta64(1, 'h')
+
+def window_sums(values, window, dtype=np.float64):
+    """
+    Sums of every window of rows of a 2D array (len(values) - window + 1 rows), as differences of one
+    cumulative sum rather than a sum per window.
+    """
+    sums = np.zeros((len(values) + 1, values.shape[1]), dtype=dtype)
+    np.cumsum(values, axis=0, dtype=dtype, out=sums[1:])
+    return sums[window:] - sums[:-window]
+
+def window_reduce(ufunc, values, window):
+    """
+    ufunc (eg. np.fmax) over every window of rows of a 2D array, combining strided views of windows of
+    doubling length, so each row is touched log2(window) times rather than window times.
+    """
+    acc, span = values, 1
+    while span * 2 <= window:
+        acc = ufunc(acc[:-span], acc[span:])
+        span *= 2
+    if span < window:
+        # Two overlapping windows of length span cover the window
+        acc = ufunc(acc[:len(acc) - (window - span)], acc[window - span:])
+    return acc
+
+class FeatureBuilder():
+    """
+    Turns an hourly frame (eg. the output of Processor.join or a DatasetStore partition) into a model
+    feature matrix: current values, lags, rolling means and maxima of every column, and diurnal/seasonal
+    encodings. Lags and windows are read from strided views of one padded array instead of shifting and
+    rolling each column in pandas, and consecutive chunks can be transformed one at a time (see stream).
+    """
+
+    def __init__(self, lags=LAGS, windows=WINDOWS, stats=STATS, calendar=True, current=True, min_periods=1, dtype=np.float32):
+        """
+        Parameters:
+            lags: [int] - Lags in hours.
+            windows: [int] - Rolling window lengths in hours, each ending at (and including) the current hour.
+            stats: [String] - Statistics of every window, any of 'mean', 'max', 'min' and 'std'.
+            calendar: bool - Add the CALENDAR encodings.
+            current: bool - Keep the current value of every column, under its own name.
+            min_periods: int - Valid hours a window needs for its statistics, NaN otherwise.
+            dtype: np.dtype - Output dtype, float32 halves the memory of float64.
+        """
+        for stat in stats:
+            if stat not in ['mean', 'max', 'min', 'std']:
+                raise ValueError(f"Unknown statistic {stat}, expected 'mean', 'max', 'min' or 'std'.")
+        self.lags = sorted(lags)
+        self.windows = sorted(windows)
+        self.stats = list(stats)
+        self.calendar = calendar
+        self.current = current
+        self.min_periods = min_periods
+        self.dtype = np.dtype(dtype)
+        # Hours of history a row needs (a window over past values only starts window hours earlier)
+        self.history = max([0, *self.lags, *self.windows])
+
+    def feature_names(self, columns, past_only=()):
+        """
+        Names of the features built from columns, in output order.
+
+        Returns:
+            ([String], dict) - Feature names, and {feature: source column} (None for calendar features).
+        """
+        names, sources = [], {}
+        def add(name, source):
+            names.append(name)
+            sources[name] = source
+
+        for col in columns:
+            if self.current and col not in past_only:
+                add(col, col)
+            for lag in self.lags:
+                add(f'{col}_lag{lag}h', col)
+            for window in self.windows:
+                for stat in self.stats:
+                    add(f'{col}_{stat}{window}h', col)
+        if self.calendar:
+            for name in CALENDAR:
+                add(name, None)
+        return names, sources
+
+    def regular(self, df):
+        """
+        Helper function. df on a gapless hourly index (missing hours become NaN rows).
+        """
+        times = df.index.values
+        if len(times) > 1 and not (np.diff(times) == HOUR).all():
+            df = df.asfreq('1h')
+        return df
+
+    def tail(self, df):
+        """
+        Last self.history hours of df, the history the next consecutive chunk needs.
+        """
+        if self.history == 0 or len(df) == 0:
+            return None
+        return df[df.index > df.index[-1] - self.history * HOUR]
+
+    def padded_values(self, df, history):
+        """
+        Helper function. Values of df with self.history hours in front: the matching hours of history,
+        NaN where history is missing.
+        """
+        values = df.to_numpy(dtype=self.dtype)
+        pad = np.full((self.history, values.shape[1]), np.nan, dtype=self.dtype)
+        if history is not None and self.history:
+            hours = pd.date_range(end=df.index[0] - HOUR, periods=self.history, freq='1h')
+            pad = history.reindex(index=hours, columns=df.columns).to_numpy(dtype=self.dtype)
+        return np.concatenate([pad, values])
+
+    def window_stats(self, padded, n, window, past):
+        """
+        Helper function. {stat: (n, columns) array} over windows of padded ending at each of its last n
+        rows (or the row before, if past).
+        """
+        end = len(padded) - 1 if past else len(padded)
+        segment = padded[end - n - window + 1:end]
+        valid = ~np.isnan(segment)
+        filled = np.where(valid, segment, 0)
+        counts = window_sums(valid, window, np.int32)
+        enough = counts >= self.min_periods
+
+        stats = {}
+        if 'mean' in self.stats or 'std' in self.stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = window_sums(filled, window) / counts
+                stats['mean'] = mean
+                if 'std' in self.stats:
+                    var = (window_sums(filled * filled, window) - counts * mean * mean) / (counts - 1)
+                    stats['std'] = np.where(counts > 1, np.sqrt(np.maximum(var, 0)), np.nan)
+        # fmax / fmin ignore NaN, and leave all-NaN windows NaN
+        if 'max' in self.stats:
+            stats['max'] = window_reduce(np.fmax, segment, window)
+        if 'min' in self.stats:
+            stats['min'] = window_reduce(np.fmin, segment, window)
+        return {stat: np.where(enough, values, np.nan) for stat, values in stats.items()}
+
+    def calendar_features(self, index):
+        """
+        Helper function. (rows, len(CALENDAR)) array of the calendar encodings of a DatetimeIndex.
+        """
+        hour = 2 * np.pi * (index.hour.to_numpy() + index.minute.to_numpy() / 60) / 24
+        doy = 2 * np.pi * (index.dayofyear.to_numpy() - 1) / 365.25
+        weekend = index.dayofweek.to_numpy() >= 5
+        return np.column_stack([np.sin(hour), np.cos(hour), np.sin(doy), np.cos(doy), weekend]).astype(self.dtype)
+
+    @timed('build_features')
+    def transform(self, df, history=None, past_only=()):
+        """
+        Build the features of one hourly frame of one site.
+
+        Parameters:
+            df: pd.DataFrame - Hourly values indexed by datetime. Missing hours are added as NaN rows.
+            history: pd.DataFrame - The hours before df (eg. tail() of the previous chunk). Without it, the
+                                    first lags and windows of df are NaN.
+            past_only: [String] - Columns whose current value is left out and whose windows end one hour
+                                  earlier, eg. the target, so no feature contains the value being predicted.
+
+        Returns:
+            pd.DataFrame - Features indexed like df (after filling missing hours), of type self.dtype.
+        """
+        df = self.regular(df)
+        columns = list(df.columns)
+        names, _ = self.feature_names(columns, past_only)
+        n = len(df)
+        # Column-major, so every feature is written contiguously and the frame is built without a copy
+        out = np.empty((n, len(names)), dtype=self.dtype, order='F')
+        if n == 0:
+            return pd.DataFrame(out, index=df.index, columns=names)
+
+        padded = self.padded_values(df, history)
+        offset = len(padded) - n
+        # Every block is computed for all columns at once, then scattered to each column's features
+        lagged = {lag: padded[offset - lag:offset - lag + n] for lag in self.lags}
+        windowed = {}
+        for window in self.windows:
+            windowed[window] = self.window_stats(padded, n, window, past=False)
+            if past_only:
+                windowed[(window, 'past')] = self.window_stats(padded, n, window, past=True)
+
+        j = 0
+        for c, col in enumerate(columns):
+            past = col in past_only
+            if self.current and not past:
+                out[:, j] = padded[offset:, c]
+                j += 1
+            for lag in self.lags:
+                out[:, j] = lagged[lag][:, c]
+                j += 1
+            for window in self.windows:
+                stats = windowed[(window, 'past') if past else window]
+                for stat in self.stats:
+                    out[:, j] = stats[stat][:, c]
+                    j += 1
+        if self.calendar:
+            out[:, j:] = self.calendar_features(df.index)
+
+        METRICS.add_rows('build_features', n)
+        return pd.DataFrame(out, index=df.index, columns=names)
+
+    def stream(self, chunks, past_only=()):
+        """
+        Transform consecutive chunks of one site (eg. the months of a DatasetStore partition, or the
+        years of a site) one at a time, carrying the history each chunk needs from the previous one.
+        Only one chunk and its features are in memory at a time.
+
+        Parameters:
+            chunks: iterable of pd.DataFrame - Hourly frames in time order.
+            past_only: [String] - See transform(...).
+
+        Returns:
+            generator of pd.DataFrame
+        """
+        history = None
+        for chunk in chunks:
+            if history is not None and len(chunk) and history.index[-1] >= chunk.index[0]:
+                raise ValueError(f"Chunks must be in time order, got {chunk.index[0]} after {history.index[-1]}.")
+            yield self.transform(chunk, history, past_only)
+            if len(chunk):
+                # Short chunks keep part of the previous history
+                history = self.tail(chunk) if history is None else self.tail(pd.concat([history, self.tail(chunk)]))
+
+def time_chunks(df, freq='30D'):
+    """
+    Split a frame indexed by datetime into consecutive chunks of length freq, for FeatureBuilder.stream(...).
+    """
+    if len(df) == 0:
+        return
+    freq = pd.Timedelta(freq).to_timedelta64()
+    times = df.index.values
+    edges = np.arange(times[0], times[-1] + freq, freq)
+    bounds = np.searchsorted(times, edges[1:], side='left')
+    start = 0
+    for end in bounds:
+        if end > start:
+            yield df.iloc[start:end]
+        start = end
+
+def store_chunks(store, site, years, kind='core', columns=None, freq=None):
+    """
+    Consecutive frames of one site and table from a DatasetStore, one per year (or per freq period
+    within each year), so a multi-year feature matrix never has to load all years at once.
+    """
+    for year in sorted(str(y) for y in years):
+        if not store.exists(site, year, kind):
+            continue
+        df = store.read(site, year, kind, columns=columns)
+        if freq is None:
+            yield df
+        else:
+            yield from time_chunks(df, freq)
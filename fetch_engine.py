@@ -0,0 +1,347 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from aqs_stream import iter_records
+from metrics import METRICS
+from errors import AQSTimeoutError, BatchError, ServerError, header_error, http_error, is_transient
+
+# AQS asks users to make no more than 10 requests per minute.
+DEFAULT_RATE_LIMIT = 10 / 60
+
+# HTTP statuses worth retrying (rate limiting and transient server errors)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Bytes read at a time when streaming a response
+STREAM_CHUNK_BYTES = 64 * 1024
+
+class RateLimiter():
+    """
+    Thread-safe limiter that spaces out calls so that at most `rate` of them start every second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        """
+        Block until the caller is allowed to issue its next request.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+class FetchEngine():
+    """
+    Shared HTTP engine for AQS queries. Reuses one pooled session across threads, caps the
+    request rate and retries transient failures with exponential backoff.
+    """
+
+    def __init__(self, base_url, max_workers=4, rate_limit=DEFAULT_RATE_LIMIT, retries=3, backoff=2.0, timeout=120, cache=None):
+        """
+        Parameters:
+            base_url: String - Root url every endpoint is appended to.
+            max_workers: int - Number of requests allowed in flight at once.
+            rate_limit: float - Maximum requests started per second (None or 0 disables the cap).
+            retries: int - Number of times a failed request is retried.
+            backoff: float - Base delay in seconds, doubled after every failed attempt.
+            timeout: float - Seconds to wait for a response.
+            cache: ResponseCache - Optional on-disk cache consulted before hitting the network.
+        """
+        self.base_url = base_url
+        self.cache = cache
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate_limit)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def sleep_before_retry(self, attempt, response=None):
+        """
+        Helper function. Honours Retry-After when present, otherwise backs off exponentially with jitter.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        time.sleep(delay)
+
+    def get(self, endpoint, params, use_cache=True):
+        """
+        Issue one GET request against base_url + endpoint and decode the JSON payload.
+
+        Parameters:
+            endpoint: String - Endpoint of AQS query. Example: 'sampleData/bySite'.
+            params: dict - Query parameters, including credentials.
+            use_cache: bool - Whether a cached response may be returned. The fresh response is cached either way.
+
+        Returns:
+            dict - Decoded JSON response.
+
+        Raises:
+            AuthError, RequestError, RateLimitError, ServerError or AQSTimeoutError (see errors.py).
+        """
+        if self.cache is not None and use_cache:
+            payload = self.cache.get(endpoint, params)
+            if payload is not None:
+                METRICS.record_cache_hit(endpoint)
+                return payload
+
+        r = self.request(endpoint, params)
+        try:
+            with METRICS.stage('json_decode'):
+                payload = r.json()
+        except ValueError as e:
+            raise ServerError(f"AQS sent an unreadable response for {endpoint}.", endpoint, r.status_code) from e
+        error = header_error(self.header(payload), endpoint)
+        if error is not None:
+            raise error
+        if self.cache is not None and self.cacheable(payload):
+            self.cache.put(endpoint, params, payload)
+        return payload
+
+    def request(self, endpoint, params, stream=False):
+        """
+        Helper function. Issue a rate limited GET request, retrying transient failures with backoff.
+
+        Returns:
+            requests.Response - A successful response.
+
+        Raises:
+            AuthError, RequestError, RateLimitError, ServerError or AQSTimeoutError (see errors.py).
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url=self.base_url + endpoint, params=params, timeout=self.timeout, stream=stream)
+            except requests.Timeout as e:
+                METRICS.record_request(endpoint, time.perf_counter() - start)
+                if attempt == self.retries:
+                    raise AQSTimeoutError(f"AQS did not answer {endpoint} within {self.timeout}s.", endpoint) from e
+                self.sleep_before_retry(attempt)
+                continue
+            except requests.ConnectionError as e:
+                METRICS.record_request(endpoint, time.perf_counter() - start)
+                if attempt == self.retries:
+                    raise ServerError(f"Could not connect to AQS for {endpoint}: {e}", endpoint) from e
+                self.sleep_before_retry(attempt)
+                continue
+            if METRICS.enabled:
+                # Streamed bodies are counted as they are read
+                METRICS.record_request(endpoint, time.perf_counter() - start, 0 if stream else len(r.content), r.status_code)
+
+            if r.status_code in RETRY_STATUSES and attempt < self.retries:
+                r.close()
+                self.sleep_before_retry(attempt, r)
+                continue
+            if not r.ok:
+                error = http_error(r.status_code, endpoint, '' if stream else r.text)
+                r.close()
+                raise error
+            return r
+
+    def header(self, payload):
+        """
+        Helper function. First entry of the Header of an AQS response.
+        """
+        header = payload.get('Header') or [{}]
+        return header[0] if isinstance(header, list) else header
+
+    def stream(self, endpoint, params, chunk_bytes=STREAM_CHUNK_BYTES, key='Data'):
+        """
+        Issue one GET request and parse the records of the response as they arrive, instead of
+        decoding the whole payload at once. Streamed responses are never cached. The Header is checked
+        before any record is yielded, raising the same errors as get(...), and a response without the
+        key array raises ServerError.
+
+        Parameters:
+            endpoint: String - Endpoint of AQS query. Example: 'sampleData/byState'.
+            params: dict - Query parameters, including credentials.
+            chunk_bytes: int - Bytes read from the socket at a time.
+            key: String - Array of the response to parse.
+
+        Returns:
+            Generator of dicts, one per record.
+        """
+        def check_header(header):
+            # Same typed errors as get(...) for a Failed header
+            error = header_error(header[0] if isinstance(header, list) and header else header or {}, endpoint)
+            if error is not None:
+                raise error
+
+        # Only the connection is retried, records already yielded cannot be taken back
+        with self.request(endpoint, params, stream=True) as r:
+            records = iter_records(self.counted(endpoint, r.iter_content(chunk_size=chunk_bytes)), key=key, on_header=check_header)
+            try:
+                yield from records
+            except ValueError as e:
+                raise ServerError(f"Unreadable streamed response from {endpoint}: {e}", endpoint) from e
+
+    def counted(self, endpoint, chunks):
+        """
+        Helper function. Pass chunks of a streamed body through, counting their bytes in METRICS.
+        """
+        for chunk in chunks:
+            METRICS.record_bytes(endpoint, len(chunk))
+            yield chunk
+
+    def cacheable(self, payload):
+        """
+        Helper function. Only responses AQS did not flag as failed are worth keeping. Empty results are
+        kept too, data submitted later is picked up once the entry expires (see ResponseCache.ttl).
+        """
+        return 'Data' in payload and self.header(payload).get('status') != 'Failed'
+
+    def try_get(self, endpoint, params, use_cache=True):
+        """
+        Helper function. get(...) that reports failures in a TaskResult instead of raising them.
+        """
+        try:
+            payload = self.get(endpoint, params, use_cache)
+        except Exception as e:
+            return TaskResult('failed', error=e)
+        return TaskResult('ok' if payload.get('Data') else 'empty', payload)
+
+    def get_batch(self, requests_list, use_cache=True, retry_rounds=1):
+        """
+        Run many GET requests concurrently on the shared session. Every request gets its own status instead
+        of one failure aborting the whole batch, and requests that failed for a transient reason (rate limiting, server
+        errors, timeouts) are retried in up to retry_rounds extra rounds.
+
+        Parameters:
+            requests_list: [(String, dict)] - (endpoint, params) pairs to query.
+            use_cache: bool - Whether cached responses may be returned.
+            retry_rounds: int - Extra rounds for transient failures, after the engine's own retries.
+
+        Returns:
+            BatchResult - One TaskResult per request, in the same order as requests_list.
+        """
+        def run(reqs):
+            if len(reqs) <= 1 or self.max_workers <= 1:
+                return [self.try_get(endpoint, params, use_cache) for endpoint, params in reqs]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(lambda req: self.try_get(*req, use_cache=use_cache), reqs))
+
+        results = run(requests_list)
+        for attempt in range(retry_rounds):
+            retry = [i for i, result in enumerate(results) if result.status == 'failed' and is_transient(result.error)]
+            if not retry:
+                break
+            self.sleep_before_retry(self.retries + attempt)
+            for i, result in zip(retry, run([requests_list[i] for i in retry])):
+                result.attempts += results[i].attempts
+                results[i] = result
+        return BatchResult(requests_list, results, runner=lambda reqs: self.get_batch(reqs, use_cache, retry_rounds))
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+class TaskResult():
+    """
+    Outcome of one task of a batch.
+    """
+
+    def __init__(self, status, value=None, error=None, attempts=1):
+        """
+        Parameters:
+            status: String - 'ok', 'empty' (succeeded without data) or 'failed'.
+            value: Result of the task (eg. decoded JSON response).
+            error: Exception - Why the task failed.
+            attempts: int - Number of times the task was run.
+        """
+        self.status = status
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+
+    def __repr__(self):
+        error = f", error={type(self.error).__name__}" if self.error is not None else ''
+        return f"TaskResult({self.status}{error}, attempts={self.attempts})"
+
+class BatchResult():
+    """
+    Per-task outcomes of a batch of requests. Tasks that failed for a transient reason can be re-run on
+    their own with rerun().
+    """
+
+    def __init__(self, tasks, results, runner=None):
+        """
+        Parameters:
+            tasks: list - Task descriptions, in order.
+            results: [TaskResult] - Outcome of every task.
+            runner: callable - Runs a list of tasks and returns a BatchResult, used by rerun().
+        """
+        self.tasks = list(tasks)
+        self.results = list(results)
+        self.runner = runner
+
+    def __len__(self):
+        return len(self.results)
+
+    def values(self):
+        """
+        Value of every task, None for failed ones.
+        """
+        return [result.value if result.status != 'failed' else None for result in self.results]
+
+    def failed(self):
+        """
+        Indices of the tasks that failed.
+        """
+        return [i for i, result in enumerate(self.results) if result.status == 'failed']
+
+    def counts(self):
+        """
+        Number of tasks per status.
+        """
+        counts = {}
+        for result in self.results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+        return counts
+
+    def rerun(self):
+        """
+        Run the tasks that failed for a transient reason (see errors.is_transient) again and replace their
+        results in place. Other failures would only fail again.
+
+        Returns:
+            BatchResult - self.
+        """
+        failed = [i for i in self.failed() if is_transient(self.results[i].error)]
+        if not failed or self.runner is None:
+            return self
+        again = self.runner([self.tasks[i] for i in failed])
+        for i, result in zip(failed, again.results):
+            result.attempts += self.results[i].attempts
+            self.results[i] = result
+        return self
+
+    def raise_for_failures(self):
+        """
+        Raise a BatchError describing the failed tasks, if there are any.
+        """
+        failed = self.failed()
+        if failed:
+            first = self.results[failed[0]].error
+            raise BatchError(f"{len(failed)} of {len(self)} tasks failed, first error: {type(first).__name__}: {first}", self)
+        return self
@@ -1,40 +1,265 @@
 """
 This script generates our dataset for our machine learning model.
 
-It currently hardcodes which site we will generate data for (LA North Main St.) in the AQS data, and
-we use only daily data for 2018.
+It reads a manifest of sites x years x stages (see sites.json, which describes LA North Main St. for 2018)
+and runs every task across a process pool:
 
-Our script first generates data for the CRITERIA pollutants and MET variables and saves as a CSV. It
-then generates data for VOC compounds in the AQS dataset and their corresponding emissions data from
-the CEDS dataset, saving each separately.
+    core      - CRITERIA pollutants and MET variables (AQS)
+    vocs      - VOC compounds in the AQS dataset that have CEDS emissions (AQS)
+    emissions - corresponding emissions data from the CEDS dataset
+
+core and vocs tasks are independent and run in parallel. Emissions are extracted once per CEDS grid cell
+and year, and shared by every site falling in that cell. Finished partitions in the dataset store act as
+checkpoints, so an interrupted run picks up where it stopped (use --force to rebuild them). With --refresh,
+existing core and vocs partitions are brought up to date instead (see DataFetcher.refresh_dataset): only
+their missing ranges and the records AQS revised since the last run are fetched. Each table is written to
+the store and, unless --no-csv is given, as a CSV under data/clean/<site>/<year>/.
+
+With --metrics the report also holds per-stage timings, per-endpoint request counts, latencies and bytes,
+and rows processed (plus peak memory per stage with --track-memory), and the same numbers are written in
+Prometheus text format next to it.
+
+Usage:
+
+$ python3 generate.py --manifest sites.json --workers 4
+$ python3 generate.py --metrics --track-memory
+$ python3 generate.py --refresh
 """
 
+import argparse
+import datetime
 import json
-import pandas as pd
+import os
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import netCDF4 as nc
+
 from data_fetcher import DataFetcher
+from fetch_engine import DEFAULT_RATE_LIMIT
+from dataset_store import DatasetStore
+from errors import is_transient
+from metrics import METRICS
+from ceds import CedsGrid, ceds_paths, ceds_site_frame, ceds_units, to_hourly
+
+CSV_PATH = './data/clean/{label}/{year}/'
+CEDS_PATH = './data/{year}/'
+STAGES = ['core', 'vocs', 'emissions']
+
+# One fetcher per worker process, created by init_worker
+FETCHER = None
+
+def init_worker(rate_limit, workers=1, metrics=False, track_memory=False):
+    """
+    Create the fetcher of a worker process. The workers share the response cache file (see
+    ResponseCache), and rate_limit is the total for all of them, so each one gets an equal share.
+    """
+    global FETCHER
+    FETCHER = DataFetcher(max_workers=4, rate_limit=rate_limit / workers if rate_limit else rate_limit)
+    if metrics:
+        METRICS.enable(track_memory=track_memory)
+
+def load_manifest(path):
+    """
+    Expand a manifest into a list of site dicts with their years and stages filled in.
+
+    A manifest looks like:
+
+    {
+        "years": ["2018"],
+        "stages": ["core", "vocs", "emissions"],
+        "sites": [{"label": "Los_Angeles-North_Main_Street", "state": "06", "county": "037", "site": "1103",
+                   "lat": 34.06659, "lon": -118.22688}]
+    }
+
+    Sites may override "years" and "stages".
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    sites = []
+    for site in manifest['sites']:
+        site = dict(site)
+        site['years'] = [str(y) for y in site.get('years', manifest.get('years', []))]
+        site['stages'] = site.get('stages', manifest.get('stages', STAGES))
+        sites.append(site)
+    return sites
+
+def write_outputs(store, df, label, year, kind, csv, extra=None, units=None):
+    store.write(df, label, year, kind, units=units, extra=extra)
+    if csv:
+        write_csv(df, label, year, kind)
+
+def write_csv(df, label, year, kind):
+    path = CSV_PATH.format(label=label, year=year)
+    os.makedirs(path, exist_ok=True)
+    df.to_csv(path + kind + '.csv')
+
+def run_task(task, store_root, csv):
+    """
+    Run one task in a worker process.
+
+    Returns:
+        dict - Task description with its status, duration and (if it failed) the error.
+    """
+    start = time.time()
+    METRICS.reset()
+    store = DatasetStore(store_root)
+    year = task['year']
+    try:
+        if task.get('refresh'):
+            # Merges the new records into the stored partition and keeps its extras (eg. coordinates)
+            names = task['vocs'] if task['stage'] == 'vocs' else None
+            task = {**task, **FETCHER.refresh_dataset(store, task['label'], year, task['stage'], task['state'], task['county'], task['site'], names=names)}
+            if csv:
+                write_csv(store.read(task['label'], year, task['stage']), task['label'], year, task['stage'])
+        elif task['stage'] == 'core':
+            df = FETCHER.create_dataset(f'{year}0101', f'{year}1231', site=task['site'], county=task['county'], state=task['state'])
+            # Site coordinates reported by AQS go in the partition metadata, see SiteIndex.from_store
+            coords = FETCHER.processor.site_coordinates
+            extra = coords.iloc[0].to_dict() if coords is not None and len(coords) else None
+            write_outputs(store, df, task['label'], year, 'core', csv, extra, units=FETCHER.processor.units)
+        elif task['stage'] == 'vocs':
+            df = FETCHER.get_voc_data(f'{year}0101', f'{year}1231', task['state'], task['county'], task['site'], task['vocs'])
+            write_outputs(store, df, task['label'], year, 'vocs', csv, units=FETCHER.processor.units)
+        elif task['stage'] == 'emissions':
+            # One extraction for the whole grid cell, written to every site in it
+            long_df = FETCHER.get_ceds_sites([year], {'cell': (task['lat'], task['lon'])}, keep=task['keep'], path=CEDS_PATH)
+            df = to_hourly(ceds_site_frame(long_df, 'cell')[[k for k in task['keep'] if k in set(long_df['variable'])]])
+            units = ceds_units(ceds_paths([year], compounds=task['keep'], path=CEDS_PATH))
+            for label in task['labels']:
+                write_outputs(store, df, label, year, 'emissions', csv, units=units)
+        status, error, transient = 'done', None, False
+    except Exception as e:
+        status, error, transient = 'failed', traceback.format_exc(), is_transient(e)
+    result = {**task, 'status': status, 'error': error, 'transient': transient, 'seconds': round(time.time() - start, 2)}
+    if METRICS.enabled:
+        result['metrics'] = METRICS.to_dict()
+    return result
+
+def plan_tasks(sites, store, final_vocs, final_emissions, force=False, refresh=False):
+    """
+    Build the task graph. core and vocs tasks are one per site-year, emissions tasks one per CEDS grid
+    cell and year. Tasks whose partitions already exist are returned separately as skipped, except
+    core and vocs tasks with refresh, which become incremental refreshes of their partitions.
+
+    Returns:
+        ([dict], [dict]) - Tasks to run and tasks skipped.
+    """
+    tasks, skipped = [], []
+
+    def add(task, labels):
+        done = all(store.exists(label, task['year'], task['stage']) for label in labels)
+        if done and refresh and not force and task['stage'] in ['core', 'vocs']:
+            tasks.append({**task, 'refresh': True})
+        else:
+            (skipped if done and not force else tasks).append(task)
+
+    cells = {}
+    for site in sites:
+        for year in site['years']:
+            base = {'label': site['label'], 'year': year, 'state': site['state'], 'county': site['county'], 'site': site['site']}
+            if 'core' in site['stages']:
+                add({**base, 'stage': 'core'}, [site['label']])
+            if 'vocs' in site['stages']:
+                add({**base, 'stage': 'vocs', 'vocs': final_vocs}, [site['label']])
+            if 'emissions' in site['stages']:
+                if 'lat' not in site or 'lon' not in site:
+                    skipped.append({**base, 'stage': 'emissions', 'status': 'failed', 'error': 'No lat/lon in manifest.'})
+                    continue
+                cells.setdefault(year, []).append(site)
+
+    # Group sites by the CEDS grid cell they fall in, using the grid of that year's files
+    for year, year_sites in cells.items():
+        paths = ceds_paths([year], path=CEDS_PATH)
+        if not paths:
+            for site in year_sites:
+                skipped.append({'label': site['label'], 'year': year, 'stage': 'emissions', 'status': 'failed',
+                                'error': f'No CEDS files in {CEDS_PATH.format(year=year)}, run DataFetcher.save_ceds_ncs first.'})
+            continue
+        with nc.Dataset(paths[0]) as ds:
+            grid = CedsGrid.from_dataset(ds)
+        rows, cols = grid.nearest([s['lat'] for s in year_sites], [s['lon'] for s in year_sites])
+        groups = {}
+        for site, i, j in zip(year_sites, rows, cols):
+            groups.setdefault((int(i), int(j)), []).append(site['label'])
+        for (i, j), labels in groups.items():
+            add({'stage': 'emissions', 'year': year, 'labels': labels, 'label': ','.join(labels),
+                 'lat': float(grid.lats[i]), 'lon': float(grid.lons[j]), 'keep': final_emissions}, labels)
+
+    return tasks, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate AQS and CEDS training data for many sites and years.')
+    parser.add_argument('--manifest', default='sites.json', help='JSON manifest of sites x years x stages.')
+    parser.add_argument('--store', default='./data/store/', help='Root of the dataset store.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes.')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT, help='AQS requests per second, shared by all workers.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--force', action='store_true', help='Rebuild partitions that already exist.')
+    mode.add_argument('--refresh', action='store_true', help='Incrementally update core and vocs partitions that already exist.')
+    parser.add_argument('--no-csv', action='store_true', help='Only write to the dataset store.')
+    parser.add_argument('--report', default=None, help='Where to write the JSON summary report.')
+    parser.add_argument('--metrics', action='store_true', help='Record timings, request and memory metrics in the report.')
+    parser.add_argument('--track-memory', action='store_true', help='With --metrics, also record peak memory per stage (slower).')
+    parser.add_argument('--retry-rounds', type=int, default=1, help='Extra rounds for tasks that failed for a transient reason.')
+    args = parser.parse_args()
 
-PATH    = './data/clean/Los_Angeles-North_Main_Street/2018/'
-SITE    = '1103'
-COUNTY  ='037'
-STATE   = '06'
+    if args.metrics:
+        METRICS.enable(track_memory=args.track_memory)
+    sites = load_manifest(args.manifest)
+    store = DatasetStore(args.store)
 
-datafetcher = DataFetcher()
+    datafetcher = DataFetcher()
+    final_vocs, final_emissions = datafetcher.get_final_compounds()
+    # NOTE: REMOVE m/p Xylene data as its indices are scrambled and so I assume the data is untrustworthy.
+    final_vocs = [voc for voc in final_vocs if voc != 'm/p Xylene']
 
-# CRITERIA and MET variables
-core_df = datafetcher.create_dataset(20180101, 20181231, site=SITE, county=COUNTY, state=STATE, processed=True, verbose=False, vocs=False)
-core_df.to_csv(PATH+'core.csv')
-print("Finished core df.")
+    tasks, skipped = plan_tasks(sites, store, final_vocs, final_emissions, force=args.force, refresh=args.refresh)
+    print(f"{len(tasks)} tasks to run, {len(skipped)} skipped.")
 
-# AQS VOCS and corresponding emisions
-final_vocs, final_emissions = datafetcher.get_final_compounds()
+    results = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.rate_limit, args.workers, args.metrics, args.track_memory)) as executor:
+        # Tasks that failed for a transient reason (rate limiting, server errors, timeouts) get extra rounds
+        for attempt in range(1 + args.retry_rounds):
+            futures = [executor.submit(run_task, task, args.store, not args.no_csv) for task in tasks]
+            tasks = []
+            for n, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                mode = ' refresh' if result.get('refresh') else ''
+                print(f"[{n}/{len(futures)}] {result['stage']}{mode} {result['label']} {result['year']}: {result['status']} ({result['seconds']}s)")
+                if 'metrics' in result:
+                    METRICS.merge(result.pop('metrics'))
+                if result['transient'] and attempt < args.retry_rounds:
+                    tasks.append({k: v for k, v in result.items() if k not in ('status', 'error', 'transient', 'seconds')})
+                else:
+                    results.append(result)
+            if not tasks:
+                break
+            print(f"Retrying {len(tasks)} tasks that failed for a transient reason...")
+    store.write_manifest()
 
-# NOTE: REMOVE m/p Xylene data as its indices are scrambled and so I assume the data is untrustworthy.
-final_vocs.remove('m/p Xylene')
+    for task in skipped:
+        task.setdefault('status', 'skipped')
+    report = {
+        'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+        'seconds': round(time.time() - start, 2),
+        'counts': dict(Counter(t['status'] for t in results + skipped)),
+        'tasks': [{k: v for k, v in t.items() if k not in ('vocs', 'keep')} for t in results + skipped],
+    }
+    if args.metrics:
+        report['metrics'] = METRICS.to_dict()
+    report_path = args.report or os.path.join(args.store, 'runs', datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.metrics:
+        # Same metrics in Prometheus text format, eg. for a node exporter textfile collector
+        METRICS.to_prometheus(os.path.splitext(report_path)[0] + '.prom')
 
-vocs_df = datafetcher.get_voc_data(20180101, 20181231, STATE, COUNTY, SITE, final_vocs)
-vocs_df.to_csv(PATH+'vocs.csv')
-print("Finished vocs df.")
+    print(f"Finished in {report['seconds']}s: {report['counts']}. Report written to {report_path}.")
 
-emissions_df = datafetcher.get_ceds_data('2018', keep=final_emissions) 
-emissions_df.to_csv(PATH+'emissions.csv')
-print("Finished emissions df.")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')]
+
+class NullStage():
+    """
+    Context manager returned by Metrics.stage(...) while metrics are disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Stage():
+    """
+    Times one run of a stage and, when memory tracking is on, its peak traced memory.
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.memory = self.metrics.track_memory and tracemalloc.is_tracing()
+        if self.memory:
+            with self.metrics.memory_lock:
+                current, peak = tracemalloc.get_traced_memory()
+                stages = self.metrics.memory_stages
+                # The traced peak is process-wide, so it is only reset when no other stage (in any thread) is open
+                if not stages:
+                    tracemalloc.reset_peak()
+                self.entry = {'start': current, 'child_peak': 0}
+                stages.append(self.entry)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        peak = None
+        if self.memory:
+            with self.metrics.memory_lock:
+                stages = self.metrics.memory_stages
+                stages.remove(self.entry)
+                top = max(tracemalloc.get_traced_memory()[1], self.entry['child_peak'])
+                peak = top - self.entry['start']
+                # Stages still open contain this one
+                for entry in stages:
+                    entry['child_peak'] = max(entry['child_peak'], top)
+        self.metrics.record_stage(self.name, seconds, peak)
+        return False
+
+class Metrics():
+    """
+    Process-wide instrumentation: per-stage timers and peak memory, per-endpoint request counts,
+    latency histograms and bytes transferred, and rows processed. Disabled by default, in which case
+    every call returns immediately.
+    """
+
+    def __init__(self, enabled=False, track_memory=False):
+        """
+        Parameters:
+            enabled: bool - Whether to record anything.
+            track_memory: bool - Also record peak memory per stage with tracemalloc (slows Python allocations down).
+        """
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.lock = threading.Lock()
+        # Stages currently tracking memory, in every thread (see Stage)
+        self.memory_lock = threading.Lock()
+        self.memory_stages = []
+        self.reset()
+
+    def enable(self, track_memory=False):
+        self.enabled = True
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.track_memory = False
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.endpoints = {}
+            self.rows = {}
+            self.started = time.time()
+
+    def stage(self, name):
+        """
+        Context manager timing a stage. Nested stages are each recorded under their own name.
+
+        Example:
+
+        with METRICS.stage('netcdf_read'):
+            ...
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def record_stage(self, name, seconds, peak=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': None})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            if peak is not None:
+                stage['peak_bytes'] = max(stage['peak_bytes'] or 0, peak)
+
+    def endpoint(self, endpoint):
+        """
+        Helper function. Counters of one endpoint, created on first use (call with the lock held).
+        """
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {'requests': 0, 'errors': 0, 'cache_hits': 0, 'bytes': 0, 'seconds': 0.0,
+                                        'buckets': [0] * len(LATENCY_BUCKETS), 'statuses': {}}
+        return self.endpoints[endpoint]
+
+    def record_request(self, endpoint, seconds, nbytes=0, status=None):
+        """
+        Record one HTTP request.
+
+        Parameters:
+            endpoint: String - Endpoint queried.
+            seconds: float - Time until the response (or error) arrived.
+            nbytes: int - Size of the response body.
+            status: int - HTTP status, None if no response was received.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self.endpoint(endpoint)
+            counters['requests'] += 1
+            counters['seconds'] += seconds
+            counters['bytes'] += nbytes
+            counters['errors'] += status is None or status >= 400
+            key = str(status)
+            counters['statuses'][key] = counters['statuses'].get(key, 0) + 1
+            counters['buckets'][next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+    def record_bytes(self, endpoint, nbytes):
+        """
+        Add bytes received after a request was recorded (eg. while streaming its body).
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.endpoint(endpoint)['bytes'] += nbytes
+
+    def record_cache_hit(self, endpoint):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.endpoint(endpoint)['cache_hits'] += 1
+
+    def add_rows(self, name, n):
+        """
+        Count rows processed by a stage.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.rows[name] = self.rows.get(name, 0) + int(n)
+
+    def to_dict(self):
+        """
+        Snapshot of every metric.
+        """
+        with self.lock:
+            return json.loads(json.dumps({
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'stages': self.stages,
+                'endpoints': self.endpoints,
+                'rows': self.rows,
+                'buckets': [str(b) for b in LATENCY_BUCKETS],
+            }))
+
+    def merge(self, snapshot):
+        """
+        Add a to_dict() snapshot (eg. from a worker process) into these metrics.
+        """
+        with self.lock:
+            for name, other in snapshot['stages'].items():
+                stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': None})
+                stage['calls'] += other['calls']
+                stage['seconds'] += other['seconds']
+                stage['max_seconds'] = max(stage['max_seconds'], other['max_seconds'])
+                if other['peak_bytes'] is not None:
+                    stage['peak_bytes'] = max(stage['peak_bytes'] or 0, other['peak_bytes'])
+            for endpoint, other in snapshot['endpoints'].items():
+                counters = self.endpoint(endpoint)
+                for key in ['requests', 'errors', 'cache_hits', 'bytes', 'seconds']:
+                    counters[key] += other[key]
+                counters['buckets'] = [a + b for a, b in zip(counters['buckets'], other['buckets'])]
+                for status, n in other['statuses'].items():
+                    counters['statuses'][status] = counters['statuses'].get(status, 0) + n
+            for name, n in snapshot['rows'].items():
+                self.rows[name] = self.rows.get(name, 0) + n
+
+    def to_json(self, path=None):
+        """
+        JSON report of every metric, also written to path if given.
+        """
+        report = json.dumps(self.to_dict(), indent=1)
+        if path:
+            with open(path, 'w') as f:
+                f.write(report)
+        return report
+
+    def to_prometheus(self, path=None, prefix='chem150'):
+        """
+        Metrics in the Prometheus text exposition format, also written to path if given.
+        """
+        snapshot = self.to_dict()
+        lines = [f'# TYPE {prefix}_stage_seconds_total counter', f'# TYPE {prefix}_stage_calls_total counter',
+                 f'# TYPE {prefix}_stage_peak_bytes gauge']
+        for name, stage in snapshot['stages'].items():
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}')
+            if stage['peak_bytes'] is not None:
+                lines.append(f'{prefix}_stage_peak_bytes{{stage="{name}"}} {stage["peak_bytes"]}')
+
+        lines += [f'# TYPE {prefix}_requests_total counter', f'# TYPE {prefix}_request_errors_total counter',
+                  f'# TYPE {prefix}_cache_hits_total counter', f'# TYPE {prefix}_response_bytes_total counter',
+                  f'# TYPE {prefix}_request_seconds histogram']
+        for endpoint, counters in snapshot['endpoints'].items():
+            label = f'endpoint="{endpoint}"'
+            lines.append(f'{prefix}_requests_total{{{label}}} {counters["requests"]}')
+            lines.append(f'{prefix}_request_errors_total{{{label}}} {counters["errors"]}')
+            lines.append(f'{prefix}_cache_hits_total{{{label}}} {counters["cache_hits"]}')
+            lines.append(f'{prefix}_response_bytes_total{{{label}}} {counters["bytes"]}')
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, counters['buckets']):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{prefix}_request_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_request_seconds_sum{{{label}}} {counters["seconds"]:.6f}')
+            lines.append(f'{prefix}_request_seconds_count{{{label}}} {counters["requests"]}')
+
+        lines.append(f'# TYPE {prefix}_rows_total counter')
+        for name, n in snapshot['rows'].items():
+            lines.append(f'{prefix}_rows_total{{stage="{name}"}} {n}')
+
+        text = '\n'.join(lines) + '\n'
+        if path:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+# Shared by every DataFetcher, FetchEngine, Processor and CEDS reader in the process
+METRICS = Metrics()
+
+def timed(name):
+    """
+    Decorator recording every call of a function as a run of stage name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            with METRICS.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,377 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import ParameterGrid
+
+# Feature sets compared in lab_notebook_2.ipynb, as the dataset kinds they combine
+FEATURE_SETS = {
+    'core': ['core'],
+    'core & vocs': ['core', 'vocs'],
+    'core & emissions': ['core', 'emissions'],
+}
+
+# Suffix added to emissions columns so they never clash with AQS columns
+KIND_SUFFIXES = {'emissions': '_emissions'}
+
+MODELS = {'random_forest': RandomForestRegressor}
+
+# Rows hashed at a time when fingerprinting a matrix
+FINGERPRINT_ROWS = 100000
+
+# Memory-mapped matrices opened once per worker process, keyed by path (see open_worker_matrix)
+WORKER_MATRICES = {}
+
+def load_site_frame(store, site, year, kinds, target='Ozone', min_coverage=0.5):
+    """
+    Join the generated tables of one site-year on the core table's hourly index.
+
+    Parameters:
+        store: DatasetStore - Store written by generate.py.
+        site: String - Site label.
+        year: String - Year label.
+        kinds: [String] - Tables to join, starting with 'core'.
+        target: String - Column to predict, always kept.
+        min_coverage: float - Columns with a smaller fraction of valid hours after ffill are dropped (eg. PM2.5 at North Main St.).
+
+    Returns:
+        (pd.DataFrame, dict) - Forward filled frame, and {kind: [columns]} of the columns it kept.
+    """
+    frames, columns = [], {}
+    for kind in kinds:
+        if not store.exists(site, year, kind):
+            continue
+        df = store.read(site, year, kind)
+        df.columns = [col + KIND_SUFFIXES.get(kind, '') for col in df.columns]
+        # Emissions are monthly and VOCs are sampled every few days, so coverage is judged after ffill
+        df = df.ffill()
+        coverage = df.notna().mean()
+        df = df[[col for col in df.columns if coverage[col] >= min_coverage or col == target]]
+        frames.append(df)
+        columns[kind] = [col for col in df.columns if col != target]
+
+    df = frames[0].join(frames[1:], how='left') if len(frames) > 1 else frames[0]
+    return df.ffill(), columns
+
+class FeatureMatrix():
+    """
+    Float32 feature matrix and target of many site-years, stored as .npy files that every worker
+    memory-maps instead of receiving a pickled copy. Rows are sorted by time, so rolling-origin folds
+    are contiguous row ranges.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path: String - Directory written by FeatureMatrix.build(...).
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.columns = self.meta['columns']
+        self.feature_sets = self.meta['feature_sets']
+        self.fingerprint = self.meta['fingerprint']
+        self.X = np.load(os.path.join(path, 'X.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+        self.times = np.load(os.path.join(path, 'times.npy'))
+
+    @classmethod
+    def build(cls, store, sites, years, path, target='Ozone', feature_sets=FEATURE_SETS, min_coverage=0.5, features=None):
+        """
+        Assemble the matrix of every site-year in the store and write it to path.
+
+        Parameters:
+            store: DatasetStore - Store written by generate.py.
+            sites: [String] - Site labels.
+            years: [String] - Years.
+            path: String - Output directory.
+            target: String - Column to predict.
+            feature_sets: dict - {name: [kinds]}, see FEATURE_SETS.
+            min_coverage: float - See load_site_frame(...).
+            features: FeatureBuilder - Optional lag/rolling/calendar features built from the joined columns.
+                                       The years of a site are streamed through it in order, and the target
+                                       only contributes past values. Calendar features count as 'core'.
+
+        Returns:
+            FeatureMatrix
+        """
+        kinds = list(dict.fromkeys(kind for kinds in feature_sets.values() for kind in kinds))
+        frames, kind_columns = [], {kind: [] for kind in kinds}
+        for site in sites:
+            site_frames = [load_site_frame(store, site, year, kinds, target, min_coverage)
+                           for year in sorted(str(y) for y in years) if store.exists(site, year, 'core')]
+            if features is not None and site_frames:
+                built = features.stream((df for df, _ in site_frames), past_only=[target])
+                site_frames = [feature_frame(features, df, columns, built_df, target) for (df, columns), built_df in zip(site_frames, built)]
+            for df, columns in site_frames:
+                frames.append((str(site), df.astype(np.float32, copy=False)))
+                for kind, cols in columns.items():
+                    kind_columns[kind].extend(c for c in cols if c not in kind_columns[kind])
+        if not frames:
+            raise FileNotFoundError(f"No core tables for sites {sites} and years {years} in {store.root}.")
+
+        columns = [col for kind in kinds for col in kind_columns[kind]]
+        times = np.concatenate([df.index.values.astype('datetime64[ns]') for _, df in frames])
+        order = np.argsort(times, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        os.makedirs(path, exist_ok=True)
+
+        # Scatter every site-year into its time sorted rows of the memory-mapped file, never concatenating them
+        X = np.lib.format.open_memmap(os.path.join(path, 'X.npy'), mode='w+', dtype=np.float32, shape=(len(times), len(columns)))
+        y = np.empty(len(times), dtype=np.float32)
+        start = 0
+        for _, df in frames:
+            rows = rank[start:start + len(df)]
+            X[rows] = df.reindex(columns=columns).to_numpy(dtype=np.float32)
+            y[rows] = df[target].to_numpy(dtype=np.float32)
+            start += len(df)
+        X.flush()
+        np.save(os.path.join(path, 'y.npy'), y)
+        np.save(os.path.join(path, 'times.npy'), times[order])
+
+        digest = hashlib.sha256()
+        for i in range(0, len(X), FINGERPRINT_ROWS):
+            digest.update(np.ascontiguousarray(X[i:i + FINGERPRINT_ROWS]).tobytes())
+        digest.update(y.tobytes())
+        digest.update(json.dumps(columns).encode())
+
+        pos = {col: j for j, col in enumerate(columns)}
+        sets = {}
+        for name, set_kinds in feature_sets.items():
+            # Without its extra kinds, a set would only repeat another one
+            absent = [kind for kind in set_kinds if not kind_columns[kind]]
+            if absent:
+                print(f"Skipping feature set {name}: no {', '.join(absent)} columns for sites {sites} and years {years}.")
+                continue
+            sets[name] = [pos[c] for kind in set_kinds for c in kind_columns[kind]]
+        meta = {
+            'target': target,
+            'columns': columns,
+            'feature_sets': sets,
+            'sites': sorted({site for site, _ in frames}),
+            'years': [str(y) for y in years],
+            'rows': int(len(times)),
+            'fingerprint': digest.hexdigest(),
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(path)
+
+def feature_frame(features, df, columns, built, target):
+    """
+    Helper function. Built features of one site-year with the target alongside, and {kind: [features]}.
+    """
+    _, sources = features.feature_names(df.columns, past_only=[target])
+    kind_of = {col: kind for kind, cols in columns.items() for col in cols}
+    kind_of[target] = 'core'
+    feature_columns = {}
+    for name in built.columns:
+        feature_columns.setdefault(kind_of.get(sources[name], 'core'), []).append(name)
+    built[target] = df[target].reindex(built.index)
+    return built, feature_columns
+
+def rolling_origin_folds(times, n_splits=5, test_size=None, gap='0h', min_train=None):
+    """
+    Expanding-window (rolling-origin) folds over time sorted rows. Every fold trains on all rows before
+    its origin and tests on the following period, so no fold ever sees the future. Origins are placed
+    on the timestamps that have rows, so periods without data (eg. between the seasons of several
+    site-years) never produce empty or repeated folds.
+
+    Parameters:
+        times: np.ndarray - Sorted datetime64 timestamp of every row.
+        n_splits: int - Number of folds.
+        test_size: String - Length of each test period (eg. '30D'), starting at the first timestamp after the
+                            previous one. Defaults to equal shares (by timestamps) of what follows min_train.
+        gap: String - Period left out between training and test rows (eg. '24h' to avoid leaking lagged features).
+        min_train: String - Length of the first training period. Defaults to one test period.
+
+    Returns:
+        [(int, int, int)] - (train_end, test_start, test_end) row bounds of every fold.
+
+    Raises:
+        ValueError if fewer than n_splits distinct, non-empty folds fit in times.
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    stamps = np.unique(times)
+    gap = pd.Timedelta(gap).to_timedelta64()
+    first = 0 if min_train is None else int(np.searchsorted(stamps, stamps[0] + pd.Timedelta(min_train).to_timedelta64(), side='left'))
+
+    origins, ends = [], []
+    if test_size is None:
+        # Quantiles of the populated timestamps
+        if min_train is None:
+            first = len(stamps) // (n_splits + 1)
+        edges = first + (len(stamps) - first) * np.arange(n_splits + 1) // n_splits
+        origins = [stamps[i] for i in edges[:-1] if i < len(stamps)]
+        ends = [stamps[i] if i < len(stamps) else stamps[-1] + np.timedelta64(1, 'ns') for i in edges[1:len(origins) + 1]]
+    else:
+        step = pd.Timedelta(test_size).to_timedelta64()
+        if min_train is None:
+            first = int(np.searchsorted(stamps, stamps[0] + step, side='left'))
+        i = first
+        while len(origins) < n_splits and i < len(stamps):
+            origins.append(stamps[i])
+            ends.append(stamps[i] + gap + step)
+            # The next origin is the first populated timestamp after this test period
+            i = int(np.searchsorted(stamps, ends[-1], side='left'))
+
+    folds = []
+    for origin, test_end in zip(origins, ends):
+        bounds = tuple(int(b) for b in np.searchsorted(times, [origin, origin + gap, test_end], side='left'))
+        if bounds[0] > 0 and bounds[1] < bounds[2] and bounds not in folds:
+            folds.append(bounds)
+    if len(folds) < n_splits:
+        raise ValueError(f"Only {len(folds)} non-empty folds fit between {stamps[0]} and {stamps[-1]}, "
+                         f"fewer than n_splits={n_splits}. Use fewer splits or a shorter test_size, gap or min_train.")
+    return folds
+
+def open_worker_matrix(path):
+    """
+    Helper function. Memory-mapped X and y of a matrix, opened once per worker process.
+    """
+    if path not in WORKER_MATRICES:
+        WORKER_MATRICES[path] = (np.load(os.path.join(path, 'X.npy'), mmap_mode='r'), np.load(os.path.join(path, 'y.npy'), mmap_mode='r'))
+    return WORKER_MATRICES[path]
+
+def fit_fold(task):
+    """
+    Fit and score one model on one fold. Runs in a worker process and only receives row bounds and
+    column indices, reading the data from the shared memory-mapped matrix.
+
+    Returns:
+        dict - Scores and sizes of the fold.
+    """
+    start = time.time()
+    X, y = open_worker_matrix(task['path'])
+    cols = np.asarray(task['columns'])
+    train_end, test_start, test_end = task['fold']
+
+    def rows(a, b):
+        Xs, ys = X[a:b][:, cols], y[a:b]
+        # Rows still missing a feature or the target (eg. before the first reading) are left out
+        valid = ~np.isnan(Xs).any(axis=1) & ~np.isnan(ys)
+        return Xs[valid], ys[valid]
+
+    X_train, y_train = rows(0, train_end)
+    X_test, y_test = rows(test_start, test_end)
+    if len(y_train) == 0 or len(y_test) == 0:
+        return {'r2': None, 'rmse': None, 'mae': None, 'n_train': len(y_train), 'n_test': len(y_test), 'seconds': 0.0}
+
+    model = MODELS[task['model']](**task['params'], random_state=task['seed'], n_jobs=1)
+    model.fit(X_train, y_train)
+    pred = model.predict(X_test)
+    return {
+        'r2': float(r2_score(y_test, pred)),
+        'rmse': float(np.sqrt(mean_squared_error(y_test, pred))),
+        'mae': float(mean_absolute_error(y_test, pred)),
+        'n_train': int(len(y_train)),
+        'n_test': int(len(y_test)),
+        'seconds': round(time.time() - start, 3),
+    }
+
+class ModelSearch():
+    """
+    Rolling-origin cross-validation of feature sets x hyperparameter grids, with fits spread over a
+    process pool and finished folds cached on disk.
+    """
+
+    def __init__(self, matrix, grid=None, model='random_forest', n_splits=5, test_size=None, gap='0h', min_train=None,
+                 cache_dir='./data/models/cache/', max_workers=None, seed=0):
+        """
+        Parameters:
+            matrix: FeatureMatrix - Shared feature matrix.
+            grid: dict - Hyperparameter grid, eg. {'n_estimators': [100, 300], 'max_depth': [None, 20]}.
+            model: String - Key of MODELS.
+            n_splits: int - Number of rolling-origin folds.
+            test_size: String - Length of each test period, see rolling_origin_folds(...).
+            gap: String - Period left out between training and test rows.
+            min_train: String - Length of the first training period.
+            cache_dir: String - Where finished folds are cached (None disables the cache).
+            max_workers: int - Worker processes, defaults to the number of cores.
+            seed: int - Random state of every model.
+        """
+        if model not in MODELS:
+            raise ValueError(f"Unknown model {model}, expected one of {list(MODELS)}.")
+        self.matrix = matrix
+        self.grid = list(ParameterGrid(grid or {}))
+        self.model = model
+        self.folds = rolling_origin_folds(matrix.times, n_splits, test_size, gap, min_train)
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.seed = seed
+
+    def tasks(self, feature_sets=None):
+        """
+        Helper function. One task per feature set x parameters x fold.
+        """
+        names = feature_sets or list(self.matrix.feature_sets)
+        tasks = []
+        for name in names:
+            for params in self.grid:
+                for k, fold in enumerate(self.folds):
+                    tasks.append({'path': self.matrix.path, 'feature_set': name, 'columns': self.matrix.feature_sets[name],
+                                  'params': params, 'fold': fold, 'fold_index': k, 'model': self.model, 'seed': self.seed})
+        return tasks
+
+    def cache_path(self, task):
+        """
+        Helper function. Cache file of a task, keyed by the matrix contents, columns, fold, model and parameters.
+        """
+        key = json.dumps({'matrix': self.matrix.fingerprint, 'columns': task['columns'], 'fold': task['fold'],
+                          'model': task['model'], 'params': task['params'], 'seed': task['seed']}, sort_keys=True, default=str)
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def run(self, feature_sets=None):
+        """
+        Evaluate every feature set x parameters x fold, reusing cached folds.
+
+        Parameters:
+            feature_sets: [String] - Names of matrix.feature_sets to evaluate, defaults to all of them.
+
+        Returns:
+            pd.DataFrame - One row per fold with its scores.
+        """
+        tasks = self.tasks(feature_sets)
+        results = [None] * len(tasks)
+        todo = []
+        for i, task in enumerate(tasks):
+            path = self.cache_path(task) if self.cache_dir else None
+            if path and os.path.exists(path):
+                with open(path, 'r') as f:
+                    results[i] = {**json.load(f), 'cached': True}
+            else:
+                todo.append(i)
+        print(f"{len(tasks)} fits, {len(tasks) - len(todo)} cached.")
+
+        if todo:
+            if self.cache_dir:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                for i, result in zip(todo, executor.map(fit_fold, [tasks[i] for i in todo])):
+                    results[i] = {**result, 'cached': False}
+                    if self.cache_dir:
+                        with open(self.cache_path(tasks[i]), 'w') as f:
+                            json.dump(result, f)
+
+        rows = []
+        for task, result in zip(tasks, results):
+            train_end, test_start, test_end = task['fold']
+            rows.append({'feature_set': task['feature_set'], 'params': json.dumps(task['params'], sort_keys=True),
+                         'fold': task['fold_index'], 'test_start': pd.Timestamp(self.matrix.times[test_start]),
+                         'test_end': pd.Timestamp(self.matrix.times[test_end - 1]), **result})
+        return pd.DataFrame(rows)
+
+    def summary(self, results, metric='r2'):
+        """
+        Mean and spread of a metric over folds for every feature set and parameters, best first.
+        """
+        grouped = results.groupby(['feature_set', 'params'])[metric]
+        summary = grouped.agg(['mean', 'std', 'count']).rename(columns={'mean': metric, 'std': metric + '_std', 'count': 'folds'})
+        return summary.sort_values(metric, ascending=(metric != 'r2'))
@@ -0,0 +1,82 @@
+import difflib
+
+class ParameterIndex():
+    """
+    Two-way in-memory index between AQS parameter names and codes.
+    """
+
+    def __init__(self, records):
+        """
+        Parameters:
+            records: [dict] - AQS list records with 'code' and 'value_represented' keys.
+        """
+        self.code_to_name = {}
+        self.name_to_code = {}
+        self.folded_to_code = {}
+        for record in records:
+            code, name = str(record['code']), record['value_represented']
+            self.code_to_name[code] = name
+            # Keep the first code seen for a name, like the old DataFrame scan did
+            self.name_to_code.setdefault(name, code)
+            self.folded_to_code.setdefault(self.fold(name), code)
+
+    def fold(self, name):
+        """
+        Helper function. Normalised form used for case-insensitive lookups.
+        """
+        return ' '.join(name.split()).casefold()
+
+    def code(self, name, fuzzy=False, cutoff=0.8):
+        """
+        Find the code for a parameter name. Tries an exact match, then a case-insensitive one,
+        then (if fuzzy) the closest name.
+
+        Parameters:
+            name: String - Name to search for.
+            fuzzy: bool - Whether to fall back to the closest name.
+            cutoff: float - Minimum similarity (0 to 1) for a fuzzy match.
+
+        Returns:
+            code: String - The code, or None if nothing matched.
+        """
+        if name in self.name_to_code:
+            return self.name_to_code[name]
+        folded = self.fold(name)
+        if folded in self.folded_to_code:
+            return self.folded_to_code[folded]
+        if fuzzy:
+            matches = difflib.get_close_matches(folded, self.folded_to_code, n=1, cutoff=cutoff)
+            if matches:
+                return self.folded_to_code[matches[0]]
+        return None
+
+    def codes(self, names, fuzzy=False, cutoff=0.8):
+        """
+        Batch version of code(...).
+
+        Returns:
+            [String] - Codes in the same order as names (None where nothing matched).
+        """
+        return [self.code(name, fuzzy=fuzzy, cutoff=cutoff) for name in names]
+
+    def name(self, code):
+        """
+        Inverse of code(...). Accepts codes as strings or ints.
+        """
+        return self.code_to_name.get(str(code))
+
+    def names(self, codes):
+        """
+        Batch version of name(...).
+        """
+        return [self.name(code) for code in codes]
+
+    def search(self, name, n=5, cutoff=0.6):
+        """
+        Closest parameter names to name, best first.
+
+        Returns:
+            [(String, String)] - (name, code) pairs.
+        """
+        matches = difflib.get_close_matches(self.fold(name), self.folded_to_code, n=n, cutoff=cutoff)
+        return [(self.code_to_name[self.folded_to_code[m]], self.folded_to_code[m]) for m in matches]
@@ -1,13 +1,113 @@
 import pandas as pd
 import numpy as np
 
+from aqs_stream import SITE_COLUMNS, site_labels
+from metrics import METRICS, timed
+
+# Raw AQS fields process_batch(...) needs. Everything else in a sampleData record is left out when building the frame.
+BATCH_COLUMNS = ['date_local', 'time_local', 'sample_measurement', 'parameter_code', 'parameter', 'method', 'poc', 'date_of_last_change', 'units_of_measure']
+
+# Raw AQS fields locating the site of a record, kept in Processor.site_coordinates
+LOCATION_COLUMNS = SITE_COLUMNS + ['latitude', 'longitude']
+
+# How to resolve several readings of one parameter at the same timestamp:
+#   mean   - average co-located monitors / methods
+#   poc    - prefer the given POC (falls back to the lowest POC)
+#   method - prefer the given method (falls back to the first one reported)
+#   latest - keep the reading with the latest date_of_last_change
+#   first  - keep the first reading returned by AQS
+DUPLICATE_POLICIES = ['mean', 'poc', 'method', 'latest', 'first']
+
+# How fill_gaps(...) fills gaps of at most max_gap hours (longer gaps stay NaN):
+#   linear  - straight line between the readings on either side of the gap
+#   diurnal - hour-of-day climatology of the column (per month where the month has enough data),
+#             shifted to meet the readings on either side of the gap
+#   none    - no filling, only the coverage report
+GAP_METHODS = ['linear', 'diurnal', 'none']
+
+# Valid readings an (hour of day, month) slot needs before the diurnal climatology uses it
+MIN_CLIMATOLOGY_COUNT = 5
+
 class Processor():
     """
     Class to preprocess AQS data in specified format to feed into models.
     """
     
     def __init__(self):
-        pass
+        # Summary of the last duplicate resolution, see resolve_duplicates(...)
+        self.duplicate_report = None
+        # Coordinates of the sites in the last processed records, see record_coordinates(...) and site_coordinates
+        self._site_coordinates = None
+        # Location columns of the last records, labelled on first use of site_coordinates
+        self.pending_locations = None
+        # Units of the parameters in the last processed records, see record_units(...)
+        self.units = {}
+        # Coverage of the last frame passed through fill_gaps(...)
+        self.gap_report = None
+
+    @property
+    def site_coordinates(self):
+        """
+        Coordinates of the sites in the last processed records, a frame indexed by '<state>-<county>-<site>'.
+        Records deferred by process(...) and process_batch(...) are only labelled when this is first read.
+        """
+        if self.pending_locations is not None:
+            locations, self.pending_locations = self.pending_locations, None
+            self.record_coordinates(locations)
+        return self._site_coordinates
+
+    @site_coordinates.setter
+    def site_coordinates(self, value):
+        self.pending_locations = None
+        self._site_coordinates = value
+
+    def defer_coordinates(self, df):
+        """
+        Helper function. Keep the location columns of raw records for record_coordinates(...), which then
+        only runs if site_coordinates is read (eg. by generate.py or DataFetcher.build_site_index).
+        """
+        self.site_coordinates = None
+        if all(col in df.columns for col in LOCATION_COLUMNS) and len(df):
+            self.pending_locations = df[LOCATION_COLUMNS]
+
+    def record_coordinates(self, df):
+        """
+        Keep the latitude and longitude of every site in raw records (the processed frames drop them) in
+        self.site_coordinates, a frame indexed by '<state>-<county>-<site>'. Used to build a spatial.SiteIndex.
+        """
+        if not all(col in df.columns for col in LOCATION_COLUMNS) or df.empty:
+            self.site_coordinates = None
+            return None
+        # Every site reports the same few coordinates, so only the distinct rows are labelled
+        unique = df.drop_duplicates(LOCATION_COLUMNS)
+        coords = pd.DataFrame({
+            'site': site_labels(unique),
+            'latitude': pd.to_numeric(unique['latitude'], errors='coerce').to_numpy(),
+            'longitude': pd.to_numeric(unique['longitude'], errors='coerce').to_numpy(),
+        })
+        self.site_coordinates = coords.dropna().drop_duplicates('site').set_index('site')
+        return self.site_coordinates
+
+    def record_units(self, df, names=None):
+        """
+        Keep the units of every parameter in raw records in self.units, {column name: units_of_measure},
+        for DatasetStore.write(..., units=...).
+
+        Parameters:
+            df: pd.DataFrame - Raw sampleData records.
+            names: dict - {parameter code: column name}. Defaults to the AQS 'parameter' field.
+        """
+        if df.empty or 'units_of_measure' not in df.columns:
+            self.units = {}
+            return self.units
+        firsts = df.drop_duplicates('parameter_code')
+        codes = firsts['parameter_code'].astype(str)
+        if names is None:
+            labels = firsts['parameter'] if 'parameter' in firsts.columns else codes
+            names = dict(zip(codes, labels))
+        names = {str(k): v for k, v in names.items()}
+        self.units = {names[code]: unit for code, unit in zip(codes, firsts['units_of_measure']) if code in names and unit is not None}
+        return self.units
 
     def project_unique(self, df, measurement, verbose=False):
         """
@@ -19,7 +119,7 @@ class Processor():
         
         # Keep only variables we care about (changing) 
         df = df[kept_cols.keys()].copy()
-        df['datetime'] = pd.to_datetime(df['date_local'] + ' ' + df['time_local'])
+        df['datetime'] = self.parse_datetimes(df)
         df.set_index('datetime', inplace=True)
         df = df.drop(['date_gmt', 'time_gmt', 'date_local', 'time_local'], axis=1)
 
@@ -39,18 +139,330 @@ class Processor():
 
         return df
     
-    def process(self, df, measurement, change_freq=False, select_method=False, drop_lat_lon=True, remove_duplicates=False):
+    def parse_datetimes(self, df, date_col='date_local', time_col='time_local'):
+        """
+        Fixed-format fast path for AQS timestamps ('YYYY-MM-DD' and 'HH:MM'). Every distinct date and
+        time string is parsed once and broadcast back to the rows, instead of concatenating strings per row.
+
+        Returns:
+            np.ndarray of datetime64[ns].
+        """
+        dates = pd.Categorical(df[date_col])
+        times = pd.Categorical(df[time_col])
+        date_values = pd.to_datetime(dates.categories, format='%Y-%m-%d').values.astype('datetime64[ns]')
+        time_values = pd.to_timedelta(times.categories + ':00').values.astype('timedelta64[ns]')
+        return date_values[dates.codes] + time_values[times.codes]
+
+    def duplicate_ranks(self, df, policy, poc=None, method=None):
+        """
+        Helper function. Sort keys that put the reading preferred by policy first within each duplicate group.
+
+        Returns:
+            [np.ndarray] - Rank arrays, most significant first (empty for 'first').
+        """
+        if policy == 'poc':
+            pocs = pd.to_numeric(df['poc'], errors='coerce').to_numpy()
+            preferred = pocs != float(poc) if poc is not None else np.zeros(len(df), dtype=bool)
+            return [preferred, pocs]
+        if policy == 'method':
+            return [(df['method'] != method).to_numpy()]
+        if policy == 'latest':
+            changed = pd.to_datetime(df['date_of_last_change'], errors='coerce').to_numpy().astype('datetime64[ns]')
+            # Newest first, with missing change dates last
+            return [-changed.astype('int64').clip(min=0)]
+        if policy == 'first':
+            return []
+        raise ValueError(f"Unknown duplicate policy {policy}, expected one of {DUPLICATE_POLICIES}.")
+
+    def duplicate_mask(self, keys, ranks):
+        """
+        Helper function. Boolean mask keeping exactly one row per key, the one with the lowest ranks.
+
+        Parameters:
+            keys: [np.ndarray] - Arrays identifying a reading (eg. parameter and timestamp).
+            ranks: [np.ndarray] - Output of duplicate_ranks(...).
+        """
+        # lexsort sorts by the last array first; the original position breaks remaining ties
+        order = np.lexsort([np.arange(len(keys[0])), *reversed(ranks), *reversed(keys)])
+        sorted_keys = [k[order] for k in keys]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.logical_or.reduce([k[1:] != k[:-1] for k in sorted_keys])
+        mask = np.zeros(len(order), dtype=bool)
+        mask[order[first]] = True
+        return mask
+
+    def report_duplicates(self, policy, params, duplicated):
+        """
+        Helper function. Stores a summary of a duplicate resolution in self.duplicate_report.
+
+        Parameters:
+            policy: String - Policy that was applied.
+            params: np.ndarray - Parameter (or column) label of every row.
+            duplicated: np.ndarray - Boolean, True for rows that were dropped or merged into another row.
+        """
+        counts = pd.Series(duplicated).groupby(np.asarray(params)).sum()
+        n = int(duplicated.sum())
+        self.duplicate_report = {
+            'policy': policy,
+            'rows': int(len(duplicated)),
+            'dropped': 0 if policy == 'mean' else n,
+            'merged': n if policy == 'mean' else 0,
+            'by_parameter': {str(k): int(v) for k, v in counts.items() if v},
+        }
+        return self.duplicate_report
+
+    def resolve_duplicates(self, df, policy='mean', key='datetime', label=None, poc=None, method=None):
+        """
+        Resolve readings that share a timestamp with vectorised group-by operations. A summary of what
+        was dropped or merged is stored in self.duplicate_report.
+
+        Parameters:
+            df: pd.DataFrame - Frame with a key column (and poc/method/date_of_last_change as the policy needs).
+            policy: String - One of DUPLICATE_POLICIES.
+            key: String - Column identifying a reading.
+            label: String - Name used for this frame in the report. Defaults to the AQS 'parameter' field.
+            poc: int - Preferred POC for the 'poc' policy.
+            method: String - Preferred method for the 'method' policy.
+
+        Returns:
+            pd.DataFrame with one row per key.
+        """
+        keys = df[key].to_numpy()
+        if label is None:
+            label = df['parameter'].iloc[0] if 'parameter' in df.columns and len(df) else 'all'
+        labels = np.full(len(df), label, dtype=object)
+
+        if policy == 'mean':
+            duplicated = df.duplicated(subset=key).to_numpy()
+            self.report_duplicates(policy, labels, duplicated)
+            if not duplicated.any():
+                return df
+            agg = {col: 'mean' if pd.api.types.is_numeric_dtype(df[col]) else 'first' for col in df.columns if col != key}
+            return df.groupby(key, sort=False, as_index=False).agg(agg)
+
+        mask = self.duplicate_mask([keys], self.duplicate_ranks(df, policy, poc, method))
+        self.report_duplicates(policy, labels, ~mask)
+        return df.loc[mask]
+
+    @timed('process_batch')
+    def process_batch(self, records, names=None, select_method=False, freq='1h', duplicate_policy='mean', poc=None, method=None):
+        """
+        Single-pass processing of raw AQS records for many parameters at once. Timestamps are parsed
+        with parse_datetimes(...), duplicate readings are resolved with duplicate_policy, and the records
+        are binned straight into a wide matrix with one row per period and one column per parameter.
+        Readings left in the same period (eg. sub-hourly samples) are averaged. This replaces the
+        process(...) -> join(...) chain.
+
+        Parameters:
+            records: [dict] or pd.DataFrame - Raw sampleData records (any number of parameters).
+            names: dict - {parameter code: column name}. Defaults to the AQS 'parameter' field. Also fixes column order.
+            select_method: bool - Keep only the first method reported for each parameter.
+            freq: String - Period of the output index.
+            duplicate_policy: String - One of DUPLICATE_POLICIES, see resolve_duplicates(...).
+            poc: int - Preferred POC for the 'poc' policy.
+            method: String - Preferred method for the 'method' policy.
+
+        Returns:
+            pd.DataFrame indexed by datetime, one column per parameter with data.
+        """
+        df = records if isinstance(records, pd.DataFrame) else pd.DataFrame(records, columns=BATCH_COLUMNS + LOCATION_COLUMNS)
+        METRICS.add_rows('process_batch', len(df))
+        self.defer_coordinates(df)
+        if df.empty:
+            self.units = {}
+            return pd.DataFrame()
+
+        params = df['parameter_code'].astype(str)
+        if names is None:
+            pairs = pd.DataFrame({'code': params, 'name': df['parameter']}).drop_duplicates('code')
+            names = dict(zip(pairs['code'], pairs['name']))
+        names = {str(k): v for k, v in names.items()}
+        self.record_units(df, names)
+
+        binned = self.bin_records(df, names, select_method, freq, duplicate_policy, poc, method)
+        if binned is None:
+            return pd.DataFrame()
+        return self.binned_frame(names, freq, *binned)
+
+    def bin_records(self, df, names, select_method=False, freq='1h', duplicate_policy='mean', poc=None, method=None):
+        """
+        Helper function. Resolve duplicates and bin readings into per-period sums and counts.
+
+        Parameters:
+            df: pd.DataFrame - Raw sampleData records.
+            names: dict - {parameter code (String): column name}.
+
+        Returns:
+            (int, np.ndarray, np.ndarray) - First period (in units of freq since the epoch), and sums and
+            counts of shape (periods, len(names)). None if no reading is left.
+        """
+        params = df['parameter_code'].astype(str)
+
+        # Column of every row (-1 for parameters not in names)
+        param_codes, param_uniques = pd.factorize(params)
+        col_pos = {p: i for i, p in enumerate(names)}
+        col_of_param = np.array([col_pos.get(p, -1) for p in param_uniques], dtype=np.int32)
+        cols = col_of_param[param_codes]
+        keep = cols >= 0
+        if select_method:
+            method_codes, _ = pd.factorize(df['method'])
+            _, first_rows = np.unique(param_codes, return_index=True)
+            keep &= method_codes == method_codes[first_rows][param_codes]
+
+        datetimes = self.parse_datetimes(df)[keep]
+        values = pd.to_numeric(df['sample_measurement'], errors='coerce').to_numpy(dtype=float)[keep]
+        cols = cols[keep]
+        if len(values) == 0:
+            return None
+
+        # Duplicates are (parameter, timestamp) pairs. 'mean' needs no work here since binning averages them.
+        labels = np.array(list(names.values()), dtype=object)[cols]
+        if duplicate_policy == 'mean':
+            order = np.lexsort([datetimes.astype('int64'), cols])
+            duplicated = np.zeros(len(order), dtype=bool)
+            duplicated[order[1:]] = (cols[order][1:] == cols[order][:-1]) & (datetimes[order][1:] == datetimes[order][:-1])
+            self.report_duplicates(duplicate_policy, labels, duplicated)
+        else:
+            ranks = [r[keep] for r in self.duplicate_ranks(df, duplicate_policy, poc, method)]
+            mask = self.duplicate_mask([cols, datetimes.astype('int64')], ranks)
+            self.report_duplicates(duplicate_policy, labels, ~mask)
+            datetimes, values, cols = datetimes[mask], values[mask], cols[mask]
+
+        # Bin every reading into its period and accumulate with two bincounts (sum and count)
+        step = pd.Timedelta(freq).value
+        bins = datetimes.astype('int64') // step
+        start = bins.min()
+        n_rows, n_cols = bins.max() - start + 1, len(names)
+        flat = (bins - start) * n_cols + cols
+        valid = ~np.isnan(values)
+        sums = np.bincount(flat[valid], weights=values[valid], minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+        counts = np.bincount(flat[valid], minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+        return int(start), sums, counts
+
+    def binned_frame(self, names, freq, start, sums, counts):
+        """
+        Helper function. Wide frame of the period averages from bin_records(...), without empty columns.
+        """
+        step = pd.Timedelta(freq).value
+        with np.errstate(invalid='ignore', divide='ignore'):
+            matrix = sums / counts
+
+        present = counts.any(axis=0)
+        index = pd.date_range(start=pd.Timestamp(start * step), periods=len(sums), freq=freq, name='datetime')
+        columns = [name for name, p in zip(names.values(), present) if p]
+        return pd.DataFrame(matrix[:, present], index=index, columns=columns)
+
+    def merge_bins(self, acc, start, sums, counts):
+        """
+        Helper function. Add binned sums and counts into an accumulator (start, sums, counts), growing it as needed.
+        """
+        if acc is None:
+            return start, sums, counts
+        acc_start, acc_sums, acc_counts = acc
+        first = min(acc_start, start)
+        last = max(acc_start + len(acc_sums), start + len(sums))
+        if first != acc_start or last != acc_start + len(acc_sums):
+            grown_sums = np.zeros((last - first, sums.shape[1]))
+            grown_counts = np.zeros((last - first, sums.shape[1]), dtype=acc_counts.dtype)
+            grown_sums[acc_start - first:acc_start - first + len(acc_sums)] = acc_sums
+            grown_counts[acc_start - first:acc_start - first + len(acc_sums)] = acc_counts
+            acc_sums, acc_counts = grown_sums, grown_counts
+        acc_sums[start - first:start - first + len(sums)] += sums
+        acc_counts[start - first:start - first + len(sums)] += counts
+        return first, acc_sums, acc_counts
+
+    @timed('process_stream')
+    def process_stream(self, chunks, names, freq='1h', by_site=True, duplicate_policy='mean', poc=None, method=None):
+        """
+        process_batch(...) over a stream of record chunks (eg. DataFetcher.stream_data(...)). Only the
+        per-period sums and counts are kept between chunks, so memory is bounded by the size of the
+        output rather than of the query. Duplicates are resolved within each chunk; readings of the same
+        period in different chunks are averaged.
+
+        Parameters:
+            chunks: iterable of pd.DataFrame - Raw sampleData records.
+            names: dict - {parameter code: column name}. Fixes the columns of every output frame.
+            freq: String - Period of the output index.
+            by_site: bool - Keep one frame per site instead of averaging sites together.
+            duplicate_policy: String - One of DUPLICATE_POLICIES, see resolve_duplicates(...).
+            poc: int - Preferred POC for the 'poc' policy.
+            method: String - Preferred method for the 'method' policy.
+
+        Returns:
+            dict - {'<state>-<county>-<site>': pd.DataFrame} if by_site, otherwise a single pd.DataFrame.
+        """
+        names = {str(k): v for k, v in names.items()}
+        accumulators, reports, coordinates, units = {}, [], [], {}
+        for df in chunks:
+            METRICS.add_rows('process_stream', len(df))
+            if df.empty:
+                continue
+            coordinates.append(self.record_coordinates(df))
+            units.update(self.record_units(df, names))
+            if by_site:
+                labels = site_labels(df)
+                groups = pd.Series(labels).groupby(labels).indices
+            else:
+                groups = {None: np.arange(len(df))}
+            for site, rows in groups.items():
+                binned = self.bin_records(df.iloc[rows], names, False, freq, duplicate_policy, poc, method)
+                if binned is not None:
+                    accumulators[site] = self.merge_bins(accumulators.get(site), *binned)
+                    reports.append(self.duplicate_report)
+        self.duplicate_report = self.merge_reports(reports)
+        coordinates = [c for c in coordinates if c is not None]
+        self.site_coordinates = pd.concat(coordinates).groupby(level=0).first() if coordinates else None
+        self.units = units
+
+        frames = {site: self.binned_frame(names, freq, *acc) for site, acc in accumulators.items()}
+        if by_site:
+            return frames
+        return frames.get(None, pd.DataFrame())
+
+    def merge_reports(self, reports):
+        """
+        Helper function. Sum several duplicate reports into one.
+        """
+        if not reports:
+            return None
+        by_parameter = {}
+        for report in reports:
+            for k, v in report['by_parameter'].items():
+                by_parameter[k] = by_parameter.get(k, 0) + v
+        return {
+            'policy': reports[0]['policy'],
+            'rows': sum(r['rows'] for r in reports),
+            'dropped': sum(r['dropped'] for r in reports),
+            'merged': sum(r['merged'] for r in reports),
+            'by_parameter': by_parameter,
+        }
+
+    @timed('process')
+    def process(self, df, measurement, change_freq=False, select_method=False, drop_lat_lon=True, remove_duplicates=False, duplicate_policy='mean', poc=None, method=None):
+        """
+        Turn the raw AQS frame of one parameter into a datetime indexed frame.
+
+        Parameters:
+            df: pd.DataFrame - Raw sampleData records for one parameter.
+            measurement: String - Name of the output column.
+            change_freq: bool - Forward fill to an hourly index.
+            select_method: bool - Keep only the first method reported.
+            drop_lat_lon: bool - Drop the latitude and longitude columns.
+            remove_duplicates: bool - Kept for backwards compatibility; duplicates are always resolved.
+            duplicate_policy: String - One of DUPLICATE_POLICIES, see resolve_duplicates(...).
+            poc: int - Preferred POC for the 'poc' policy.
+            method: String - Preferred method for the 'method' policy.
+        """
+        METRICS.add_rows('process', len(df))
+        self.defer_coordinates(df)
+        self.units = {measurement: df['units_of_measure'].iloc[0]} if 'units_of_measure' in df.columns and len(df) else {}
         if select_method:
             df = df.loc[df['method'] == df['method'].unique()[0]].copy()
-        df['datetime'] = pd.to_datetime(df['date_local'] + ' ' + df['time_local'])
+        df['datetime'] = self.parse_datetimes(df)
+
+        df = self.resolve_duplicates(df, duplicate_policy, label=measurement, poc=poc, method=method)
         df = df[['datetime', 'sample_measurement', 'latitude', 'longitude']]
         df = df.rename({'sample_measurement': measurement}, axis=1)
-
-        # TODO: Fix this, currently just select the first year period to avoid duplicate index, but this might select the wrong data
-        duplicates = df.duplicated(subset='datetime', keep='first')
-        duplicates = np.where(duplicates)[0]
-        if len(duplicates) > 0:
-            df = df.iloc[:duplicates[0]]
         
         df.set_index(['datetime'], inplace=True)
 
@@ -62,9 +474,217 @@ class Processor():
 
         return df
         
-    def join(self, dfs):
+    @timed('join')
+    def join(self, dfs, fill=None, max_gap=3):
+        """
+        Outer join per-parameter frames on an hourly index.
+
+        Parameters:
+            dfs: [pd.DataFrame] - Outputs of process(...).
+            fill: String - Optional gap method (see GAP_METHODS and fill_gaps(...)). Without it gaps stay NaN.
+            max_gap: int or dict - Longest gap (hours) to fill.
+        """
         df = dfs[0].join(dfs[1:], how='outer')
         df = df.drop([x for x in df.columns if (('latitude' in x) and (x != 'latitude'))], axis=1)
         df = df.drop([x for x in df.columns if (('longitude' in x) and (x != 'longitude'))], axis=1)
         df = df.resample('1h').mean()
-        return df
\ No newline at end of file
+        if fill is not None:
+            df = self.fill_gaps(df, method=fill, max_gap=max_gap, columns=[c for c in df.columns if c not in ['latitude', 'longitude']])
+        return df
+
+    def gap_runs(self, missing):
+        """
+        Run-length encode the gaps of every column of a 2D missing mask.
+
+        Parameters:
+            missing: np.ndarray - Boolean array of shape (hours, columns), True where a value is missing.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray) - Column, first row and length of every gap, ordered by column then row.
+        """
+        n, n_cols = missing.shape
+        edges = np.zeros((n_cols, n + 2), dtype=np.int8)
+        edges[:, 1:-1] = missing.T
+        steps = np.diff(edges, axis=1)
+        cols, starts = np.nonzero(steps == 1)
+        _, ends = np.nonzero(steps == -1)
+        return cols, starts, ends - starts
+
+    def gap_lengths(self, missing, runs=None):
+        """
+        Length of the gap every missing value belongs to (0 where the value is present), shape (hours, columns).
+        """
+        n, n_cols = missing.shape
+        cols, starts, lengths = runs if runs is not None else self.gap_runs(missing)
+        # +length at the start of every run and -length after its end, accumulated down each column
+        steps = np.zeros((n + 1, n_cols), dtype=np.int64)
+        np.add.at(steps, (starts, cols), lengths)
+        np.add.at(steps, (starts + lengths, cols), -lengths)
+        return np.cumsum(steps[:-1], axis=0)
+
+    def neighbours(self, values, missing):
+        """
+        Helper function. Row of the last valid value at or before, and the first valid value at or after,
+        every cell (-1 and len(values) where there is none).
+        """
+        n = len(values)
+        rows = np.arange(n)[:, None]
+        before = np.maximum.accumulate(np.where(missing, -1, rows), axis=0)
+        after = np.minimum.accumulate(np.where(missing, n, rows)[::-1], axis=0)[::-1]
+        return before, after
+
+    def climatology(self, values, missing, index):
+        """
+        Helper function. Diurnal climatology at every cell: the mean of the column at that hour of day in
+        that month, or at that hour of day over the whole frame where the month has too few readings.
+        """
+        hours = index.hour.to_numpy()
+        months = index.month.to_numpy() - 1
+        filled = np.where(missing, 0, values)
+        valid = (~missing).astype(float)
+
+        def slot_means(slots, n_slots):
+            sums = np.zeros((n_slots, values.shape[1]))
+            counts = np.zeros((n_slots, values.shape[1]))
+            np.add.at(sums, slots, filled)
+            np.add.at(counts, slots, valid)
+            return sums, counts
+
+        month_sums, month_counts = slot_means(months * 24 + hours, 12 * 24)
+        hour_sums, hour_counts = slot_means(hours, 24)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            monthly = month_sums / month_counts
+            hourly = hour_sums / hour_counts
+        slot = months * 24 + hours
+        return np.where(month_counts[slot] >= MIN_CLIMATOLOGY_COUNT, monthly[slot], hourly[hours])
+
+    @timed('fill_gaps')
+    def fill_gaps(self, df, method='linear', max_gap=3, columns=None):
+        """
+        Fill short gaps of an hourly frame and leave longer ones missing, instead of forward filling across
+        outages. Gaps are found with run-length encoding of the missing mask of all columns at once, and
+        every column is filled in a single 2D array, so the frame is copied once rather than per column.
+        A coverage report (see coverage_report(...)) is stored in self.gap_report.
+
+        Parameters:
+            df: pd.DataFrame - Frame indexed by datetime (eg. the output of join(...)). Missing hours are added.
+            method: String - One of GAP_METHODS.
+            max_gap: int or dict - Longest gap (hours) to fill, or {column: hours} (columns left out are not filled).
+            columns: [String] - Columns to fill, defaults to every numeric column.
+
+        Returns:
+            pd.DataFrame on a gapless hourly index.
+        """
+        if method not in GAP_METHODS:
+            raise ValueError(f"Unknown gap method {method}, expected one of {GAP_METHODS}.")
+        df = df.asfreq('1h') if len(df) > 1 else df
+        columns = list(columns) if columns is not None else [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+        values = df[columns].to_numpy(dtype=float, copy=True)
+        missing = np.isnan(values)
+        runs = self.gap_runs(missing)
+        lengths = self.gap_lengths(missing, runs)
+        limits = np.array([max_gap.get(col, 0) if isinstance(max_gap, dict) else max_gap for col in columns])
+
+        before, after = self.neighbours(values, missing)
+        n = len(values)
+        interior = (before >= 0) & (after < n)
+        fill = missing & (lengths <= limits) & (method != 'none')
+
+        if method == 'linear':
+            fill &= interior
+        if fill.any():
+            cols = np.arange(values.shape[1])
+            rows = np.arange(n)[:, None]
+            if method == 'diurnal':
+                base = self.climatology(values, missing, df.index)
+                anomaly = values - base
+            else:
+                base, anomaly = 0, values
+            # Anomaly on either side of every gap, held flat towards the ends of the frame
+            left = anomaly[np.clip(before, 0, n - 1), cols]
+            right = anomaly[np.clip(after, 0, n - 1), cols]
+            left = np.where(before >= 0, left, right)
+            right = np.where(after < n, right, left)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.where(interior, (rows - before) / (after - before), 0)
+            estimate = base + left + (right - left) * t
+            fill &= ~np.isnan(estimate)
+            values[fill] = estimate[fill]
+
+        self.gap_report = self.coverage_report(missing, df.index, columns, runs, filled=fill.sum(axis=0))
+        out = pd.DataFrame(values, index=df.index, columns=columns)
+        others = [c for c in df.columns if c not in columns]
+        if others:
+            out = out.join(df[others])[list(df.columns)]
+        return out
+
+    def coverage_report(self, missing, index=None, columns=None, runs=None, filled=None):
+        """
+        Compact per-column coverage summary, reusable for ranking sites (see rank_sites(...)).
+
+        Parameters:
+            missing: np.ndarray or pd.DataFrame - Missing mask of shape (hours, columns), or an hourly frame.
+            index: pd.DatetimeIndex - Hours of the mask (taken from the frame if one is given).
+            columns: [String] - Column names (taken from the frame if one is given).
+            runs: tuple - Output of gap_runs(missing), if already computed.
+            filled: np.ndarray - Values filled per column by fill_gaps(...).
+
+        Returns:
+            pd.DataFrame indexed by column: hours, valid, coverage, gaps, longest_gap, mean_gap, filled,
+            masked (missing hours left after filling), first and last valid hour.
+        """
+        if isinstance(missing, pd.DataFrame):
+            frame = missing.asfreq('1h') if len(missing) > 1 else missing
+            index, columns = frame.index, list(frame.columns)
+            missing = frame.isna().to_numpy()
+        n, n_cols = missing.shape
+        cols, starts, lengths = runs if runs is not None else self.gap_runs(missing)
+        gaps = np.bincount(cols, minlength=n_cols)
+        longest = np.zeros(n_cols, dtype=np.int64)
+        np.maximum.at(longest, cols, lengths)
+        gap_hours = np.bincount(cols, weights=lengths, minlength=n_cols)
+        valid = n - missing.sum(axis=0)
+        filled = filled if filled is not None else np.zeros(n_cols, dtype=np.int64)
+
+        present = ~missing
+        first = np.where(present.any(axis=0), present.argmax(axis=0), -1)
+        last = np.where(present.any(axis=0), n - 1 - present[::-1].argmax(axis=0), -1)
+        times = np.asarray(index) if index is not None else None
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame({
+                'hours': n,
+                'valid': valid,
+                'coverage': valid / n if n else np.zeros(n_cols),
+                'gaps': gaps,
+                'longest_gap': longest,
+                'mean_gap': np.where(gaps > 0, gap_hours / gaps, 0),
+                'filled': filled,
+                'masked': n - valid - filled,
+                'first': [times[i] if i >= 0 else pd.NaT for i in first] if times is not None else first,
+                'last': [times[i] if i >= 0 else pd.NaT for i in last] if times is not None else last,
+            }, index=pd.Index(columns if columns is not None else range(n_cols), name='column'))
+
+    def rank_sites(self, reports, columns=None, max_gap=None):
+        """
+        Rank sites by the coverage of the columns that matter, from their coverage reports.
+
+        Parameters:
+            reports: dict - {site: coverage_report(...)}.
+            columns: [String] - Columns to score, defaults to every column. Missing columns count as 0 coverage.
+            max_gap: int - Optional, sites with a longer gap in any scored column are ranked last.
+
+        Returns:
+            pd.DataFrame indexed by site with coverage (mean over columns), longest_gap and masked hours, best first.
+        """
+        rows = {}
+        for site, report in reports.items():
+            report = report.reindex(columns) if columns is not None else report
+            rows[site] = {
+                'coverage': report['coverage'].fillna(0).mean(),
+                'longest_gap': report['longest_gap'].max(),
+                'masked': report['masked'].sum(),
+            }
+        ranking = pd.DataFrame.from_dict(rows, orient='index')
+        ranking.index.name = 'site'
+        ranking['within_max_gap'] = ranking['longest_gap'] <= max_gap if max_gap is not None else True
+        return ranking.sort_values(['within_max_gap', 'coverage', 'longest_gap'], ascending=[False, False, True])
\ No newline at end of file
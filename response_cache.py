@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+DAY = 24 * 60 * 60
+
+# Time to live (seconds) for each endpoint family. Code lists barely change, so they are kept for a
+# long time. Sample data is kept until it is explicitly invalidated (e.g. when AQS revises it).
+ENDPOINT_TTLS = {
+    'list/': 30 * DAY,
+    'sampleData/': None,
+}
+DEFAULT_TTL = 7 * DAY
+
+# Agencies keep submitting and revising data for months, so responses whose edate is this recent
+# expire after RECENT_TTL whatever the endpoint's TTL
+RECENT_DAYS = 180
+RECENT_TTL = DAY
+
+# Several processes may share one cache file (see generate.py): seconds a connection waits for another
+# one's write lock, and how often a write is retried after that
+BUSY_TIMEOUT = 30
+WRITE_RETRIES = 5
+
+# Query parameters that never take part in the cache key
+CREDENTIALS = ('email', 'key')
+
+class ResponseCache():
+    """
+    Persistent, content-addressed cache for AQS responses, bounded by a byte budget with LRU eviction.
+    """
+
+    def __init__(self, path='./data/cache/aqs.sqlite', max_bytes=2 * 1024 ** 3, ttls=None):
+        """
+        Parameters:
+            path: String - Location of the sqlite file backing the cache.
+            max_bytes: int - Byte budget for stored (compressed) responses.
+            ttls: dict - Overrides for ENDPOINT_TTLS, keyed by endpoint prefix.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = {**ENDPOINT_TTLS, **(ttls or {})}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        # Readers do not block the writer, so worker processes can share the file
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, endpoint TEXT, created REAL, accessed REAL, size INTEGER, raw_size INTEGER, body BLOB, params TEXT)')
+        # Caches created before the query parameters were stored
+        if 'params' not in [row[1] for row in self.conn.execute('PRAGMA table_info(responses)')]:
+            self.conn.execute('ALTER TABLE responses ADD COLUMN params TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def public_params(self, params):
+        """
+        Helper function. Query parameters as strings, excluding credentials.
+        """
+        return {k: str(v) for k, v in params.items() if k not in CREDENTIALS and v is not None}
+
+    def make_key(self, endpoint, params):
+        """
+        Hash of the endpoint and its query parameters, excluding credentials.
+        """
+        blob = json.dumps({'endpoint': endpoint, 'params': self.public_params(params)}, sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def ttl(self, endpoint, params=None):
+        """
+        Time to live for endpoint, using the longest matching prefix in self.ttls. Queries ending
+        less than RECENT_DAYS ago are capped at RECENT_TTL.
+        """
+        matches = [prefix for prefix in self.ttls if endpoint.startswith(prefix)]
+        ttl = self.ttls[max(matches, key=len)] if matches else DEFAULT_TTL
+        edate = (params or {}).get('edate')
+        if edate is not None:
+            try:
+                recent = time.time() - time.mktime(time.strptime(str(edate), '%Y%m%d')) < RECENT_DAYS * DAY
+            except ValueError:
+                recent = False
+            if recent:
+                ttl = RECENT_TTL if ttl is None else min(ttl, RECENT_TTL)
+        return ttl
+
+    def get(self, endpoint, params):
+        """
+        Look up a cached response.
+
+        Returns:
+            dict - Decoded response, or None on a miss or an expired entry.
+        """
+        key = self.make_key(endpoint, params)
+        with self.lock:
+            row = self.conn.execute('SELECT created, raw_size, body FROM responses WHERE key = ?', (key,)).fetchone()
+            ttl = self.ttl(endpoint, params)
+            if row is None or (ttl is not None and time.time() - row[0] > ttl):
+                self.misses += 1
+                return None
+            try:
+                self.write(lambda: self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key)))
+            except sqlite3.OperationalError:
+                # Only the LRU order suffers, the entry itself is valid
+                pass
+            self.hits += 1
+            self.bytes_saved += row[1]
+        return json.loads(zlib.decompress(row[2]))
+
+    def put(self, endpoint, params, payload):
+        """
+        Store a decoded response, evicting the least recently used entries if over budget.
+        """
+        key = self.make_key(endpoint, params)
+        raw = json.dumps(payload).encode()
+        body = zlib.compress(raw)
+        now = time.time()
+        def insert():
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, endpoint, created, accessed, size, raw_size, body, params) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (key, endpoint, now, now, len(body), len(raw), body, json.dumps(self.public_params(params))))
+            self.evict()
+
+        with self.lock:
+            self.write(insert)
+
+    def write(self, fn):
+        """
+        Helper function. Run fn in one write transaction, retrying while other processes hold the write
+        lock. Must be called with self.lock held.
+        """
+        for attempt in range(WRITE_RETRIES):
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+                result = fn()
+                self.conn.commit()
+                return result
+            except sqlite3.OperationalError as e:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                if 'locked' not in str(e) or attempt == WRITE_RETRIES - 1:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+
+    def evict(self):
+        """
+        Helper function. Drops least recently used entries until the cache fits its byte budget.
+        Must be called inside write(...). The usage is read from the file, so entries written by other
+        processes count towards the budget too.
+        """
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while self.total_bytes > self.max_bytes:
+            row = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 1').fetchone()
+            if row is None:
+                break
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (row[0],))
+            self.total_bytes -= row[1]
+            self.evictions += 1
+
+    def invalidate(self, endpoint=None, params=None, where=None):
+        """
+        Remove entries. Drops one entry if params is given, the entries for endpoint whose parameters
+        satisfy where if it is given, every entry for endpoint if only endpoint is given, and the whole
+        cache otherwise.
+
+        Parameters:
+            endpoint: String - Endpoint of the entries.
+            params: dict - Query parameters of a single entry.
+            where: function - Called with the (string) query parameters of every entry of endpoint. Entries
+                              stored without their parameters are dropped too, since they cannot be checked.
+        """
+        def delete():
+            if params is not None:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (self.make_key(endpoint, params),))
+            elif where is not None:
+                rows = self.conn.execute('SELECT key, params FROM responses WHERE endpoint = ?', (endpoint,)).fetchall()
+                stale = [(key,) for key, stored in rows if stored is None or where(json.loads(stored))]
+                self.conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+            elif endpoint is not None:
+                self.conn.execute('DELETE FROM responses WHERE endpoint = ?', (endpoint,))
+            else:
+                self.conn.execute('DELETE FROM responses')
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        with self.lock:
+            self.write(delete)
+
+    def stats(self):
+        """
+        Returns:
+            dict - Hits, misses, bytes saved (uncompressed response bytes served from disk) and current usage.
+        """
+        with self.lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes_used': self.total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from aqs_stream import site_labels
+
+# Mean Earth radius (km)
+EARTH_RADIUS_KM = 6371.0088
+
+def unit_vectors(lats, lons):
+    """
+    Points on the unit sphere for latitudes and longitudes in degrees, shape (n, 3). Euclidean distance
+    between them (the chord) grows monotonically with great-circle distance, so a KD-tree over them
+    answers great-circle nearest neighbour and radius queries exactly.
+    """
+    lat, lon = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+def km_to_chord(km):
+    return 2 * np.sin(np.minimum(np.asarray(km, dtype=float), np.pi * EARTH_RADIUS_KM) / (2 * EARTH_RADIUS_KM))
+
+def inverse_distance_weights(km, power=2):
+    """
+    Weights 1 / d^power of sites at distances km (closest first). A site at the point itself
+    (within a metre) takes all the weight.
+    """
+    km = np.asarray(km, dtype=float)
+    if len(km) and km[0] < 1e-3:
+        return (km < 1e-3).astype(float)
+    return 1 / km ** power
+
+class SiteIndex():
+    """
+    KD-tree over monitoring site coordinates, for nearest-site and radius queries across counties,
+    states or the whole country, and distance-weighted aggregates of several sites.
+    """
+
+    def __init__(self, sites):
+        """
+        Parameters:
+            sites: pd.DataFrame - Indexed by site label, with latitude and longitude columns (and optionally name).
+        """
+        sites = sites.loc[sites['latitude'].notna() & sites['longitude'].notna()]
+        self.sites = sites[~sites.index.duplicated()]
+        self.labels = self.sites.index.to_numpy()
+        self.lats = self.sites['latitude'].to_numpy(dtype=float)
+        self.lons = self.sites['longitude'].to_numpy(dtype=float)
+        self.tree = cKDTree(unit_vectors(self.lats, self.lons))
+        self.positions = {label: i for i, label in enumerate(self.labels)}
+        # CEDS cell of every site, per grid (see ceds_cells)
+        self.cells = {}
+
+    @classmethod
+    def from_records(cls, records, names=None):
+        """
+        Index the sites of AQS records carrying site codes and coordinates (eg. sampleData or monitors/ results).
+
+        Parameters:
+            records: [dict] or pd.DataFrame - Records with state_code, county_code, site_number, latitude and longitude.
+            names: dict - Optional {'<state>-<county>-<site>': name}, eg. from list/sitesByCounty.
+        """
+        df = records if isinstance(records, pd.DataFrame) else pd.DataFrame(records)
+        if df.empty:
+            return cls(pd.DataFrame(columns=['latitude', 'longitude', 'name']))
+        sites = pd.DataFrame({
+            'site': site_labels(df),
+            'latitude': pd.to_numeric(df['latitude'], errors='coerce').to_numpy(),
+            'longitude': pd.to_numeric(df['longitude'], errors='coerce').to_numpy(),
+        }).dropna().drop_duplicates('site').set_index('site')
+        if names:
+            sites['name'] = sites.index.map(names)
+        elif 'local_site_name' in df.columns:
+            sites['name'] = sites.index.map(dict(zip(site_labels(df), df['local_site_name'])))
+        return cls(sites)
+
+    @classmethod
+    def from_store(cls, store, kind='core'):
+        """
+        Index the sites of a DatasetStore whose partitions recorded their coordinates.
+        """
+        rows = {meta['site']: (meta['latitude'], meta['longitude']) for meta in store.partitions(kind=kind)
+                if meta.get('latitude') is not None and meta.get('longitude') is not None}
+        return cls(pd.DataFrame.from_dict(rows, orient='index', columns=['latitude', 'longitude']).rename_axis('site'))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def coordinates(self, site):
+        """
+        (lat, lon) of a site.
+        """
+        if site not in self.positions:
+            raise KeyError(f"Site {site} is not in the index.")
+        i = self.positions[site]
+        return float(self.lats[i]), float(self.lons[i])
+
+    def result_frame(self, idx, chords):
+        """
+        Helper function. Sites and distances of query results, closest first.
+        """
+        return pd.DataFrame({'site': self.labels[idx], 'distance_km': chord_to_km(chords)})
+
+    def nearest(self, lat, lon, k=5, max_km=None):
+        """
+        The k sites closest to a point.
+
+        Parameters:
+            lat: float - Latitude.
+            lon: float - Longitude.
+            k: int - Number of sites.
+            max_km: float - Ignore sites further than this.
+
+        Returns:
+            pd.DataFrame - Columns site and distance_km, closest first.
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return self.result_frame(np.array([], dtype=int), np.array([]))
+        bound = km_to_chord(max_km) if max_km is not None else np.inf
+        chords, idx = self.tree.query(unit_vectors(lat, lon), k=k, distance_upper_bound=bound)
+        chords, idx = np.atleast_1d(chords), np.atleast_1d(idx)
+        found = idx < len(self)
+        return self.result_frame(idx[found], chords[found])
+
+    def neighbours(self, site, k=5, max_km=None):
+        """
+        The k sites closest to a site of the index, leaving the site itself out.
+        """
+        res = self.nearest(*self.coordinates(site), k=k + 1, max_km=max_km)
+        return res.loc[res['site'] != site].head(k).reset_index(drop=True)
+
+    def within(self, lat, lon, km):
+        """
+        Every site within km of a point, closest first.
+        """
+        point = unit_vectors(lat, lon)
+        idx = np.asarray(self.tree.query_ball_point(point, km_to_chord(km)), dtype=int)
+        chords = np.linalg.norm(self.tree.data[idx] - point, axis=1)
+        order = np.argsort(chords, kind='stable')
+        return self.result_frame(idx[order], chords[order])
+
+    def nearest_many(self, lats, lons, k=1):
+        """
+        Nearest k sites of many points in one query.
+
+        Returns:
+            (np.ndarray, np.ndarray) - Site labels and distances (km), of shape (points, k).
+        """
+        k = min(k, len(self))
+        chords, idx = self.tree.query(unit_vectors(lats, lons), k=k)
+        chords, idx = chords.reshape(len(idx), k), idx.reshape(len(idx), k)
+        return self.labels[idx], chord_to_km(chords)
+
+    def idw_weights(self, lat, lon, k=5, power=2, max_km=None):
+        """
+        Inverse distance weights of the k sites nearest to a point.
+
+        Returns:
+            pd.Series - Weights summing to 1, indexed by site.
+        """
+        res = self.nearest(lat, lon, k=k, max_km=max_km)
+        w = inverse_distance_weights(res['distance_km'], power)
+        return pd.Series(w / w.sum() if len(w) else w, index=res['site'].to_numpy())
+
+    def aggregate(self, values, lat, lon, k=5, power=2, max_km=None, min_sites=1, exclude=None):
+        """
+        Inverse distance weighted estimate of a parameter at a point from the surrounding sites. Every hour
+        uses the sites with a value at that hour, with their weights rescaled to sum to 1. Hours where a site
+        at the point itself (within a metre) has a value use that value; other hours fall back to the
+        remaining sites.
+
+        Parameters:
+            values: pd.DataFrame - One column per site on a shared hourly index (see site_matrix(...)).
+            lat: float - Latitude of the point.
+            lon: float - Longitude of the point.
+            k: int - Number of sites to combine (only sites present in values are considered).
+            power: float - Distance exponent of the weights.
+            max_km: float - Ignore sites further than this.
+            min_sites: int - Hours with fewer valid sites are NaN.
+            exclude: [String] - Sites to leave out, eg. the site being estimated.
+
+        Returns:
+            pd.DataFrame - Columns value (the estimate) and sites (number of sites used), indexed like values.
+        """
+        candidates = self.within(lat, lon, max_km) if max_km is not None else self.nearest(lat, lon, k=len(self))
+        keep = candidates['site'].isin(values.columns) & ~candidates['site'].isin(exclude or [])
+        candidates = candidates.loc[keep].head(k)
+        d = candidates['distance_km'].to_numpy()
+        colocated = d < 1e-3
+        w = np.where(colocated, 0, 1 / np.where(colocated, 1, d) ** power)
+
+        data = values[candidates['site'].to_numpy()].to_numpy(dtype=float)
+        valid = ~np.isnan(data)
+        filled = np.where(valid, data, 0)
+        total = valid @ w
+        used = (valid & ~colocated).sum(axis=1)
+        exact = (valid & colocated).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            estimate = filled @ w / total
+            exact_mean = filled @ colocated.astype(float) / exact
+        estimate[(used < min_sites) | (total == 0)] = np.nan
+        # Decided per hour, so a missing co-located reading does not hide its neighbours
+        estimate = np.where(exact > 0, exact_mean, estimate)
+        used = np.where(exact > 0, exact, used)
+        return pd.DataFrame({'value': estimate, 'sites': used}, index=values.index)
+
+    def ceds_cells(self, grid):
+        """
+        CEDS grid cell of every site, computed once per grid and reused afterwards.
+
+        Parameters:
+            grid: ceds.CedsGrid - Grid of the CEDS files.
+
+        Returns:
+            pd.DataFrame - Indexed by site, with the cell's row and col and its centre lat and lon.
+        """
+        key = (len(grid.lats), float(grid.lats[0]), float(grid.lats[-1]), len(grid.lons), float(grid.lons[0]), float(grid.lons[-1]))
+        if key not in self.cells:
+            rows, cols = grid.nearest(self.lats, self.lons)
+            self.cells[key] = pd.DataFrame({'row': rows, 'col': cols, 'lat': grid.lats[rows], 'lon': grid.lons[cols]}, index=self.labels)
+        return self.cells[key]
+
+def site_matrix(frames, column):
+    """
+    One column per site of a parameter, on the hourly index shared by all sites.
+
+    Parameters:
+        frames: dict or pd.DataFrame - {site: frame indexed by datetime} (eg. Processor.process_stream(...)),
+                                       or a frame indexed by (site, datetime) (eg. DatasetStore.load(...)).
+        column: String - Parameter to collect.
+
+    Returns:
+        pd.DataFrame indexed by datetime.
+    """
+    if isinstance(frames, pd.DataFrame):
+        return frames[column].unstack('site').asfreq('1h')
+    series = {site: df[column] for site, df in frames.items() if column in df.columns}
+    if not series:
+        return pd.DataFrame()
+    return pd.DataFrame(series).asfreq('1h')
@@ -0,0 +1,18 @@
+import os
+
+from benchmarks.ceds_fixtures import make_ceds_fixtures
+from data_fetcher import DataFetcher
+
+def test_get_ceds_data_defaults_to_every_compound(tmp_path):
+    make_ceds_fixtures(str(tmp_path), ['2018'], ['BENZ', 'TOLU'], resolution=10.0)
+    path = os.path.join(str(tmp_path), '{year}', '')
+
+    df = DataFetcher(cache=False).get_ceds_data('2018', (34.0, -118.0), path=path, hourly=False)
+
+    assert sorted(df.columns) == ['BENZ', 'TOLU']
+    assert len(df) == 12
+    assert df.notna().all().all()
+
+    df = DataFetcher(cache=False).get_ceds_data('2018', (34.0, -118.0), keep=['TOLU'], path=path, hourly=False)
+
+    assert df.columns.tolist() == ['TOLU']
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from spatial import SiteIndex
+
+def make_index():
+    sites = pd.DataFrame({'latitude': [34.0, 34.1, 34.0], 'longitude': [-118.0, -118.0, -118.1]}, index=['a', 'b', 'c'])
+    return SiteIndex(sites)
+
+def test_aggregate_falls_back_when_colocated_site_is_missing():
+    index = make_index()
+    times = pd.date_range('2018-01-01', periods=3, freq='1h')
+    values = pd.DataFrame({'a': [1.0, np.nan, 3.0], 'b': [10.0, 10.0, 10.0], 'c': [20.0, 20.0, 20.0]}, index=times)
+
+    res = index.aggregate(values, 34.0, -118.0, k=3)
+
+    # Hours with a reading at the point use it as is
+    assert res['value'].iloc[0] == 1.0
+    assert res['value'].iloc[2] == 3.0
+    # The missing hour is estimated from the neighbours instead of coming back NaN
+    d = index.nearest(34.0, -118.0, k=3).set_index('site')['distance_km']
+    expected = (10 / d['b'] ** 2 + 20 / d['c'] ** 2) / (1 / d['b'] ** 2 + 1 / d['c'] ** 2)
+    assert np.isclose(res['value'].iloc[1], expected)
+    assert res['sites'].tolist() == [1, 2, 1]
+
+def test_aggregate_exclude():
+    index = make_index()
+    times = pd.date_range('2018-01-01', periods=2, freq='1h')
+    values = pd.DataFrame({'a': [1.0, 1.0], 'b': [10.0, 10.0], 'c': [10.0, 10.0]}, index=times)
+
+    res = index.aggregate(values, 34.0, -118.0, exclude=['a'])
+
+    assert np.allclose(res['value'], 10.0)
+    assert res['sites'].tolist() == [2, 2]